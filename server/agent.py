@@ -1,6 +1,6 @@
 from mesa import Agent
-import math
-import heapq
+import time
+from router import AStarRouter
 
 class Car(Agent):
     """
@@ -9,210 +9,121 @@ class Car(Agent):
         unique_id: Agent's ID 
         direction: Randomly chosen direction chosen from one of eight directions
     """
-    def __init__(self, unique_id, model, pos, destination):
+    def __init__(self, unique_id, model, pos, destination, path=None):
         """
         Creates a new random agent.
         Args:
             unique_id: The agent's ID
             model: Model reference for the agent
+            pos: Position where the car starts
+            destination: Destination the car goes to
+            path: Positions the car has to visit, looked up in the route cache of the model if None
         """
         super().__init__(unique_id, model)
         self.state = "moving"
         self.destination = destination
-        self.last_known_direction = [agent for agent in self.model.grid[pos] if isinstance(agent, Road)][0]
-        self.path = self.a_star_search(pos, self.destination.pos)
-        for agent in self.model.grid[pos]:
-            if isinstance(agent, Road) or isinstance(agent, TrafficLight):
-                self.direction = agent.direction
-        # if pos in self.model.all_paths:
-        #     if destination.pos in self.model.all_paths[pos]:
-        #         self.path = self.model.all_paths[pos][destination.pos]
-        #     else:
-        #         self.path = self.a_star_search(pos, self.destination.pos)
-        #         if self.path:
-        #             self.model.all_paths[pos][destination.pos] = self.path
-        # else:
-        #     self.path = self.a_star_search(pos, self.destination.pos)
-        #     if self.path:
-        #         self.model.all_paths[pos] = {}
-        #         self.model.all_paths[pos][destination.pos] = self.path
+        self.spawn_step = model.step_count
+        # Routes come from the router of the model, by default the shortest path trees it caches per destination.
+        if path is None:
+            start = time.perf_counter()
+            path, expansions = self.model.router.route(pos, self.destination.pos)
+            model.metrics.add_routing(time.perf_counter() - start, expansions)
+        self.path = path
+        self.blocked_steps = 0
+        self.direction = self.model.road_graph.direction_names[self.model.road_graph.cell_id(pos)]
 
-    def heuristic(self, a, b):
-        """
-        Calculates the distance between A and B.
-        Args:
-            a: Point A
-            b: Point B
-        Returns:
-            The distance between the A and B
-        """
-        return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
-
-
-
-    def get_transitable_neighbors(self, current):
+    def a_star_search(self, start, goal):
         """
-        Get the neighbors that are transitable based on road direction, traffic light behavior, and not buildings.
+        Finds a path from start to goal walking the road graph of the model, see router.AStarRouter.
         Args:
-            current: The current position of the agent.
+            start: Start position
+            goal: Goal position
         Returns:
-            A list of the neighbors that are transitable and follow road direction rules.
+            The list of positions to visit, without the start
         """
-        possible_moves = []
-        neighbors = self.model.grid.get_neighborhood(current, moore=True, include_center=False)
-
-        # # Identify the current cell type: Road, TrafficLight, or other
-        current_direction = None
-        for agent in self.model.grid.get_cell_list_contents(current):
-            if isinstance(agent, Road) or isinstance(agent, TrafficLight):
-                current_direction = agent.direction  # Use the direction of the current Road
-                break
-        #     elif isinstance(agent, TrafficLight):
-        #         current_direction = self.last_known_direction  # Use the last known direction when on a TrafficLight
-        #         break
-
-        # # If no direction is determined (e.g., on a non-transitable cell), return an empty list
-        if not current_direction:
-            return possible_moves
-        
-        for neighbor in neighbors:
-            contents = self.model.grid.get_cell_list_contents(neighbor)
-            # print(f"Contents of ({neighbor[0]}, {neighbor[1]}): {contents}")
-            for agent in contents:
-                if isinstance(agent, Destination):
-                    if agent.pos == self.destination.pos:
-                        possible_moves.append(neighbor)
-                elif not isinstance(agent, Building):
-                    if isinstance(agent, Road) or isinstance(agent, TrafficLight):
-
-
-                        if current_direction == 'Up' and agent.pos[1] >= current[1] and agent.direction != 'Down':
-                            if agent.direction == 'Left' and agent.pos[0] <= current[0]:
-                                self.last_known_direction = 'Left'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Right' and agent.pos[0] >= current[0]:
-                                self.last_known_direction = 'Right'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Up' and agent.pos[1] >= current[1]:
-                                self.last_known_direction = 'Up'
-                                possible_moves.append(neighbor)
-
-
-                        elif current_direction == 'Down' and agent.pos[1] < current[1] and agent.direction != 'Up':
-                            if agent.direction == 'Left' and agent.pos[0] <= current[0]:
-                                self.last_known_direction = 'Left'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Right' and agent.pos[0] >= current[0]:
-                                self.last_known_direction = 'Right'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Down' and agent.pos[1] <= current[1]:
-                                self.last_known_direction = 'Down'
-                                possible_moves.append(neighbor)
-
-
-                        elif current_direction == 'Right' and agent.pos[0] >= current[0] and agent.direction != 'Left':
-                            if agent.direction == 'Up' and agent.pos[1] >= current[1]:
-                                self.last_known_direction = 'Up'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Down' and agent.pos[1] <= current[1]:
-                                self.last_known_direction = 'Down'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Right' and agent.pos[0] >= current[0]:
-                                self.last_known_direction = "Right"
-                                possible_moves.append(neighbor)
-
-
-                        elif current_direction == 'Left' and agent.pos[0] < current[0] and agent.direction != 'Right':
-                            self.last_known_direction = 'Left'
-                            if agent.direction == 'Up' and agent.pos[1] >= current[1]:
-                                self.last_known_direction = 'Up'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Down' and agent.pos[1] <= current[1]:
-                                self.last_known_direction = 'Down'
-                                possible_moves.append(neighbor)
-                            elif agent.direction == 'Left' and agent.pos[0] <= current[0]:
-                                self.last_known_direction = 'Left'
-                                possible_moves.append(neighbor)
-                        
-                        # if current_direction == 'Up' and agent.pos[1] > current[1] and agent.pos[0] == current[0]:
-                        #     possible_moves.append(neighbor)
-                        # elif current_direction == 'Down' and agent.pos[1] < current[1] and agent.pos[0] == current[0]:
-                        #     possible_moves.append(neighbor)
-                        # elif current_direction == 'Right' and agent.pos[0] > current[0] and agent.pos[0] == current[0]:
-                        #     possible_moves.append(neighbor)
-                        # elif current_direction == 'Left' and agent.pos[0] < current[0] and agent.pos[0] == current[0]:
-                        #     possible_moves.append(neighbor)
-
-        return possible_moves
-
-
-    def a_star_search(self, start, goal):
-        # print("New A* Search")
-        frontier = []
-        heapq.heappush(frontier, (0, start))
-        came_from = {}
-        cost_so_far = {}
-        came_from[start] = None
-        cost_so_far[start] = 0
-        
-        while frontier:
-
-            current = heapq.heappop(frontier)[1]
-            if current == goal:
-                # print(f"Frontier: {frontier}")
-                # print(f"Came_from: {came_from}")
-                # print(f"Cost_so_far: {cost_so_far}")
-                break
-            neighbors = self.get_transitable_neighbors(current)
-            # if not neighbors:
-            #     return self.reconstruct_path(came_from, start, current)
-            for next in neighbors:
-                new_cost = cost_so_far[current] + 1
-                if next not in cost_so_far or new_cost < cost_so_far[next]:
-                    cost_so_far[next] = new_cost
-                    priority = new_cost + self.heuristic(goal, next)
-                    heapq.heappush(frontier, (priority, next))
-                    came_from[next] = current
-        else: # No break
-            # print("Frontier: ", frontier)
-            # print("Error: No path found.")
-            return []
-        return self.reconstruct_path(came_from, start, goal)
-
-    def reconstruct_path(self, came_from, start, goal):
-        current = goal
-        path = []
-        while current != start:
-            if current not in came_from:
-                # print(f"Error: Node {current} not in came_from.")
-                return path  # Devuelve el camino parcial
-            path.append(current)
-            current = came_from[current]
-        path.reverse()
+        started = time.perf_counter()
+        path, expansions = AStarRouter(self.model.road_graph).route(start, goal)
+        self.model.metrics.add_routing(time.perf_counter() - started, expansions)
         return path
 
     def move(self):
         """ 
         Determines if the agent can move in the direction that was chosen
         """
+        event_log = self.model.event_log
         if self.path:
             next_move = self.path[0]
-            for agent in self.model.grid[next_move]:
-                if isinstance(agent, Road) or isinstance(agent, TrafficLight):
-                    self.direction = agent.direction
-            for agent in self.model.grid.get_cell_list_contents(next_move):
-                if isinstance(agent, TrafficLight):
-                    # print(f"Traffic Light {agent.unique_id} is {agent.state}")
-                    if agent.state == False:
-                        return
-                elif isinstance(agent, Car):
+            grid = self.model.grid
+            cell = grid.cell_id(next_move)
+            direction = self.model.road_graph.direction_names[cell]
+            previous_direction = self.direction
+            if direction:
+                self.direction = direction
+            # The grid keeps the light state and the number of cars of each cell, so there's no need to look inside it.
+            if grid.light_states[cell] == False or grid.cars[cell]:
+                if not self.reroute():
+                    self.model.metrics.blocked_cars += 1
+                    if event_log is not None and self.direction != previous_direction:
+                        event_log.move(self)
                     return
+            self.blocked_steps = 0
             next_move = self.path.pop(0)
             self.model.grid.move_agent(self, next_move)
-            self.model.arrived_cars += 1
+            if event_log is not None:
+                event_log.move(self)
         else:
+            # Cars with an unreachable destination have no path either, only count the ones that got there.
+            arrived = self.pos == self.destination.pos
+            if arrived:
+                self.model.arrived_cars += 1
+                self.model.total_travel_time += self.model.step_count - self.spawn_step
             self.model.grid.remove_agent(self)
             self.model.schedule.remove(self)
+            if event_log is not None:
+                event_log.remove(self, arrived)
+
+    def reroute(self):
+        """
+        When the model has rerouting on and the car has been blocked for long enough, repairs its path
+        around the traffic it can see.
+        Returns:
+            True if the first cell of the new path is free, so the car can move now
+        """
+        model = self.model
+        if model.rerouter is None:
+            return False
+        self.blocked_steps += 1
+        # The number of searches per step is limited, so a jam can't make the steps slow.
+        if self.blocked_steps < model.reroute_patience or model.reroute_budget <= 0:
+            return False
+        rerouter = model.rerouter
+        grid = model.grid
+        if rerouter.saturated[grid.cell_id(self.pos)] or not rerouter.has_way_out(self.pos, self.path[0], self.destination.pos):
+            # In a jam that fills the horizon detours only fill the gaps the traffic needs to move, until the cars
+            # wait for each other in a loop. And when every other cell the car could enter is taken no detour
+            # can get it moving now.
+            self.blocked_steps = 0
+            return False
+        model.reroute_budget -= 1
+        expansions = rerouter.expansions
+        start = time.perf_counter()
+        path = rerouter.route(self.pos, self.destination.pos)
+        model.metrics.add_routing(time.perf_counter() - start, rerouter.expansions - expansions)
+        if (not path or path[0] == self.path[0] or not rerouter.is_free(grid.cell_id(path[0]))
+                or len(path) > len(self.path) + rerouter.max_detour):
+            # Waiting is still the best option, look again after another reroute_patience steps.
+            # A detour that is blocked too would only take the car off its shortest route, and a long one
+            # takes it through the traffic of other roads.
+            self.blocked_steps = 0
+            return False
+        model.reroutes += 1
+        self.path = path
+        if model.event_log is not None:
+            model.event_log.reroute(self)
+        direction = model.road_graph.direction_names[grid.cell_id(path[0])]
+        if direction:
+            self.direction = direction
+        return True
 
     def step(self):
         """ 
@@ -221,65 +132,64 @@ class Car(Agent):
         if self.state == "moving":
             self.move()
 
-class TrafficLight(Agent):
+class TrafficLight:
     """
     Traffic light. Where the traffic lights are in the grid.
+    The lights are not agents anymore: the TrafficController of the model sets all of them on every step.
     """
-    def __init__(self, unique_id, model, state = False, timeToChange = 10, direction = "Up"):
-        super().__init__(unique_id, model)
+    __slots__ = ("unique_id", "pos", "state", "timeToChange", "direction")
+
+    def __init__(self, unique_id, pos, state = False, timeToChange = 10, direction = "Up"):
         """
         Creates a new Traffic light.
         Args:
-            unique_id: The agent's ID
-            model: Model reference for the agent
+            unique_id: The light's ID
+            pos: Position of the light
             state: Whether the traffic light is green or red
-            timeToChange: After how many step should the traffic light change color 
+            timeToChange: Green time of its phase in the fixed cycle
+            direction: Direction where the cars can move
         """
+        self.unique_id = unique_id
+        self.pos = pos
         self.state = state
         self.timeToChange = timeToChange
         self.direction = direction
 
-    def step(self):
-        """ 
-        To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
-        """
-        if self.model.schedule.steps % self.timeToChange == 0:
-            self.state = not self.state
-
-class Destination(Agent):
+class Destination:
     """
-    Destination agent. Where each car should go.
+    Destination. Where each car should go.
+    Static cells are not agents: they don't act, so they are plain records built from the map arrays.
     """
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+    __slots__ = ("unique_id", "pos")
 
-    def step(self):
-        pass
+    def __init__(self, unique_id, pos):
+        self.unique_id = unique_id
+        self.pos = pos
 
-class Building(Agent):
+class Building:
     """
-    Building agent. Just to add builgins to the grid.
+    Building. Cells where the cars can't go.
     """
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+    __slots__ = ("unique_id", "pos")
 
-    def step(self):
-        pass
+    def __init__(self, unique_id, pos):
+        self.unique_id = unique_id
+        self.pos = pos
 
-class Road(Agent):
+class Road:
     """
-    Road agent. Determines where the cars can move, and in which direction.
+    Road. Determines where the cars can move, and in which direction.
     """
-    def __init__(self, unique_id, model, direction= "Left"):
+    __slots__ = ("unique_id", "pos", "direction")
+
+    def __init__(self, unique_id, pos, direction= "Left"):
         """
         Creates a new road.
         Args:
-            unique_id: The agent's ID
-            model: Model reference for the agent
+            unique_id: The road's ID
+            pos: Position of the road
             direction: Direction where the cars can move
         """
-        super().__init__(unique_id, model)
+        self.unique_id = unique_id
+        self.pos = pos
         self.direction = direction
-
-    def step(self):
-        pass
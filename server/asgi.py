@@ -0,0 +1,405 @@
+"""
+Production server: the routes of server.py, with the same requests and JSON responses, on an asyncio (ASGI) stack.
+
+    python asgi.py    (or: uvicorn asgi:app --port 8585)
+
+It shares the settings and the session registry of server.py (the CITY_* environment variables). The differences are
+only in how the requests are served:
+    - Uvicorn instead of the Werkzeug debug server, with HTTP keep-alive (CITY_KEEP_ALIVE seconds)
+    - JSON is encoded with orjson when it is installed, and the /get-cars body is encoded once per step and
+      shared by all the clients that poll it
+    - Creating, resetting and stepping models runs on worker threads, so a slow step never blocks the event loop.
+      The streams wait for new steps on the event loop, without a thread per client
+The sessions live in the memory of the process, so the server must run with a single worker.
+See load_test.py to measure it.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import weakref
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from server import sessions, engine, tickRate, profileEvery, DEFAULT_SESSION
+from sessions import SessionLimitError, recording_folder
+from stream import DeltaEncoder
+from metrics import PrometheusText, add_step_metrics
+from trajectory import TrajectoryReader, frame_snapshot
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("city.asgi")
+# Seconds an idle connection is kept open for the next request of the client.
+keepAlive = float(os.environ.get("CITY_KEEP_ALIVE", "30"))
+# Seconds a stream waits for a step before it sends a keep-alive.
+STREAM_KEEP_ALIVE = 15
+# Last /get-cars body of every session, with the snapshot it was encoded from.
+carsBodies = weakref.WeakKeyDictionary()
+
+
+def dumps(content):
+    """
+    Encodes content as compact JSON bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+
+def failsWith(message):
+    """
+    Turns the errors of a route into a 500 response with message, like the routes of server.py.
+    """
+    def decorator(route):
+        @functools.wraps(route)
+        async def handle(request):
+            try:
+                return await route(request)
+            except Exception:
+                logger.exception(message)
+                return FastJSONResponse({"message": message}, status_code=500)
+        return handle
+    return decorator
+
+
+async def requestParameters(request):
+    """
+    Returns the JSON body of the request as a dictionary, empty if there is no body or it isn't JSON.
+    """
+    body = await request.body()
+    if not body:
+        return {}
+    try:
+        parameters = json.loads(body)
+    except ValueError:
+        return {}
+    return parameters if isinstance(parameters, dict) else {}
+
+
+async def sessionId(request, parameters=None):
+    """
+    Returns the session id of the request: the session query parameter, the X-Session-Id header or the session field of the body.
+    """
+    session_id = request.query_params.get("session") or request.headers.get("x-session-id")
+    if session_id:
+        return session_id
+    if parameters is None:
+        parameters = await requestParameters(request)
+    return parameters.get("session") or DEFAULT_SESSION
+
+
+def queryInt(request, name, default=None, minimum=None):
+    """
+    Returns an integer query parameter of the request, default if it wasn't sent.
+    Raises:
+        ValueError: If the parameter isn't an integer or is smaller than minimum
+    """
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    value = int(value)
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return value
+
+
+def sessionNotFound():
+    return FastJSONResponse({"message":"Session not found, initialize the model first."}, status_code=404)
+
+
+def sessionInfo(session, message):
+    return {
+        "message": message,
+        "sessionId": session.session_id,
+        "seed": session.run_seed,
+        "width": session.model.width,
+        "height": session.model.height
+    }
+
+
+def headerValues(request, name):
+    """
+    Returns the comma separated values of a header, lower case, without their parameters and weights of 0.
+    """
+    values = []
+    for part in request.headers.get(name, "").split(","):
+        value, _, options = part.partition(";")
+        options = options.replace(" ", "")
+        if options.startswith("q="):
+            try:
+                if float(options[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if value.strip():
+            values.append(value.strip().lower())
+    return values
+
+
+def etagMatches(request, etag):
+    for value in request.headers.get("if-none-match", "").split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == "*" or value.strip('"') == etag:
+            return True
+    return False
+
+
+def framesResponse(frames, binary):
+    if binary:
+        return StreamingResponse(frames, media_type="application/octet-stream")
+    return StreamingResponse(frames, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@failsWith("Erorr initializing the model")
+async def initModel(request):
+    parameters = await requestParameters(request)
+    session_id = None if parameters.get("newSession") else await sessionId(request, parameters)
+    session = sessions.get(session_id) if session_id else None
+    if session is not None:
+        return FastJSONResponse(sessionInfo(session, "Model already initiated"))
+    try:
+        # Building the model can take a while on big maps.
+        session = await run_in_threadpool(sessions.create, session_id,
+                                          engine=parameters.get("engine", engine),
+                                          tick_rate=float(parameters.get("tickRate", tickRate)),
+                                          rerouting=bool(parameters.get("rerouting", False)),
+                                          light_control=parameters.get("lightControl", "fixed"),
+                                          profile_every=profileEvery,
+                                          demand=parameters.get("demand"),
+                                          seed=int(parameters["seed"]) if parameters.get("seed") is not None else None)
+    except SessionLimitError as e:
+        return FastJSONResponse({"message":str(e)}, status_code=503)
+    return FastJSONResponse(sessionInfo(session, "Parameters recieved, model initiated."))
+
+
+@failsWith("Erorr initializing the model")
+async def resetModel(request):
+    session = sessions.get(await sessionId(request))
+    if session is None:
+        return sessionNotFound()
+    await run_in_threadpool(session.start)
+    return FastJSONResponse(sessionInfo(session, "Parameters recieved, model initiated."))
+
+
+@failsWith("Error during step.")
+async def updateModel(request):
+    session = sessions.get(await sessionId(request))
+    if session is None:
+        return sessionNotFound()
+    # Without a tick rate the model is updated here, on a worker thread.
+    runner = session.runner
+    snapshot = runner.snapshot if runner.running else await run_in_threadpool(runner.step)
+    return FastJSONResponse({
+        'message': f'Model updated to step {snapshot.step}',
+        'step': snapshot.step,
+        'total': snapshot.total
+    })
+
+
+@failsWith("Error with car positions")
+async def getCars(request):
+    session = sessions.get(await sessionId(request))
+    if session is None:
+        return sessionNotFound()
+    snapshot = session.runner.snapshot
+    cached = carsBodies.get(session)
+    if cached is None or cached[0] is not snapshot:
+        cached = (snapshot, dumps({"cars": snapshot.cars, "trafficLights": snapshot.traffic_lights}))
+        carsBodies[session] = cached
+    return Response(cached[1], media_type="application/json")
+
+
+async def streamCars(request):
+    session = sessions.get(await sessionId(request))
+    if session is None:
+        return sessionNotFound()
+    binary = request.query_params.get("format") == "binary"
+    try:
+        keyframe = queryInt(request, "keyframe", 50, minimum=1)
+    except ValueError:
+        return FastJSONResponse({"message":"keyframe must be a number of frames, at least 1."}, status_code=400)
+    encoder = DeltaEncoder(keyframe, binary)
+
+    async def frames():
+        loop = asyncio.get_running_loop()
+        published = asyncio.Event()
+
+        def wake(snapshot):
+            loop.call_soon_threadsafe(published.set)
+
+        current = None
+        snapshot = None
+        try:
+            # The stream ends when the session is closed.
+            while sessions.get(session.session_id) is session:
+                # A reset replaces the runner, so the client needs a new keyframe.
+                if current is not session.runner:
+                    if current is not None:
+                        current.unsubscribe(wake)
+                    current = session.runner
+                    current.subscribe(wake)
+                    encoder.reset()
+                    snapshot = current.snapshot
+                else:
+                    # Cleared before looking at the snapshot, so a step published in between still wakes the stream.
+                    published.clear()
+                    if current.snapshot.step <= snapshot.step:
+                        try:
+                            await asyncio.wait_for(published.wait(), STREAM_KEEP_ALIVE)
+                        except asyncio.TimeoutError:
+                            pass
+                    latest = current.snapshot
+                    if latest.step == snapshot.step:
+                        # Nothing new, keep the connection alive (an empty packet in binary streams).
+                        yield bytes(4) if binary else ": keep-alive\n\n"
+                        continue
+                    snapshot = latest
+                frame = encoder.encode(snapshot)
+                if binary:
+                    yield len(frame).to_bytes(4, "little") + frame
+                else:
+                    yield f"data: {frame}\n\n"
+        finally:
+            if current is not None:
+                current.unsubscribe(wake)
+
+    return framesResponse(frames(), binary)
+
+
+async def replaySteps(request):
+    session_id = await sessionId(request)
+    session = sessions.get(session_id)
+    folder = None
+    if sessions.recording_dir is not None:
+        try:
+            folder = recording_folder(sessions.recording_dir, session_id)
+        except ValueError:
+            return FastJSONResponse({"message":"Invalid session id."}, status_code=400)
+    if session is not None and session.recorder is not None:
+        lights = session.recorder.meta["lights"]
+        recorded = session.recorder.frames
+    elif folder is not None and os.path.exists(os.path.join(folder, "meta.json")):
+        reader = TrajectoryReader(folder)
+        lights = reader.lights
+        recorded = reader.frames
+    else:
+        return FastJSONResponse({"message":"The session has no recording, set CITY_RECORDING_DIR to record the sessions."}, status_code=404)
+    try:
+        start = queryInt(request, "start")
+        stop = queryInt(request, "stop")
+    except ValueError:
+        return FastJSONResponse({"message":"start and stop must be step numbers."}, status_code=400)
+    binary = request.query_params.get("format") == "binary"
+    try:
+        keyframe = queryInt(request, "keyframe", 50, minimum=1)
+    except ValueError:
+        return FastJSONResponse({"message":"keyframe must be a number of frames, at least 1."}, status_code=400)
+    encoder = DeltaEncoder(keyframe, binary)
+
+    # A plain generator: it reads the recording from disk, so Starlette runs it on worker threads.
+    def frames():
+        for frame in recorded(start, stop):
+            encoded = encoder.encode(frame_snapshot(lights, frame))
+            if binary:
+                yield len(encoded).to_bytes(4, "little") + encoded
+            else:
+                yield f"data: {encoded}\n\n"
+
+    return framesResponse(frames(), binary)
+
+
+@failsWith("Error with city objects positions")
+async def getCity(request):
+    session = sessions.get(await sessionId(request))
+    if session is None:
+        return sessionNotFound()
+    # Built and compressed once per map (the first time on a worker thread), clients that have it get a 304.
+    payload = await run_in_threadpool(lambda: session.model.city_map.city_payload)
+    headers = {"ETag": f'"{payload.etag}"', "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etagMatches(request, payload.etag):
+        return Response(status_code=304, headers=headers)
+    encodings = headerValues(request, "accept-encoding")
+    if payload.br is not None and "br" in encodings:
+        return Response(payload.br, media_type="application/json", headers=dict(headers, **{"Content-Encoding": "br"}))
+    elif "gzip" in encodings:
+        return Response(payload.gzip, media_type="application/json", headers=dict(headers, **{"Content-Encoding": "gzip"}))
+    return Response(payload.json, media_type="application/json", headers=headers)
+
+
+async def getMetrics(request):
+    page = PrometheusText()
+    page.sample("city_sessions", "gauge", "Open sessions.", len(sessions))
+    page.sample("city_sessions_evicted_total", "counter", "Sessions closed for being idle or too big.", sessions.evicted)
+    for session_id, session in sessions.items():
+        add_step_metrics(page, session.runner.snapshot.metrics, {"session": session_id, "engine": session.engine})
+    return Response(page.render(), media_type="text/plain; version=0.0.4")
+
+
+async def getProfile(request):
+    session = sessions.get(await sessionId(request))
+    if session is None:
+        return sessionNotFound()
+    try:
+        report = await run_in_threadpool(session.runner.snapshot.metrics.profile_report, request.query_params.get("sort", "cumulative"))
+    except KeyError:
+        return FastJSONResponse({"message":"Unknown sort key."}, status_code=400)
+    if report is None:
+        return FastJSONResponse({"message":"No step has been profiled, set CITY_PROFILE_EVERY to profile the steps."}, status_code=404)
+    return Response(report, media_type="text/plain")
+
+
+async def closeSession(request):
+    session_id = await sessionId(request)
+    if session_id not in sessions:
+        return sessionNotFound()
+    # Stopping waits for the current step of the session.
+    await run_in_threadpool(sessions.remove, session_id)
+    return FastJSONResponse({"message":"Session closed.", "sessionId": session_id})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    sessions.start_reaper()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/init", initModel, methods=["POST"]),
+        Route("/reset", resetModel, methods=["POST"]),
+        Route("/update", updateModel, methods=["GET"]),
+        Route("/get-cars", getCars, methods=["GET"]),
+        Route("/stream-cars", streamCars, methods=["GET"]),
+        Route("/replay", replaySteps, methods=["GET"]),
+        Route("/get-city", getCity, methods=["GET"]),
+        Route("/metrics", getMetrics, methods=["GET"]),
+        Route("/profile", getProfile, methods=["GET"]),
+        Route("/close", closeSession, methods=["POST"])
+    ],
+    # Same as the cross_origin() of the routes of server.py.
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["GET", "POST"], allow_headers=["*"])],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    # Same port as the flask server. No access log: it would cost more than most of the requests.
+    uvicorn.run(app, host=os.environ.get("CITY_HOST", "localhost"), port=int(os.environ.get("CITY_PORT", "8585")),
+                timeout_keep_alive=keepAlive, access_log=False, log_level="warning")
@@ -0,0 +1,151 @@
+"""
+Runs the city simulation without the server, for parameter sweeps.
+
+Example, from the server folder:
+    python batch.py --steps 1000 --maps city_files/2022_base.txt city_files/2023_base.txt \
+        --spawn-intervals 5 10 --light-timings 17,5 10,10 --light-controls fixed adaptive --replicates 20 --output results.npz
+"""
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from model import create_model
+
+# Columns of the results, in order.
+COLUMNS = ["map_file", "engine", "rerouting", "light_control", "spawn_interval", "red_timing", "green_timing", "seed", "steps",
+           "spawned", "arrivals", "throughput", "mean_travel_time", "active_cars", "seconds"]
+
+
+def run_simulation(map_file="city_files/2022_base.txt", engine="mesa", spawn_interval=10, light_timings=None, seed=0, steps=1000,
+                   rerouting=False, light_control="fixed"):
+    """
+    Runs one simulation and returns its metrics.
+    Args:
+        map_file: Path of the map file
+        engine: "mesa" or "vectorized"
+        spawn_interval: Every how many steps new cars appear
+        light_timings: Timings of the lights that start red and of the ones that start green, the ones of the map if None
+        seed: Seed of the run
+        steps: Number of steps to run
+        rerouting: Whether blocked cars repair their routes (only the mesa engine has it)
+        light_control: "fixed", "green_wave" or "adaptive"
+    Returns:
+        Dictionary with one value for each column in COLUMNS
+    """
+    start = time.perf_counter()
+    options = {"rerouting": True} if rerouting else {}
+    model = create_model(engine, map_file=map_file, spawn_interval=spawn_interval, light_timings=light_timings, seed=seed,
+                         light_control=light_control, **options)
+    for _ in range(steps):
+        model.step()
+    return {
+        "map_file": map_file,
+        "engine": engine,
+        "rerouting": rerouting,
+        "light_control": light_control,
+        "spawn_interval": spawn_interval,
+        "red_timing": model.light_timings[0],
+        "green_timing": model.light_timings[1],
+        "seed": seed,
+        "steps": steps,
+        "spawned": model.cars_count,
+        "arrivals": model.arrived_cars,
+        "throughput": model.arrived_cars / steps if steps else 0.0,
+        "mean_travel_time": model.total_travel_time / model.arrived_cars if model.arrived_cars else float("nan"),
+        "active_cars": len(model.get_cars()),
+        "seconds": time.perf_counter() - start
+    }
+
+
+def _run(parameters):
+    return run_simulation(**parameters)
+
+
+def sweep(maps, spawn_intervals=(10,), light_timings=(None,), replicates=1, steps=1000, engine="mesa", seed=0, workers=None,
+          rerouting=False, light_controls=("fixed",)):
+    """
+    Runs every combination of the parameters, replicates times each, on a pool of processes.
+    Replicate i of every combination uses the seed seed + i.
+    Returns:
+        Dictionary from column name to numpy array, one row per run
+    """
+    runs = [{
+        "map_file": map_file,
+        "engine": engine,
+        "spawn_interval": spawn_interval,
+        "light_timings": timings,
+        "seed": seed + replicate,
+        "steps": steps,
+        "rerouting": rerouting,
+        "light_control": light_control
+    } for map_file, light_control, spawn_interval, timings, replicate
+        in itertools.product(maps, light_controls, spawn_intervals, light_timings, range(replicates))]
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_run, runs, chunksize=max(1, len(runs) // (4 * workers))))
+
+    return {column: np.array([result[column] for result in results]) for column in COLUMNS}
+
+
+def save_results(columns, output):
+    """
+    Writes the results of a sweep to a columnar file: .npz (numpy), .parquet (needs pyarrow) or .csv.
+    """
+    if output.endswith(".npz"):
+        np.savez_compressed(output, **columns)
+    elif output.endswith(".parquet") or output.endswith(".csv"):
+        import pandas as pd
+        frame = pd.DataFrame(columns)
+        if output.endswith(".parquet"):
+            frame.to_parquet(output, index=False)
+        else:
+            frame.to_csv(output, index=False)
+    else:
+        raise ValueError(f"Unknown output format: {output}")
+
+
+def summarize(columns):
+    """
+    Returns the mean metrics of each combination of parameters as printable lines.
+    """
+    keys = list(zip(columns["map_file"], columns["light_control"], columns["spawn_interval"], columns["red_timing"], columns["green_timing"]))
+    lines = []
+    for key in dict.fromkeys(keys):
+        rows = np.array([row_key == key for row_key in keys])
+        lines.append(f"{key[0]} {key[1]} spawn={key[2]} lights={key[3]}/{key[4]} runs={rows.sum()} "
+                     f"arrivals={columns['arrivals'][rows].mean():.1f} "
+                     f"throughput={columns['throughput'][rows].mean():.3f} "
+                     f"travel_time={np.nanmean(columns['mean_travel_time'][rows]):.1f}")
+    return lines
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the city simulation headless over a grid of parameters.")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--maps", nargs="+", default=["city_files/2022_base.txt"])
+    parser.add_argument("--spawn-intervals", nargs="+", type=int, default=[10])
+    parser.add_argument("--light-timings", nargs="+", default=None,
+                        help="Timings as red,green pairs, e.g. 17,5. The ones of each map by default")
+    parser.add_argument("--light-controls", nargs="+", choices=["fixed", "green_wave", "adaptive"], default=["fixed"])
+    parser.add_argument("--replicates", type=int, default=1)
+    parser.add_argument("--engine", choices=["mesa", "vectorized"], default="mesa")
+    parser.add_argument("--rerouting", action="store_true", help="Blocked cars repair their routes around the traffic")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="results.npz")
+    args = parser.parse_args(args)
+
+    light_timings = [tuple(int(value) for value in timing.split(",")) for timing in args.light_timings] if args.light_timings else [None]
+    columns = sweep(args.maps, args.spawn_intervals, light_timings, args.replicates, args.steps, args.engine, args.seed, args.workers,
+                    args.rerouting, args.light_controls)
+    save_results(columns, args.output)
+    for line in summarize(columns):
+        print(line)
+    print(f"{len(columns['seed'])} runs written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Benchmarks of the hot paths of the simulation: the A* of the cars, the routers, the steps of the model and the
+serialization of the routes the visualization polls. The base maps can be tiled into bigger maps to
+see how each path scales with the size of the city.
+
+Results are written as JSON and can be compared with a saved baseline. Example, from the server folder:
+    python benchmark.py --tiles 1 2 4 --output baseline.json
+    python benchmark.py --tiles 1 2 4 --output current.json --baseline baseline.json
+The comparison uses the best time of each benchmark, the least affected by the noise of the machine,
+and exits with status 1 if any benchmark got slower than --threshold times its baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import mesa
+from agent import Car
+from city_map import load_city_map
+from model import CityModel
+from map_compiler import ROAD
+from route_cache import RouteCache
+from router import ROUTERS, TreeRouter, create_router
+
+BENCHMARKS = ["astar", "routers", "step", "serialization"]
+
+
+def tile_map(map_file, tiles_x, tiles_y, folder):
+    """
+    Writes a map made of tiles_x by tiles_y copies of a map file.
+    Returns:
+        Path of the new map file
+    """
+    with open(map_file) as baseFile:
+        lines = baseFile.read().splitlines()
+    width = len(lines[0])
+    rows = [line.ljust(width)[:width] * tiles_x for line in lines]
+    path = os.path.join(folder, f"{os.path.splitext(os.path.basename(map_file))[0]}_{tiles_x}x{tiles_y}.txt")
+    with open(path, "w") as tiledFile:
+        tiledFile.write("\n".join(rows * tiles_y) + "\n")
+    return path
+
+
+def measure(function, repeat):
+    """
+    Runs function repeat times.
+    Returns:
+        Dictionary with the best, median and mean seconds of the runs
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"repeat": repeat, "best": min(times), "median": statistics.median(times), "mean": statistics.mean(times)}
+
+
+def populate(model, density, seed=0):
+    """
+    Adds cars with random destinations to a fraction of the free road cells of a model.
+    Returns:
+        Number of cars added
+    """
+    rng = np.random.default_rng(seed)
+    graph = model.road_graph
+    cells = np.flatnonzero((model.city_map.kinds == ROAD) & (np.frombuffer(model.grid.cars, dtype=np.intc) == 0))
+    cells = rng.choice(cells, int(len(cells) * density), replace=False)
+    destinations = rng.integers(0, len(model.destinations), len(cells))
+    for cell, destination in zip(cells.tolist(), destinations.tolist()):
+        pos = graph.positions[cell]
+        car = Car(f"c_{model.cars_count}", model, pos, model.destinations[destination])
+        model.cars_count += 1
+        model.grid.place_agent(car, pos)
+        model.schedule.add(car)
+    return len(cells)
+
+
+def bench_astar(map_file, repeat):
+    """
+    Car.a_star_search from every corner to every destination.
+    """
+    model = CityModel(map_file, seed=0)
+    car = next(agent for agent in model.schedule.agents if isinstance(agent, Car))
+    pairs = [(corner, destination.pos) for corner in model.corners for destination in model.destinations]
+
+    def search():
+        for start, goal in pairs:
+            car.a_star_search(start, goal)
+
+    return [dict(measure(search, repeat), benchmark="astar", searches=len(pairs))]
+
+
+def bench_routers(map_file, repeat):
+    """
+    Every router of router.ROUTERS from every corner to every destination, with the cells each one expands.
+    The trees of the tree router are built again on every run, the landmarks of the alt router only once per map.
+    """
+    city_map = load_city_map(map_file)
+    city_map.landmarks
+    pairs = [(corner, pos) for corner in city_map.corners for _, pos in city_map.destinations]
+    results = []
+    for name in ROUTERS:
+        expansions = []
+
+        def search():
+            router = TreeRouter(RouteCache(city_map.road_graph)) if name == "tree" else create_router(name, city_map)
+            expansions.append(sum(router.route(start, goal)[1] or 0 for start, goal in pairs))
+
+        results.append(dict(measure(search, repeat), benchmark="routers", router=name, searches=len(pairs),
+                            expansions=expansions[-1]))
+    return results
+
+
+def bench_step(map_file, densities, steps, repeat):
+    """
+    CityModel.step with a fraction of the road cells taken by cars. Every run starts from the same model.
+    """
+    results = []
+    for density in densities:
+        models = []
+        for _ in range(repeat):
+            # No spawns, so the number of cars only goes down as they arrive.
+            model = CityModel(map_file, spawn_interval=10 ** 9, seed=0)
+            cars = populate(model, density)
+            models.append(model)
+
+        def run():
+            model = models.pop()
+            for _ in range(steps):
+                model.step()
+
+        results.append(dict(measure(run, repeat), benchmark="step", density=density, cars=cars, steps=steps))
+    return results
+
+
+def bench_serialization(map_file, densities, requests, repeat):
+    """
+    /get-cars and /get-city through the Flask test client, on a session of the map.
+    """
+    import server
+    client = server.app.test_client()
+    session = server.sessions.create("benchmark", map_file=map_file, tick_rate=0)
+    results = []
+    try:
+        for density in densities:
+            session.start()
+            cars = populate(session.model, density)
+            session.runner.step()
+
+            def get_cars():
+                for _ in range(requests):
+                    client.get("/get-cars?session=benchmark").get_data()
+
+            results.append(dict(measure(get_cars, repeat), benchmark="serialization", route="/get-cars",
+                                density=density, cars=cars, requests=requests))
+
+        for encoding in ("identity", "gzip"):
+            def get_city():
+                for _ in range(requests):
+                    client.get("/get-city?session=benchmark", headers={"Accept-Encoding": encoding}).get_data()
+
+            results.append(dict(measure(get_city, repeat), benchmark="serialization", route="/get-city",
+                                encoding=encoding, requests=requests))
+    finally:
+        server.sessions.remove("benchmark")
+    return results
+
+
+def result_key(result):
+    """
+    Identifies a result across runs: every field except the measurements.
+    """
+    return json.dumps({key: value for key, value in result.items() if key not in ("repeat", "best", "median", "mean", "cars", "expansions")},
+                      sort_keys=True)
+
+
+def compare(results, baseline, threshold=1.25):
+    """
+    Compares the best time of every result with the same result in a baseline.
+    Args:
+        results: List of results of this run
+        baseline: List of results of a previous run
+        threshold: Ratio of the best times above which a result counts as a regression
+    Returns:
+        (lines, regressions): printable lines and the number of regressions
+    """
+    previous = {result_key(result): result for result in baseline}
+    lines = []
+    regressions = 0
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            lines.append(f"new        {result_key(result)}")
+            continue
+        ratio = result["best"] / before["best"] if before["best"] else float("inf")
+        if ratio > threshold:
+            regressions += 1
+            status = "REGRESSION"
+        elif ratio < 1 / threshold:
+            status = "faster"
+        else:
+            status = "same"
+        lines.append(f"{status:<10} {ratio:6.2f}x {before['best'] * 1000:10.3f}ms -> {result['best'] * 1000:10.3f}ms  {result_key(result)}")
+    return lines, regressions
+
+
+def run_benchmarks(maps, tiles=(1,), benchmarks=BENCHMARKS, densities=(0.05, 0.1, 0.2, 0.4), steps=20, requests=50, repeat=5):
+    """
+    Runs the benchmarks on every map, tiled every number of times in tiles.
+    Returns:
+        List of results, one dictionary per measurement
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for map_file in maps:
+            for tile in tiles:
+                path = map_file if tile == 1 else tile_map(map_file, tile, tile, folder)
+                model = CityModel(path, seed=0)
+                context = {"map": os.path.basename(map_file), "tiles": tile, "width": model.width, "height": model.height}
+                measured = []
+                if "astar" in benchmarks:
+                    measured += bench_astar(path, repeat)
+                if "routers" in benchmarks:
+                    measured += bench_routers(path, repeat)
+                if "step" in benchmarks:
+                    measured += bench_step(path, densities, steps, repeat)
+                if "serialization" in benchmarks:
+                    measured += bench_serialization(path, densities, requests, repeat)
+                for result in measured:
+                    results.append(dict(context, **result))
+                    expansions = f", {result['expansions']} expansions" if "expansions" in result else ""
+                    print(f"{result_key(results[-1])}: {result['best'] * 1000:.3f}ms{expansions}", file=sys.stderr)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the routing, stepping and serialization of the simulation.")
+    parser.add_argument("--maps", nargs="+", default=["city_files/2021_base.txt", "city_files/2022_base.txt", "city_files/2023_base.txt"])
+    parser.add_argument("--tiles", nargs="+", type=int, default=[1, 2], help="Build maps of NxN copies of each map")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--densities", nargs="+", type=float, default=[0.05, 0.1, 0.2, 0.4],
+                        help="Fractions of the road cells with cars")
+    parser.add_argument("--steps", type=int, default=20, help="Steps per run of the step benchmark")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per run of the serialization benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", default=None, help="Results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(args.maps, args.tiles, args.benchmarks, args.densities, args.steps, args.requests, args.repeat)
+    with open(args.output, "w") as outputFile:
+        json.dump({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "mesa": mesa.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results
+        }, outputFile, indent=1)
+    print(f"{len(results)} results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)["results"]
+        lines, regressions = compare(results, baseline, args.threshold)
+        for line in lines:
+            print(line)
+        if regressions:
+            print(f"{regressions} regressions")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
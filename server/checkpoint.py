@@ -0,0 +1,416 @@
+"""
+Checkpoints and event logs of CityModel.
+
+A checkpoint is the dynamic state of a model (cars with their remaining paths, lights, counters and the state of the
+random generator) in a binary file. Restoring it gives a model that runs the same steps the original would have run.
+    preamble: magic, format version, length of the header
+    header: JSON with the settings of the model, its counters, the cars waiting to enter and the number of records
+        of each section
+    sections: CAR_STATE records, the cells of the paths, the light states, the intersections and the random state
+
+An event log is an append-only file with one block per step: the cars that spawned (with their paths), moved,
+changed their route or left, and the lights that changed. Every keyframe_every steps there is a keyframe block
+with the whole state, so replaying to a step only applies the blocks after the keyframe before it,
+without running the cars or searching any route.
+"""
+import json
+import mmap
+import os
+import struct
+import numpy as np
+from map_compiler import map_hash
+from road_graph import DIRECTION_CODES, DIRECTIONS
+
+CHECKPOINT_MAGIC = b"CITYCKPT"
+LOG_MAGIC = b"CITYLOG\0"
+FORMAT_VERSION = 1
+# magic, version, length of the JSON header.
+PREAMBLE = struct.Struct("<8sII")
+
+CAR_STATE = np.dtype([("serial", "<i8"), ("cell", "<i4"), ("destination", "<i4"), ("spawn_step", "<i4"),
+                      ("blocked_steps", "<i4"), ("direction", "u1"), ("path_length", "<i4")])
+INTERSECTION_STATE = np.dtype([("phase", "u1"), ("elapsed", "<i4")])
+
+STEP, KEYFRAME = 0, 1
+# kind, step, arrived cars, then the number of records of each section of the block.
+BLOCK_HEADER = struct.Struct("<BIIIIIIII")
+SPAWN_RECORD = np.dtype([("serial", "<i8"), ("cell", "<i4"), ("destination", "<i4"), ("spawn_step", "<i4"),
+                         ("direction", "u1"), ("path_length", "<i4")])
+MOVE_RECORD = np.dtype([("serial", "<i8"), ("cell", "<i4"), ("direction", "u1")])
+REMOVE_RECORD = np.dtype([("serial", "<i8"), ("arrived", "u1")])
+REROUTE_RECORD = np.dtype([("serial", "<i8"), ("path_length", "<i4")])
+LIGHT_CHANGE_RECORD = np.dtype([("index", "<u4"), ("state", "u1")])
+# Order of the sections in a block, after the header.
+BLOCK_SECTIONS = (SPAWN_RECORD, MOVE_RECORD, REMOVE_RECORD, REROUTE_RECORD, np.dtype("<i4"), LIGHT_CHANGE_RECORD)
+
+
+def serial(car):
+    """
+    Returns the number of a car id ("c_12" -> 12).
+    """
+    return int(car.unique_id.split("_")[-1])
+
+
+def _map_key(model):
+    return map_hash(model.settings["map_file"], "city_files/mapDictionary.json")
+
+
+def _read_preamble(data, magic):
+    found, version, length = PREAMBLE.unpack_from(data)
+    if found != magic:
+        raise ValueError("Not a city simulation file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported format version {version}")
+    return json.loads(bytes(data[PREAMBLE.size:PREAMBLE.size + length])), PREAMBLE.size + length
+
+
+def _preamble(magic, header):
+    header = json.dumps(header, separators=(",", ":")).encode()
+    return PREAMBLE.pack(magic, FORMAT_VERSION, len(header)) + header
+
+
+def save_checkpoint(model):
+    """
+    Returns the dynamic state of a CityModel as bytes.
+    """
+    graph = model.road_graph
+    destination_index = {destination.pos: index for index, destination in enumerate(model.destinations)}
+    # Cars are saved in the order of the schedule, which is the order RandomActivation shuffles.
+    cars = []
+    paths = []
+    for car in model.schedule.agents:
+        cars.append((serial(car), graph.cell_id(car.pos), destination_index[car.destination.pos], car.spawn_step,
+                     car.blocked_steps, DIRECTION_CODES.get(car.direction, 0), len(car.path)))
+        paths.extend(graph.cell_id(pos) for pos in car.path)
+
+    control = model.traffic_control
+    intersections = np.zeros(len(control.intersections), dtype=INTERSECTION_STATE)
+    intersections["phase"] = control.phase
+    intersections["elapsed"] = control.elapsed
+    random_version, random_state, gauss_next = model.random.getstate()
+    sections = [np.array(cars, dtype=CAR_STATE), np.array(paths, dtype="<i4"), control.states.astype("u1"), intersections,
+                np.array(random_state, dtype="<u4")]
+    header = {
+        "settings": model.settings,
+        "map": _map_key(model),
+        "step_count": model.step_count,
+        "cars_count": model.cars_count,
+        "arrived_cars": model.arrived_cars,
+        "total_travel_time": model.total_travel_time,
+        "reroutes": model.reroutes,
+        "schedule": [model.schedule.steps, model.schedule.time],
+        "light_time": control.time,
+        "random": [random_version, gauss_next],
+        "spawn_queue": None if model.spawn_queue is None else
+            [model.spawn_queue.state(), model.spawn_queue.dropped, model.spawn_queue.waited],
+        "sections": [len(section) for section in sections]
+    }
+    return b"".join([_preamble(CHECKPOINT_MAGIC, header)] + [section.tobytes() for section in sections])
+
+
+def load_checkpoint(data, **options):
+    """
+    Creates a CityModel from the bytes of save_checkpoint.
+    Args:
+        data: Bytes of the checkpoint
+        options: Arguments of the model that aren't part of its state, e.g. profile_every
+    Raises:
+        ValueError: If the data isn't a checkpoint or the map changed since it was taken
+    """
+    from model import CityModel, Car
+    header, offset = _read_preamble(data, CHECKPOINT_MAGIC)
+    sections = []
+    for dtype, count in zip((CAR_STATE, np.dtype("<i4"), np.dtype("u1"), INTERSECTION_STATE, np.dtype("<u4")), header["sections"]):
+        sections.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+        offset += dtype.itemsize * count
+    records, paths, light_states, intersections, random_state = sections
+
+    model = CityModel(**header["settings"], **options)
+    if _map_key(model) != header["map"]:
+        raise ValueError(f"The map {model.settings['map_file']} changed since the checkpoint was taken")
+    for car in model.schedule.agents:
+        model.grid.remove_agent(car)
+        model.schedule.remove(car)
+
+    positions = model.road_graph.positions
+    start = 0
+    for record in records.tolist():
+        number, cell, destination, spawn_step, blocked_steps, direction, path_length = record
+        path = [positions[cell] for cell in paths[start:start + path_length].tolist()]
+        start += path_length
+        car = Car(f"c_{number}", model, positions[cell], model.destinations[destination], path)
+        car.spawn_step = spawn_step
+        car.blocked_steps = blocked_steps
+        car.direction = DIRECTIONS[direction]
+        model.grid.place_agent(car, positions[cell])
+        model.schedule.add(car)
+
+    control = model.traffic_control
+    control.time = header["light_time"]
+    control.states[:] = light_states.astype(bool)
+    control.phase[:] = intersections["phase"]
+    control.elapsed[:] = intersections["elapsed"]
+    for light, state in zip(model.trafficLights, control.states.tolist()):
+        light.state = state
+        model.grid.light_states[model.grid.cell_id(light.pos)] = state
+
+    model.step_count = header["step_count"]
+    model.cars_count = header["cars_count"]
+    model.arrived_cars = header["arrived_cars"]
+    model.total_travel_time = header["total_travel_time"]
+    model.reroutes = header["reroutes"]
+    model.schedule.steps, model.schedule.time = header["schedule"]
+    if header.get("spawn_queue") is not None:
+        model.spawn_queue.restore(*header["spawn_queue"])
+    random_version, gauss_next = header["random"]
+    model.random.setstate((random_version, tuple(random_state.tolist()), gauss_next))
+    return model
+
+
+def write_checkpoint(model, path):
+    """
+    Saves a checkpoint to a file. The file is written next to its final place and renamed,
+    so a crash never leaves half a checkpoint.
+    """
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as checkpointFile:
+        checkpointFile.write(save_checkpoint(model))
+    os.replace(temporary, path)
+
+
+def read_checkpoint(path, **options):
+    """
+    Creates a CityModel from a checkpoint file.
+    """
+    with open(path, "rb") as checkpointFile:
+        return load_checkpoint(checkpointFile.read(), **options)
+
+
+def index_blocks(data, offset):
+    """
+    Finds the blocks of an event log without reading their records.
+    Returns:
+        List of (offset, kind, step) of every complete block
+    """
+    blocks = []
+    while offset + BLOCK_HEADER.size <= len(data):
+        kind, step, _, *counts = BLOCK_HEADER.unpack_from(data, offset)
+        end = offset + BLOCK_HEADER.size + sum(dtype.itemsize * count for dtype, count in zip(BLOCK_SECTIONS, counts))
+        if end > len(data):
+            # The last block was cut by a crash.
+            break
+        blocks.append((offset, kind, step))
+        offset = end
+    return blocks
+
+
+def read_block(data, offset):
+    """
+    Returns the kind, step, arrived cars and sections of the block at offset.
+    """
+    kind, step, arrived, *counts = BLOCK_HEADER.unpack_from(data, offset)
+    offset += BLOCK_HEADER.size
+    sections = []
+    for dtype, count in zip(BLOCK_SECTIONS, counts):
+        sections.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+        offset += dtype.itemsize * count
+    return kind, step, arrived, sections
+
+
+class EventLog:
+    """
+    Writes the events of a CityModel to an append-only file. Attaching the log to a model sets model.event_log,
+    which the model and its cars call during the steps, and writes a keyframe with the current state.
+    Attributes:
+        path: File of the log
+        keyframe_every: Every how many steps a keyframe is written
+    """
+    def __init__(self, path, model, keyframe_every=500):
+        """
+        Opens a log for a model.
+        If the file is a log of the same map, it is continued: the blocks after the current step of the model
+        (e.g. written after the checkpoint the model was restored from) are dropped. Otherwise it is replaced.
+        """
+        self.path = path
+        self.keyframe_every = keyframe_every
+        self.graph = model.road_graph
+        self.destination_index = {destination.pos: index for index, destination in enumerate(model.destinations)}
+        header = {"settings": model.settings, "map": _map_key(model)}
+
+        end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as logFile:
+                data = logFile.read()
+            try:
+                previous, offset = _read_preamble(data, LOG_MAGIC)
+                if previous["map"] == header["map"]:
+                    end = offset
+                    for block_offset, _, step in index_blocks(data, offset):
+                        if step > model.step_count:
+                            break
+                        end = block_offset
+            except (ValueError, struct.error):
+                end = 0
+        self.file = open(path, "r+b" if end else "wb")
+        if end:
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.file.write(_preamble(LOG_MAGIC, header))
+        self._clear()
+        model.event_log = self
+        self.write_keyframe(model)
+
+    def _clear(self):
+        self.spawns = []
+        self.moves = []
+        self.removes = []
+        self.reroutes = []
+        self.spawn_paths = []
+        self.reroute_paths = []
+        self.lights = []
+
+    def spawn(self, car):
+        self.spawns.append((serial(car), self.graph.cell_id(car.pos), self.destination_index[car.destination.pos],
+                            car.spawn_step, DIRECTION_CODES.get(car.direction, 0), len(car.path)))
+        self.spawn_paths.extend(self.graph.cell_id(pos) for pos in car.path)
+
+    def move(self, car):
+        """
+        A car moved or turned towards its next cell.
+        """
+        self.moves.append((serial(car), self.graph.cell_id(car.pos), DIRECTION_CODES.get(car.direction, 0)))
+
+    def remove(self, car, arrived):
+        self.removes.append((serial(car), arrived))
+
+    def reroute(self, car):
+        self.reroutes.append((serial(car), len(car.path)))
+        self.reroute_paths.extend(self.graph.cell_id(pos) for pos in car.path)
+
+    def light_changes(self, indices, states):
+        self.lights.extend(zip(indices, states))
+
+    def _write_block(self, kind, step, arrived):
+        # The paths of the spawns come before the ones of the reroutes, the same order they are read.
+        sections = [np.array(self.spawns, dtype=SPAWN_RECORD), np.array(self.moves, dtype=MOVE_RECORD),
+                    np.array(self.removes, dtype=REMOVE_RECORD), np.array(self.reroutes, dtype=REROUTE_RECORD),
+                    np.array(self.spawn_paths + self.reroute_paths, dtype="<i4"), np.array(self.lights, dtype=LIGHT_CHANGE_RECORD)]
+        self.file.write(BLOCK_HEADER.pack(kind, step, arrived, *(len(section) for section in sections)) +
+                        b"".join(section.tobytes() for section in sections))
+        self._clear()
+
+    def end_step(self, model):
+        """
+        Writes the events of the step that just ended.
+        """
+        self._write_block(STEP, model.step_count, model.arrived_cars)
+        if model.step_count % self.keyframe_every == 0:
+            self.write_keyframe(model)
+        self.file.flush()
+
+    def write_keyframe(self, model):
+        """
+        Writes the whole state of the model: every car as a spawn with its remaining path, and every light.
+        """
+        self._clear()
+        for car in model.schedule.agents:
+            self.spawn(car)
+        self.lights = list(enumerate(model.traffic_control.states.tolist()))
+        self._write_block(KEYFRAME, model.step_count, model.arrived_cars)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayState:
+    """
+    State of the cars and lights of a logged simulation at one step.
+    Attributes:
+        step: Step of the state
+        arrived_cars: Cars that reached their destination
+        cars: Dictionary by car serial of [cell, destination index, spawn step, direction code, remaining path cells]
+        light_states: Whether every light is green
+    """
+    def __init__(self, city_map):
+        self.city_map = city_map
+        self.step = 0
+        self.arrived_cars = 0
+        self.cars = {}
+        self.light_states = np.zeros(len(city_map.traffic_lights), dtype=bool)
+
+    def apply(self, kind, step, arrived, sections):
+        """
+        Applies a block of the log.
+        """
+        spawns, moves, removes, reroutes, paths, lights = sections
+        paths = paths.tolist()
+        if kind == KEYFRAME:
+            self.cars = {}
+        start = 0
+        for number, cell, destination, spawn_step, direction, path_length in spawns.tolist():
+            self.cars[number] = [cell, destination, spawn_step, direction, paths[start:start + path_length]]
+            start += path_length
+        # A car changes its route before it moves in the same step.
+        for number, path_length in reroutes.tolist():
+            self.cars[number][4] = paths[start:start + path_length]
+            start += path_length
+        for number, cell, direction in moves.tolist():
+            car = self.cars[number]
+            if car[0] != cell:
+                car[0] = cell
+                car[4] = car[4][1:]
+            car[3] = direction
+        for number, _ in removes.tolist():
+            del self.cars[number]
+        if len(lights):
+            self.light_states[lights["index"]] = lights["state"].astype(bool)
+        self.step = step
+        self.arrived_cars = arrived
+
+    def get_cars(self):
+        """
+        Returns the cars as the list of dictionaries sent to the visualization.
+        """
+        height = self.city_map.height
+        return [{
+            "id": f"c_{number}",
+            "x": car[0] // height,
+            "y": 0,
+            "dir": DIRECTIONS[car[3]],
+            "z": car[0] % height
+        } for number, car in self.cars.items()]
+
+    def get_traffic_lights(self):
+        """
+        Returns the traffic lights as the list of dictionaries sent to the visualization.
+        """
+        return [{
+            "id": unique_id,
+            "x": pos[0],
+            "y": 1,
+            "z": pos[1],
+            "state": state
+        } for (unique_id, pos, _, _, _), state in zip(self.city_map.traffic_lights, self.light_states.tolist())]
+
+
+def replay(path, step=None):
+    """
+    Rebuilds the state of a logged simulation at a step, from the last keyframe before it.
+    Args:
+        path: File of the event log
+        step: Step to replay to, the last logged step if None
+    Returns:
+        ReplayState, at the last logged step if the log ends before step
+    """
+    from city_map import load_city_map
+    with open(path, "rb") as logFile, mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header, offset = _read_preamble(data, LOG_MAGIC)
+        state = ReplayState(load_city_map(header["settings"]["map_file"]))
+        blocks = [block for block in index_blocks(data, offset) if step is None or block[2] <= step]
+        keyframes = [index for index, (_, kind, _) in enumerate(blocks) if kind == KEYFRAME]
+        if keyframes:
+            for block_offset, _, _ in blocks[keyframes[-1]:]:
+                state.apply(*read_block(data, block_offset))
+    return state
@@ -0,0 +1,173 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import namedtuple
+from functools import cached_property, lru_cache
+import numpy as np
+from map_compiler import load_map, ROAD, TRAFFIC_LIGHT, BUILDING, DESTINATION, STARTS_GREEN
+from road_graph import DIRECTIONS, RoadGraph
+from route_cache import RouteCache
+from router import Landmarks, bfs_tree
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The /get-city response of a map, serialized and compressed once. br is None if brotli isn't installed.
+CityPayload = namedtuple("CityPayload", ["etag", "json", "gzip", "br"])
+
+
+class CityMap:
+    """
+    Static data of a city map file, shared by the simulation engines.
+    The map is kept as the typed arrays of map_compiler (memory-mapped from the compiled map cache),
+    the lists of objects are only built the first time they are needed.
+    Positions use the grid coordinates, (column, height - row - 1).
+    Attributes:
+        width, height: Size of the map
+        light_timings: Green time of the lights that start red and of the ones that start green, from the dictionary
+        kinds, directions, light_groups: Arrays indexed by cell id, see map_compiler
+        roads: List of (unique_id, pos, direction)
+        traffic_lights: List of (unique_id, pos, state, timeToChange, direction)
+        buildings: List of (unique_id, pos)
+        destinations: List of (unique_id, pos)
+        road_graph: The compiled RoadGraph of the map
+        routes: RouteCache of the map, shared by all the models that use it
+        landmarks: router.Landmarks of the map, shared by all the models that use it
+    """
+    def __init__(self, map_file="city_files/2022_base.txt", dictionary_file="city_files/mapDictionary.json", cache_dir="city_files/.compiled"):
+        """
+        Loads a map file.
+        Args:
+            map_file: Text file where each character represents an agent
+            dictionary_file: JSON file that maps the characters in the map file to the corresponding agent
+            cache_dir: Folder of the compiled maps, None to parse the text without caching
+        """
+        compiled = load_map(map_file, dictionary_file, cache_dir)
+        self.width = compiled["width"]
+        self.height = compiled["height"]
+        self.light_timings = tuple(compiled["light_timings"])
+        self.kinds = compiled["kinds"]
+        self.directions = compiled["directions"]
+        self.light_groups = compiled["light_groups"]
+
+        edges = tuple(compiled[name] for name in ("indptr", "indices", "reverse_indptr", "reverse_indices"))
+        self.road_graph = RoadGraph(self.width, self.height, self.directions, self.kinds == DESTINATION, edges)
+        self.routes = RouteCache(self.road_graph)
+
+    def _objects(self, kind):
+        """
+        Returns the unique ids, positions and cell ids of the cells of a kind, in the order of the map file.
+        """
+        cells = np.flatnonzero(self.kinds == kind)
+        x, y = np.divmod(cells, self.height)
+        # Unique ids are row * width + column in the map file, like when the agents were created from the text.
+        numbers = (self.height - y - 1) * self.width + x
+        order = np.argsort(numbers, kind="stable")
+        return numbers[order].tolist(), list(zip(x[order].tolist(), y[order].tolist())), cells[order]
+
+    @cached_property
+    def roads(self):
+        numbers, positions, cells = self._objects(ROAD)
+        return [(f"r_{number}", pos, DIRECTIONS[code]) for number, pos, code in zip(numbers, positions, self.directions[cells].tolist())]
+
+    @cached_property
+    def traffic_lights(self):
+        numbers, positions, cells = self._objects(TRAFFIC_LIGHT)
+        red_timing, green_timing = self.light_timings
+        return [(f"tl_{number}", pos, group == STARTS_GREEN, green_timing if group == STARTS_GREEN else red_timing, DIRECTIONS[code])
+                for number, pos, group, code in zip(numbers, positions, self.light_groups[cells].tolist(), self.directions[cells].tolist())]
+
+    @cached_property
+    def buildings(self):
+        numbers, positions, _ = self._objects(BUILDING)
+        return [(f"ob_{number}", pos) for number, pos in zip(numbers, positions)]
+
+    @cached_property
+    def destinations(self):
+        numbers, positions, _ = self._objects(DESTINATION)
+        return [(f"d_{number}", pos) for number, pos in zip(numbers, positions)]
+
+    @property
+    def corners(self):
+        """
+        Cells where the new cars appear.
+        """
+        return [(0, 0), (0, self.height-1), (self.width-1, 0), (self.width-1, self.height-1)]
+
+    @cached_property
+    def landmarks(self):
+        """
+        Landmarks of the alt router (see router), computed the first time a model uses them.
+        """
+        return Landmarks(self.road_graph)
+
+    @cached_property
+    def next_hops(self):
+        """
+        Next cell towards each destination from every cell, one row per destination (-1 where it can't be reached).
+        The rows are filled straight from the searches, without keeping their trees in the route cache.
+        """
+        graph = self.road_graph
+        table = np.empty((len(self.destinations), graph.width * graph.height), dtype=np.int32)
+        for row, (_, pos) in zip(table, self.destinations):
+            row[:] = bfs_tree(graph.reverse_indptr, graph.reverse_indices, graph.cell_id(pos))[1]
+        table.setflags(write=False)
+        return table
+
+    def get_city(self):
+        """
+        Returns the positions of the city objects as the lists of dictionaries sent to the visualization,
+        in the same order a walk over the grid cells gives.
+        """
+        def positions(objects):
+            return [{
+                "id": str(unique_id),
+                "x": pos[0],
+                "y": 1,
+                "z": pos[1]
+            } for unique_id, pos in sorted(objects, key=lambda item: item[1])]
+
+        return {
+            "buildings": positions(self.buildings),
+            "roads": positions((unique_id, pos) for unique_id, pos, _ in self.roads),
+            "destinations": positions(self.destinations),
+            "trafficLights": positions((unique_id, pos) for unique_id, pos, _, _, _ in self.traffic_lights)
+        }
+
+    @cached_property
+    def city_payload(self):
+        """
+        The result of get_city as JSON bytes, plus its compressed versions and an ETag.
+        The city never changes during a simulation, so this is built once per map.
+        """
+        body = json.dumps(self.get_city(), separators=(",", ":")).encode()
+        return CityPayload(
+            etag=hashlib.sha256(body).hexdigest()[:32],
+            json=body,
+            gzip=gzip.compress(body, compresslevel=9),
+            br=brotli.compress(body) if brotli is not None else None
+        )
+
+
+def _file_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_city_map(map_file="city_files/2022_base.txt", dictionary_file="city_files/mapDictionary.json"):
+    """
+    Returns the CityMap of a map file, parsing it only the first time.
+    The map is shared by every model that loads it, so it must not be modified.
+    The modification time and size of the files are part of the key, so a map edited while the server runs
+    is loaded again instead of serving its old arrays and ETag.
+    """
+    return _load_city_map(map_file, dictionary_file, _file_version(map_file), _file_version(dictionary_file))
+
+
+@lru_cache(maxsize=16)
+def _load_city_map(map_file, dictionary_file, map_version, dictionary_version):
+    return CityMap(map_file, dictionary_file)
@@ -0,0 +1,189 @@
+"""
+Demand of the simulation: how many cars appear on each step, where they appear and where they go.
+
+    DemandProfile: Arrival rate of the cars over time and an origin-destination matrix that splits them
+    SpawnQueue: Cars that arrived at an origin and wait for its entry cell to be free
+
+The profile is given as a dictionary of JSON types, so it can be kept in the settings of a model and sent to /init:
+    {
+        "rates": [[0, 0.2], [300, 2.0], [600, 0.2]],   # (step, cars per step over all the origins), interpolated
+        "period": 1440,                                # the rates repeat every period steps, optional
+        "origins": [[0, 0], [23, 0]],                  # entry cells, the corners of the map if missing
+        "od": [[1, 0, 2, ...], [0, 1, 1, ...]]         # weight of every origin (rows) and destination (columns),
+    }                                                  # the same for all of them if missing
+The number of cars of a step follows a Poisson distribution with the rate of the step, drawn with the random
+number generator of the model, so a seeded run with demand is as repeatable as one without.
+"""
+from collections import deque
+import numpy as np
+
+
+def rush_hour_rates(base, peak, peak_steps, ramp):
+    """
+    Returns the rates of a profile with a base rate and rush hours.
+    Args:
+        base: Cars per step out of the rush hours
+        peak: Cars per step at the top of each rush hour
+        peak_steps: Step of the top of every rush hour
+        ramp: Steps the rate takes to go from base to peak and back
+    """
+    rates = [[0, base]]
+    for step in sorted(peak_steps):
+        rates.extend([[max(0, step - ramp), base], [step, peak], [step + ramp, base]])
+    return rates
+
+
+def poisson(mean, random):
+    """
+    Returns how many cars of a Poisson process with the given mean arrive in one step:
+    the number of exponential gaps between arrivals that fit in the step.
+    """
+    count = 0
+    if mean <= 0:
+        return count
+    elapsed = random.expovariate(mean)
+    while elapsed < 1:
+        count += 1
+        elapsed += random.expovariate(mean)
+    return count
+
+
+class DemandProfile:
+    """
+    Time-varying arrivals of cars split over an origin-destination matrix.
+    Attributes:
+        settings: The dictionary the profile was created from
+        origins: (x, y) of the entry cell of every origin
+        steps, rates: Breakpoints of the arrival rate, cars per step over all the origins
+        period: Steps after which the rates repeat, None if the last rate is kept forever
+    """
+    def __init__(self, settings, road_graph, corners, destinations_count):
+        """
+        Args:
+            settings: Dictionary with the rates, period, origins and od of the profile (see the module)
+            road_graph: RoadGraph of the map
+            corners: Default origins
+            destinations_count: Number of destinations of the map, the columns of the matrix
+        Raises:
+            ValueError: If the settings don't fit the map
+        """
+        self.settings = settings
+        self.origins = [tuple(origin) for origin in settings.get("origins") or corners]
+        for origin in self.origins:
+            if not (0 <= origin[0] < road_graph.width and 0 <= origin[1] < road_graph.height):
+                raise ValueError(f"The origin {origin} is outside the map")
+            cell = road_graph.cell_id(origin)
+            if road_graph.indptr[cell + 1] == road_graph.indptr[cell]:
+                raise ValueError(f"Cars can't leave the origin {origin}")
+
+        rates = sorted((int(step), float(rate)) for step, rate in settings.get("rates") or [(0, 0.4)])
+        self.steps = np.array([step for step, _ in rates], dtype=np.float64)
+        self.rates = np.array([rate for _, rate in rates], dtype=np.float64)
+        if (self.rates < 0).any():
+            raise ValueError("Arrival rates can't be negative")
+        self.period = settings.get("period")
+
+        od = settings.get("od")
+        weights = np.ones((len(self.origins), destinations_count)) if od is None else np.array(od, dtype=np.float64)
+        if weights.shape != (len(self.origins), destinations_count):
+            raise ValueError(f"The origin-destination matrix must have {len(self.origins)} rows and {destinations_count} columns")
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError("The origin-destination matrix needs positive weights")
+        # Every arrival picks an (origin, destination) pair, numbered origin * destinations + destination.
+        self._destinations_count = destinations_count
+        self._pairs = np.flatnonzero(weights).tolist()
+        self._cumulative = np.cumsum(weights.ravel()[self._pairs]).tolist()
+
+    def rate(self, step):
+        """
+        Returns the cars per step over all the origins at a step.
+        """
+        if self.period:
+            return float(np.interp(step, self.steps, self.rates, period=self.period))
+        return float(np.interp(step, self.steps, self.rates))
+
+    def arrivals(self, step, random):
+        """
+        Draws the cars that arrive at a step.
+        Args:
+            step: Number of the step
+            random: random.Random of the model
+        Returns:
+            List of (origin index, destination index) of the cars
+        """
+        count = poisson(self.rate(step), random)
+        if not count:
+            return []
+        pairs = random.choices(self._pairs, cum_weights=self._cumulative, k=count)
+        return [divmod(pair, self._destinations_count) for pair in pairs]
+
+
+class SpawnQueue:
+    """
+    Cars waiting to enter the map. Every origin lets in at most one car per step, when its entry cell is empty,
+    so cars never appear on top of each other and a busy origin builds a queue instead.
+    Attributes:
+        cells: Cell id of the entry cell of every origin
+        pending: Deque of (destination index, arrival step) of every origin
+        max_pending: Cars an origin keeps waiting, the ones that arrive when it is full are dropped. None for no limit
+        dropped: Cars dropped because their origin was full
+        waited: Steps the cars that entered spent waiting, in total
+    """
+    def __init__(self, cells, max_pending=None):
+        self.cells = cells
+        self.pending = [deque() for _ in cells]
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.waited = 0
+
+    def __len__(self):
+        return sum(len(waiting) for waiting in self.pending)
+
+    def add(self, arrivals, step):
+        """
+        Puts the cars that arrived at a step at the end of the queues of their origins.
+        Args:
+            arrivals: List of (origin index, destination index)
+            step: Step of the arrival
+        """
+        for origin, destination in arrivals:
+            waiting = self.pending[origin]
+            if self.max_pending is not None and len(waiting) >= self.max_pending:
+                self.dropped += 1
+            else:
+                waiting.append((destination, step))
+
+    def release(self, occupancy, step):
+        """
+        Takes out the first car of every origin whose entry cell is empty.
+        Args:
+            occupancy: Number of cars in every cell, indexed by cell id
+            step: Current step
+        Returns:
+            List of (origin index, destination index) of the cars that enter, in the order of the origins
+        """
+        released = []
+        taken = set()
+        for origin, (cell, waiting) in enumerate(zip(self.cells, self.pending)):
+            if waiting and not occupancy[cell] and cell not in taken:
+                destination, arrival = waiting.popleft()
+                self.waited += step - arrival
+                taken.add(cell)
+                released.append((origin, destination))
+        return released
+
+    def state(self):
+        """
+        Returns the waiting cars as a list of [origin, destination, arrival step], e.g. for a checkpoint.
+        """
+        return [[origin, destination, arrival] for origin, waiting in enumerate(self.pending) for destination, arrival in waiting]
+
+    def restore(self, state, dropped=0, waited=0):
+        """
+        Replaces the waiting cars with the ones of state.
+        """
+        self.pending = [deque() for _ in self.cells]
+        for origin, destination, arrival in state:
+            self.pending[origin].append((destination, arrival))
+        self.dropped = dropped
+        self.waited = waited
@@ -0,0 +1,170 @@
+"""
+Load generator for the server: keeps a number of connections busy with the polling requests of the visualization and
+reports the requests per second and the latency percentiles.
+
+Works against server.py and asgi.py alike. Each connection sends its requests one after the other over HTTP/1.1
+keep-alive, and opens a new connection only when the server closes it. Example, with the server running:
+    python load_test.py --connections 32 --duration 20 --paths /update /get-cars
+"""
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+import numpy as np
+
+
+class Connection:
+    """
+    HTTP/1.1 client connection that reopens itself when the server closes it.
+    Attributes:
+        host, port: Address of the server
+        reconnects: Number of times the connection was opened
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reconnects = 0
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, body=b"", headers=None):
+        """
+        Sends a request and reads the whole response.
+        Returns:
+            (status, body)
+        """
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self.reconnects += 1
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        status, headers = await self._read_head()
+        if headers.get("transfer-encoding") == "chunked":
+            content = await self._read_chunks()
+        elif "content-length" in headers:
+            content = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await self._reader.read()
+            headers["connection"] = "close"
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, content
+
+    async def _read_head(self):
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("The server closed the connection")
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        version, status = status_line.split()[:2]
+        if version == b"HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+            headers["connection"] = "close"
+        return int(status), headers
+
+    async def _read_chunks(self):
+        chunks = []
+        while True:
+            size = int((await self._reader.readline()).split(b";")[0], 16)
+            chunk = await self._reader.readexactly(size + 2)
+            if not size:
+                return b"".join(chunks)
+            chunks.append(chunk[:-2])
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+async def worker(connection, paths, headers, deadline, latencies, errors):
+    """
+    Sends the paths in turn until the deadline, adding the latency of every request to latencies.
+    """
+    index = 0
+    while time.perf_counter() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            status, _ = await connection.request("GET", path, headers=headers)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            connection.close()
+            errors.append(path)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors.append(path)
+
+
+async def run_load(url, paths, connections=16, duration=10.0, session=None, init=True):
+    """
+    Runs the load test.
+    Args:
+        url: Base url of the server
+        paths: Paths the connections request in turn, with their query strings
+        connections: Number of connections sending requests at the same time
+        duration: Seconds of load
+        session: Session id sent in X-Session-Id, the default session if None
+        init: POST /init before the test, so the session exists
+    Returns:
+        Dictionary with the requests, errors, requests per second and latency percentiles in milliseconds
+    """
+    address = urlsplit(url)
+    host, port = address.hostname, address.port or 80
+    headers = {"X-Session-Id": session} if session else {}
+    if init:
+        setup = Connection(host, port)
+        body = json.dumps({"session": session} if session else {}).encode()
+        status, content = await setup.request("POST", "/init", body, {"Content-Type": "application/json", **headers})
+        setup.close()
+        if status != 200:
+            raise RuntimeError(f"/init failed with {status}: {content[:200]!r}")
+
+    clients = [Connection(host, port) for _ in range(connections)]
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(client, paths, headers, start + duration, latencies, errors) for client in clients))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+
+    milliseconds = np.array(latencies) * 1000
+    percentiles = np.percentile(milliseconds, [50, 90, 99]) if len(milliseconds) else [float("nan")] * 3
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "connections_opened": sum(client.reconnects for client in clients),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": float(percentiles[0]),
+        "p90_ms": float(percentiles[1]),
+        "p99_ms": float(percentiles[2]),
+        "max_ms": float(milliseconds.max()) if len(milliseconds) else float("nan")
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measure the requests per second and latency of the server.")
+    parser.add_argument("--url", default="http://localhost:8585")
+    parser.add_argument("--paths", nargs="+", default=["/update", "/get-cars"], help="Paths requested in turn by every connection")
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load")
+    parser.add_argument("--session", default=None, help="Session id, the default session if missing")
+    parser.add_argument("--no-init", action="store_true", help="Don't POST /init before the test")
+    args = parser.parse_args(args)
+
+    results = asyncio.run(run_load(args.url, args.paths, args.connections, args.duration, args.session, not args.no_init))
+    print(", ".join(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}" for name, value in results.items()))
+    return 1 if results["errors"] else 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Compiles the text maps into typed arrays and caches them on disk.
+
+A compiled map is a folder with one .npy file per array, named after the sha256 of the
+map file, the dictionary file and the format version. Loading it memory-maps the arrays,
+so a model starts without parsing the text or creating one python object per cell.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections import Counter
+import numpy as np
+from road_graph import DIRECTION_CODES, UP, DOWN, LEFT, RIGHT, compile_edges, reverse_edges
+
+FORMAT_VERSION = 2
+
+# Kind of every cell.
+EMPTY, ROAD, TRAFFIC_LIGHT, BUILDING, DESTINATION = range(5)
+# Light group of every cell: the lights that start red (upper case) and the ones that start green (lower case).
+NO_LIGHT, STARTS_RED, STARTS_GREEN = range(3)
+
+ROAD_CHARACTERS = "v^><"
+RED_LIGHT_CHARACTERS = "RLUA"
+GREEN_LIGHT_CHARACTERS = "rlua"
+# Lights without a direction in the dictionary, they take the direction of the road they are on.
+# Their entries in the dictionary are the timings of the lights: S for the ones that start red, s for the ones that start green.
+TIMED_LIGHT_CHARACTERS = "Ss"
+# Timings used when the dictionary doesn't have them.
+DEFAULT_LIGHT_TIMINGS = (17, 5)
+
+ARRAYS = ["kinds", "directions", "light_groups", "indptr", "indices", "reverse_indptr", "reverse_indices"]
+
+
+def map_hash(map_file, dictionary_file):
+    """
+    Returns the key of a map in the cache.
+    """
+    digest = hashlib.sha256(f"city-map-v{FORMAT_VERSION}".encode())
+    for path in (map_file, dictionary_file):
+        with open(path, "rb") as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+def compile_map(map_file, dictionary_file="city_files/mapDictionary.json"):
+    """
+    Parses a text map into arrays indexed by cell id (x * height + y).
+    Args:
+        map_file: Text file where each character represents an agent
+        dictionary_file: JSON file that maps the characters to directions
+    Returns:
+        Dictionary with width, height, light_timings (of the lights that start red and green) and the arrays in ARRAYS
+    """
+    with open(dictionary_file) as dictionaryFile:
+        dataDictionary = json.load(dictionaryFile)
+    with open(map_file, "rb") as baseFile:
+        lines = baseFile.read().replace(b"\r\n", b"\n").splitlines(keepends=True)
+    width = len(lines[0]) - 1
+    height = len(lines)
+
+    # Rows of the file, one byte per cell. Rows shorter than the map are padded with empty cells.
+    rows = np.full((height, width), ord(" "), dtype=np.uint8)
+    for r, line in enumerate(lines):
+        row = np.frombuffer(line[:width], dtype=np.uint8)
+        rows[r, :len(row)] = row
+
+    kind_table = np.full(256, EMPTY, dtype=np.uint8)
+    direction_table = np.zeros(256, dtype=np.uint8)
+    light_table = np.full(256, NO_LIGHT, dtype=np.uint8)
+    for character in ROAD_CHARACTERS:
+        kind_table[ord(character)] = ROAD
+    for character in RED_LIGHT_CHARACTERS:
+        kind_table[ord(character)] = TRAFFIC_LIGHT
+        light_table[ord(character)] = STARTS_RED
+    for character in GREEN_LIGHT_CHARACTERS:
+        kind_table[ord(character)] = TRAFFIC_LIGHT
+        light_table[ord(character)] = STARTS_GREEN
+    for character in ROAD_CHARACTERS + RED_LIGHT_CHARACTERS + GREEN_LIGHT_CHARACTERS:
+        direction_table[ord(character)] = DIRECTION_CODES[dataDictionary[character]]
+    kind_table[ord("#")] = BUILDING
+    kind_table[ord("D")] = DESTINATION
+    timed_red, timed_green = TIMED_LIGHT_CHARACTERS
+    for character, group in ((timed_red, STARTS_RED), (timed_green, STARTS_GREEN)):
+        kind_table[ord(character)] = TRAFFIC_LIGHT
+        light_table[ord(character)] = group
+
+    # The first row of the file is the top of the grid: cell (x, y) is rows[height - y - 1, x].
+    cells = np.ascontiguousarray(rows[::-1].T).ravel()
+    compiled = {
+        "width": width,
+        "height": height,
+        "light_timings": [dataDictionary.get(timed_red, DEFAULT_LIGHT_TIMINGS[0]),
+                          dataDictionary.get(timed_green, DEFAULT_LIGHT_TIMINGS[1])],
+        "kinds": kind_table[cells],
+        "directions": direction_table[cells],
+        "light_groups": light_table[cells]
+    }
+    timed = np.flatnonzero((cells == ord(timed_red)) | (cells == ord(timed_green)))
+    compiled["directions"][timed] = infer_directions(timed, width, height, compiled["directions"])
+    indptr, indices = compile_edges(width, height, compiled["directions"], compiled["kinds"] == DESTINATION)
+    compiled["indptr"], compiled["indices"] = indptr, indices
+    compiled["reverse_indptr"], compiled["reverse_indices"] = reverse_edges(indptr, indices)
+    return compiled
+
+
+def infer_directions(lights, width, height, directions):
+    """
+    Returns the direction of the road each light is on: the most common direction among the roads next to it
+    that run along the same axis (Left or Right on its sides, Up or Down above and below).
+    Args:
+        lights: Cell ids of the lights
+        width, height: Size of the map
+        directions: Direction code of every cell
+    """
+    inferred = []
+    for cell in lights.tolist():
+        x, y = divmod(cell, height)
+        votes = Counter()
+        for dx, dy, axis in ((-1, 0, (LEFT, RIGHT)), (1, 0, (LEFT, RIGHT)), (0, -1, (UP, DOWN)), (0, 1, (UP, DOWN))):
+            if 0 <= x + dx < width and 0 <= y + dy < height:
+                code = int(directions[(x + dx) * height + y + dy])
+                if code in axis:
+                    votes[code] += 1
+        inferred.append(votes.most_common(1)[0][0] if votes else 0)
+    return np.array(inferred, dtype=np.uint8)
+
+
+def save_compiled(compiled, folder):
+    """
+    Writes a compiled map to a folder. The folder is written next to its final place and renamed,
+    so other processes never see half a map.
+    """
+    parent = os.path.dirname(os.path.abspath(folder))
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=parent)
+    with open(os.path.join(temporary, "meta.json"), "w") as metaFile:
+        json.dump({"version": FORMAT_VERSION, "width": compiled["width"], "height": compiled["height"],
+                   "light_timings": compiled["light_timings"]}, metaFile)
+    for name in ARRAYS:
+        np.save(os.path.join(temporary, f"{name}.npy"), compiled[name])
+    try:
+        os.rename(temporary, folder)
+    except OSError:
+        # Another process compiled the same map first.
+        for name in os.listdir(temporary):
+            os.remove(os.path.join(temporary, name))
+        os.rmdir(temporary)
+
+
+def load_compiled(folder):
+    """
+    Memory-maps a compiled map.
+    """
+    with open(os.path.join(folder, "meta.json")) as metaFile:
+        compiled = json.load(metaFile)
+    for name in ARRAYS:
+        compiled[name] = np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+    return compiled
+
+
+def load_map(map_file, dictionary_file="city_files/mapDictionary.json", cache_dir="city_files/.compiled"):
+    """
+    Returns the compiled version of a map, compiling it only if it isn't in the cache.
+    Args:
+        map_file: Text file of the map
+        dictionary_file: JSON file that maps the characters to directions
+        cache_dir: Folder of the compiled maps, None to compile in memory without caching
+    """
+    if cache_dir is None:
+        return compile_map(map_file, dictionary_file)
+    folder = os.path.join(cache_dir, map_hash(map_file, dictionary_file))
+    if not os.path.isdir(folder):
+        save_compiled(compile_map(map_file, dictionary_file), folder)
+    return load_compiled(folder)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile map files into the cache.")
+    parser.add_argument("maps", nargs="+")
+    parser.add_argument("--dictionary", default="city_files/mapDictionary.json")
+    parser.add_argument("--cache-dir", default="city_files/.compiled")
+    args = parser.parse_args()
+    for map_file in args.maps:
+        compiled = load_map(map_file, args.dictionary, args.cache_dir)
+        print(f"{map_file}: {compiled['width']}x{compiled['height']} -> {os.path.join(args.cache_dir, map_hash(map_file, args.dictionary))}")
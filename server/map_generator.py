@@ -0,0 +1,231 @@
+"""
+Generates city maps of any size in the format of the files in city_files, to test the simulation at scale.
+
+A generated city is a grid of blocks of buildings between one-way streets two lanes wide:
+    - A ring of streets around the map, going counterclockwise like the ones of the base maps
+    - Vertical and horizontal streets between the blocks, in alternating directions, that start and end on the ring
+    - Traffic lights before some of the crossings, red first on the vertical street and green on the horizontal one
+    - Destinations on the sides of the blocks, next to a street
+Every street can be entered from the ring and leads back to it, so every destination can be reached from the corners
+where the cars appear. unreachable_destinations checks it on the compiled graph of a map.
+
+The file is written in chunks of rows, so the maps can be much bigger than what fits in memory as python strings.
+Example, from the server folder:
+    python map_generator.py city_files/generated_2000.txt --width 2000 --height 2000 --destinations 50 --check
+"""
+import argparse
+import numpy as np
+from map_compiler import compile_map, DESTINATION
+from router import bfs_distances
+
+BUILDING = ord("#")
+DOWN, UP, LEFT, RIGHT = (ord(character) for character in "v^<>")
+# Characters of the lights that start red and green, by direction of the street.
+RED_LIGHTS = {DOWN: ord("A"), UP: ord("U"), LEFT: ord("L"), RIGHT: ord("R")}
+GREEN_LIGHTS = {DOWN: ord("a"), UP: ord("u"), LEFT: ord("l"), RIGHT: ord("r")}
+MIN_BLOCK = 3
+CHUNK_CELLS = 1 << 22
+
+
+def street_starts(size, block_size, rng):
+    """
+    Returns the first row (or column) of every street across the map, the ring streets included.
+    Blocks are between block_size / 2 and 3 * block_size / 2 cells long.
+    """
+    low = max(MIN_BLOCK, block_size // 2)
+    high = max(low, block_size * 3 // 2)
+    starts = [0]
+    while True:
+        start = starts[-1] + 2 + int(rng.integers(low, high + 1))
+        if start + 2 + low > size - 2:
+            break
+        starts.append(start)
+    if size - 2 - (starts[-1] + 2) < MIN_BLOCK and len(starts) > 1:
+        # The last block would be too small, it is merged with the one before.
+        starts.pop()
+    starts.append(size - 2)
+    return np.array(starts, dtype=np.int64)
+
+
+def generate_map(path, width=200, height=200, block_size=10, light_density=0.5, destinations=20, seed=None):
+    """
+    Writes a generated city map.
+    Args:
+        path: Path of the map file
+        width, height: Size of the map, at least 8 cells
+        block_size: Average side of the blocks, the smaller the denser the city
+        light_density: Fraction of the crossings with traffic lights
+        destinations: Number of destinations
+        seed: Seed of the random number generator
+    Returns:
+        Dictionary with the size of the map and the number of streets, lights and destinations
+    Raises:
+        ValueError: If the map is too small, or its blocks don't have room for all the destinations
+    """
+    if width < 8 or height < 8:
+        raise ValueError("Maps must be at least 8x8 cells")
+    rng = np.random.default_rng(seed)
+    # Streets across the columns of the file go up and down, streets across its rows go left and right.
+    # Rows are numbered from the top of the file.
+    columns = street_starts(width, block_size, rng)
+    rows = street_starts(height, block_size, rng)
+    # The ring goes down on the left, right at the bottom, up on the right and left at the top.
+    column_directions = np.where(np.arange(len(columns)) % 2 == 0, DOWN, UP)
+    column_directions[-1] = UP
+    row_directions = np.where(np.arange(len(rows)) % 2 == 0, LEFT, RIGHT)
+    row_directions[-1] = RIGHT
+
+    # A row of the file between streets, and the two lanes of each horizontal direction. On the crossings the
+    # upper lane keeps the vertical street and the lower one the horizontal street, so the cars on both
+    # streets can go straight through or turn. The top of the ring has no street above, so it is the other way.
+    block_row = np.full(width, BUILDING, dtype=np.uint8)
+    for start, direction in zip(columns.tolist(), column_directions.tolist()):
+        block_row[start:start + 2] = direction
+    street_rows = {}
+    for direction in (LEFT, RIGHT):
+        street_row = np.full(width, direction, dtype=np.uint8)
+        street_rows[direction, 1] = street_row.copy()
+        street_row[block_row != BUILDING] = block_row[block_row != BUILDING]
+        street_rows[direction, 0] = street_row
+    # The streets going left end on the left of the ring, where the cars can only turn down.
+    street_rows[LEFT, 1][[0, 1]] = DOWN
+    row_kinds = np.full(height, -1, dtype=np.int64)
+    row_lanes = np.zeros(height, dtype=np.int64)
+    for start, direction in zip(rows.tolist(), row_directions.tolist()):
+        row_kinds[start:start + 2] = direction
+        row_lanes[start + 1] = 1
+    row_lanes[[0, 1]] = [1, 0]
+
+    features = [_lights(columns, rows, column_directions, row_directions, light_density, rng),
+                _destinations(columns, rows, destinations, rng)]
+    feature_rows = np.concatenate([rows for rows, _, _ in features])
+    order = np.argsort(feature_rows, kind="stable")
+    feature_rows = feature_rows[order]
+    feature_columns = np.concatenate([columns for _, columns, _ in features])[order]
+    feature_characters = np.concatenate([characters for _, _, characters in features])[order]
+
+    chunk_rows = max(1, CHUNK_CELLS // (width + 1))
+    with open(path, "wb") as mapFile:
+        for first in range(0, height, chunk_rows):
+            last = min(height, first + chunk_rows)
+            chunk = np.empty((last - first, width + 1), dtype=np.uint8)
+            chunk[:, -1] = ord("\n")
+            kinds = row_kinds[first:last]
+            lanes = row_lanes[first:last]
+            chunk[kinds == -1, :width] = block_row
+            for (direction, lane), street_row in street_rows.items():
+                chunk[(kinds == direction) & (lanes == lane), :width] = street_row
+            begin, end = np.searchsorted(feature_rows, [first, last])
+            chunk[feature_rows[begin:end] - first, feature_columns[begin:end]] = feature_characters[begin:end]
+            mapFile.write(chunk.tobytes())
+    return {
+        "width": width,
+        "height": height,
+        "vertical_streets": len(columns),
+        "horizontal_streets": len(rows),
+        "traffic_lights": int(np.isin(feature_characters, list(RED_LIGHTS.values()) + list(GREEN_LIGHTS.values())).sum()),
+        "destinations": int((feature_characters == ord("D")).sum())
+    }
+
+
+def _lights(columns, rows, column_directions, row_directions, light_density, rng):
+    """
+    Returns the rows, columns and characters of the lights of a random fraction of the inner crossings.
+    The lights go on the two lanes of each street, on the cells right before the crossing.
+    """
+    column_index, row_index = np.meshgrid(np.arange(1, len(columns) - 1), np.arange(1, len(rows) - 1), indexing="ij")
+    column_index = column_index.ravel()
+    row_index = row_index.ravel()
+    chosen = rng.random(len(column_index)) < light_density
+    column_index = column_index[chosen]
+    row_index = row_index[chosen]
+    x = columns[column_index]
+    y = rows[row_index]
+    vertical = column_directions[column_index]
+    horizontal = row_directions[row_index]
+
+    # Vertical lanes: above the crossing if going down, below it if going up. Start red.
+    vertical_row = np.where(vertical == DOWN, y - 1, y + 2)
+    vertical_characters = np.where(vertical == DOWN, RED_LIGHTS[DOWN], RED_LIGHTS[UP])
+    # Horizontal lanes: right of the crossing if going left, left of it if going right. Start green.
+    horizontal_column = np.where(horizontal == LEFT, x + 2, x - 1)
+    horizontal_characters = np.where(horizontal == LEFT, GREEN_LIGHTS[LEFT], GREEN_LIGHTS[RIGHT])
+    return (np.concatenate([vertical_row, vertical_row, y, y + 1]),
+            np.concatenate([x, x + 1, horizontal_column, horizontal_column]),
+            np.concatenate([vertical_characters, vertical_characters, horizontal_characters, horizontal_characters]).astype(np.uint8))
+
+
+def _destinations(columns, rows, count, rng):
+    """
+    Returns the rows, columns and characters of count destinations, on the border cells of random blocks.
+    Raises:
+        ValueError: If count different cells weren't found after count * 20 attempts, e.g. a small map with many destinations
+    """
+    # Blocks are between consecutive streets: from the end of one street to the start of the next.
+    block_columns = np.stack([columns[:-1] + 2, columns[1:]], axis=1)
+    block_rows = np.stack([rows[:-1] + 2, rows[1:]], axis=1)
+    cells = set()
+    found_rows, found_columns = [], []
+    attempts = 0
+    while len(cells) < count and attempts < count * 20:
+        attempts += 1
+        left, right = block_columns[rng.integers(len(block_columns))].tolist()
+        top, bottom = block_rows[rng.integers(len(block_rows))].tolist()
+        # A random cell on one of the four sides of the block.
+        side = int(rng.integers(4))
+        if side < 2:
+            row, column = (top if side == 0 else bottom - 1), int(rng.integers(left, right))
+        else:
+            row, column = int(rng.integers(top, bottom)), (left if side == 2 else right - 1)
+        if (row, column) not in cells:
+            cells.add((row, column))
+            found_rows.append(row)
+            found_columns.append(column)
+    if len(cells) < count:
+        raise ValueError(f"Only found room for {len(cells)} of the {count} destinations, use fewer destinations or a bigger map")
+    return (np.array(found_rows, dtype=np.int64), np.array(found_columns, dtype=np.int64),
+            np.full(len(found_rows), ord("D"), dtype=np.uint8))
+
+
+def unreachable_destinations(map_file, dictionary_file="city_files/mapDictionary.json"):
+    """
+    Returns the (x, y) of the destinations of a map that can't be reached from one of the corners where the cars appear.
+    """
+    compiled = compile_map(map_file, dictionary_file)
+    width, height = compiled["width"], compiled["height"]
+    destinations = np.flatnonzero(compiled["kinds"] == DESTINATION)
+    missing = np.zeros(len(destinations), dtype=bool)
+    for x, y in ((0, 0), (0, height - 1), (width - 1, 0), (width - 1, height - 1)):
+        missing |= bfs_distances(compiled["indptr"], compiled["indices"], x * height + y)[destinations] < 0
+    return [divmod(int(cell), height) for cell in destinations[missing]]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate a city map.")
+    parser.add_argument("output")
+    parser.add_argument("--width", type=int, default=200)
+    parser.add_argument("--height", type=int, default=200)
+    parser.add_argument("--block-size", type=int, default=10, help="Average side of the blocks")
+    parser.add_argument("--light-density", type=float, default=0.5, help="Fraction of the crossings with traffic lights")
+    parser.add_argument("--destinations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--check", action="store_true", help="Check that every destination can be reached from the corners")
+    args = parser.parse_args(args)
+
+    try:
+        summary = generate_map(args.output, args.width, args.height, args.block_size, args.light_density, args.destinations, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    print(", ".join(f"{name}: {value}" for name, value in summary.items()))
+    if args.check:
+        missing = unreachable_destinations(args.output)
+        if missing:
+            print(f"{len(missing)} destinations can't be reached: {missing[:10]}")
+            return 1
+        print("Every destination can be reached from the corners")
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
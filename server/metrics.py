@@ -0,0 +1,239 @@
+"""
+Instrumentation of the simulation steps, and the Prometheus text format used by the /metrics route.
+
+Every model keeps a StepMetrics. On each step the model marks the end of its phases (spawn, lights, moves)
+and the route searches add their time and expansions, so the time of a step is split between:
+    spawn: creating the new cars, without their routes
+    routing: routes of the new cars and searches of the blocked ones
+    lights: the traffic controller
+    moves: the cars, without their searches
+"""
+import cProfile
+import io
+import pstats
+import time
+from bisect import bisect_left
+
+PHASES = ("spawn", "routing", "lights", "moves")
+
+# Upper bounds of the buckets, in seconds for the steps and in expanded cells for the searches.
+STEP_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+EXPANSION_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    """
+    Counts of the observed values in buckets with fixed upper bounds, as Prometheus histograms.
+    Attributes:
+        buckets: Upper bounds of the buckets, increasing. Values over the last one go to a +Inf bucket
+        counts: Number of values in every bucket (not cumulative), the last one is +Inf
+        sum: Sum of the values
+        count: Number of values
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class StepMetrics:
+    """
+    Timings and counters of the steps of one model.
+    Attributes:
+        steps: Number of steps measured
+        phase_seconds: Seconds spent in every phase of PHASES, over all the steps
+        last_step: Seconds spent in every phase of PHASES in the last step
+        step_seconds: Histogram of the duration of the steps
+        expansions: Histogram of the cells expanded by each route search
+        active_cars: Cars in the simulation after the last step
+        blocked_cars: Cars that had somewhere to go but couldn't move in the last step
+        arrived_cars: Cars that reached their destination
+        spawned_cars: Cars created
+        reroutes: Routes changed to get around the traffic
+        pending_spawns: Cars of the demand waiting for their entry cell to be free (see demand)
+        dropped_spawns: Cars of the demand dropped because too many were waiting
+        profile_every: Every how many steps a step is run under cProfile, None to never profile
+        profile: cProfile.Profile of the last profiled step, None until one is profiled
+        profile_step: Number of the last profiled step
+    """
+    def __init__(self, profile_every=None):
+        self.steps = 0
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        self.last_step = dict.fromkeys(PHASES, 0.0)
+        self.step_seconds = Histogram(STEP_BUCKETS)
+        self.expansions = Histogram(EXPANSION_BUCKETS)
+        self.active_cars = 0
+        self.blocked_cars = 0
+        self.arrived_cars = 0
+        self.spawned_cars = 0
+        self.reroutes = 0
+        self.pending_spawns = 0
+        self.dropped_spawns = 0
+        self.profile_every = profile_every
+        self.profile = None
+        self.profile_step = None
+        self._profiler = None
+        self._mark = 0.0
+        self._routing = 0.0
+
+    def begin(self, step):
+        """
+        Starts measuring a step, under cProfile if it is one of every profile_every steps.
+        """
+        self.blocked_cars = 0
+        self.last_step = dict.fromkeys(PHASES, 0.0)
+        self._routing = 0.0
+        if self.profile_every and step % self.profile_every == 0:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self._profiler = profiler
+            except ValueError:
+                # Another profiler is running in this thread.
+                pass
+        self._mark = time.perf_counter()
+
+    def add_routing(self, seconds, expansions=None):
+        """
+        Adds the time of a route search made during the current phase.
+        Args:
+            seconds: Duration of the search
+            expansions: Cells expanded by the search, None if it didn't search (e.g. a cached route)
+        """
+        self._routing += seconds
+        if expansions is not None:
+            self.expansions.observe(expansions)
+
+    def lap(self, phase):
+        """
+        Ends a phase of the step. The searches made during the phase count as routing.
+        """
+        now = time.perf_counter()
+        self.last_step[phase] += now - self._mark - self._routing
+        self.last_step["routing"] += self._routing
+        self._routing = 0.0
+        self._mark = now
+
+    def end(self, active_cars, arrived_cars, spawned_cars, reroutes=0):
+        """
+        Ends the step and records its duration and the counters of the model after it.
+        """
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.profile = self._profiler
+            self.profile_step = self.steps + 1
+            self._profiler = None
+        self.steps += 1
+        for phase, seconds in self.last_step.items():
+            self.phase_seconds[phase] += seconds
+        self.step_seconds.observe(sum(self.last_step.values()))
+        self.active_cars = active_cars
+        self.arrived_cars = arrived_cars
+        self.spawned_cars = spawned_cars
+        self.reroutes = reroutes
+
+    def profile_report(self, sort="cumulative", limit=40):
+        """
+        Returns the last profiled step as the text of pstats, or None if no step has been profiled.
+        Args:
+            sort: pstats sort key
+            limit: Number of functions in the report
+        """
+        if self.profile is None:
+            return None
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return f"Step {self.profile_step}\n" + output.getvalue()
+
+    def copy(self):
+        """
+        Returns a copy that isn't changed by the next steps, for the snapshots of the runner.
+        """
+        metrics = StepMetrics.__new__(StepMetrics)
+        metrics.__dict__.update(self.__dict__)
+        metrics.phase_seconds = dict(self.phase_seconds)
+        metrics.last_step = dict(self.last_step)
+        metrics.step_seconds = self.step_seconds.copy()
+        metrics.expansions = self.expansions.copy()
+        metrics._profiler = None
+        return metrics
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = {name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusText:
+    """
+    Builds a page in the Prometheus text exposition format. The samples of every metric are kept
+    together under its HELP and TYPE lines, whatever the order they are added in.
+    """
+    def __init__(self):
+        self._families = {}
+
+    def _family(self, name, kind, help):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        return family
+
+    def sample(self, name, kind, help, value, labels=None):
+        self._family(name, kind, help).append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def histogram(self, name, help, histogram, labels=None):
+        family = self._family(name, "histogram", help)
+        labels = labels or {}
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            family.append(f"{name}_bucket{_labels(dict(labels, le=_number(bound)))} {cumulative}")
+        family.append(f"{name}_sum{_labels(labels)} {_number(histogram.sum)}")
+        family.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+    def render(self):
+        return "\n".join(line for family in self._families.values() for line in family) + "\n"
+
+
+def add_step_metrics(page, metrics, labels):
+    """
+    Adds the metrics of one model to a PrometheusText page.
+    """
+    page.sample("city_steps_total", "counter", "Steps of the simulation.", metrics.steps, labels)
+    page.histogram("city_step_seconds", "Duration of the steps.", metrics.step_seconds, labels)
+    for phase in PHASES:
+        page.sample("city_step_phase_seconds_total", "counter", "Time spent in every phase of the steps.",
+                    metrics.phase_seconds[phase], dict(labels, phase=phase))
+    for phase in PHASES:
+        page.sample("city_last_step_phase_seconds", "gauge", "Time spent in every phase of the last step.",
+                    metrics.last_step[phase], dict(labels, phase=phase))
+    page.histogram("city_route_search_expansions", "Cells expanded by each route search.", metrics.expansions, labels)
+    page.sample("city_active_cars", "gauge", "Cars in the simulation.", metrics.active_cars, labels)
+    page.sample("city_blocked_cars", "gauge", "Cars that couldn't move in the last step.", metrics.blocked_cars, labels)
+    page.sample("city_arrived_cars_total", "counter", "Cars that reached their destination.", metrics.arrived_cars, labels)
+    page.sample("city_spawned_cars_total", "counter", "Cars created.", metrics.spawned_cars, labels)
+    page.sample("city_reroutes_total", "counter", "Routes changed to get around the traffic.", metrics.reroutes, labels)
+    page.sample("city_pending_spawns", "gauge", "Cars waiting for their entry cell to be free.", metrics.pending_spawns, labels)
+    page.sample("city_dropped_spawns_total", "counter", "Cars dropped because too many were waiting to enter.", metrics.dropped_spawns, labels)
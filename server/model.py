@@ -1,17 +1,48 @@
 from mesa import Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
+from array import array
+import time
+import numpy as np
 from agent import *
-import json
+from city_map import load_city_map
+from demand import DemandProfile, SpawnQueue
+from map_compiler import ROAD, TRAFFIC_LIGHT, BUILDING, DESTINATION
+from rerouting import CongestionRouter
+from router import create_router
+from traffic_control import TrafficController, FIXED
+from metrics import StepMetrics
 
-def print_dict(dictionary):
-    print("{")
-    for key in dictionary:
-        print("    ", key, " : {")
-        for key2 in dictionary[key]:
-            print("        ", key2, " : ", dictionary[key][key2])
-    print("    }")
-    print("}")
+
+class CityGrid(MultiGrid):
+    """
+    MultiGrid that keeps an index of what the cars need to know about each cell, so they don't scan the cells.
+    The index is updated by place_agent and remove_agent (move_agent goes through both), and by the model when the lights change.
+    Attributes:
+        cars: Number of cars in each cell, indexed by cell id (x * height + y)
+        light_states: State of the traffic light of each cell, None if the cell has no light
+    """
+    def __init__(self, width, height, torus):
+        super().__init__(width, height, torus)
+        self.cars = array("i", bytes(4 * width * height))
+        self.light_states = [None] * (width * height)
+
+    def cell_id(self, pos):
+        """
+        Returns the id of the cell in pos.
+        """
+        return pos[0] * self.height + pos[1]
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        if isinstance(agent, Car):
+            self.cars[pos[0] * self.height + pos[1]] += 1
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        super().remove_agent(agent)
+        if isinstance(agent, Car):
+            self.cars[pos[0] * self.height + pos[1]] -= 1
 
 
 class CityModel(Model):
@@ -19,59 +50,113 @@ class CityModel(Model):
         Creates a model based on a city map.
 
         Args:
-            N: Number of agents in the simulation
+            map_file: Path of the map file to load
+            spawn_interval: Every how many steps new cars appear in the corners
+            light_timings: Green time of the lights that start red and of the lights that start green, the timings of the map if None
+            light_control: How the lights are coordinated, "fixed", "green_wave" or "adaptive" (see traffic_control)
+            seed: Seed of the random number generator (used by Mesa's Model.__new__)
+            rerouting: Whether blocked cars look for a way around the traffic
+            reroute_patience: Steps a car waits blocked before it looks for another way
+            reroute_horizon: How many cells around a car the traffic is taken into account
+            max_reroutes: Maximum number of route searches per step
+            profile_every: Every how many steps a step is run under cProfile (see metrics), None to never profile
+            router: How the new cars find their routes, "tree", "astar", "bidirectional" or "alt" (see router)
+            demand: Dictionary of a demand.DemandProfile. Cars then arrive at its rates and wait for their entry cell
+                to be free, instead of appearing in every corner every spawn_interval steps
+            max_pending: Cars each origin of the demand keeps waiting, None for no limit
+
+        The seed the model runs with (a random one if seed is None) is kept in settings, so every run can be repeated.
     """
-    def __init__(self):
+    def __init__(self, map_file="city_files/2022_base.txt", spawn_interval=10, light_timings=None, seed=None,
+                 light_control=FIXED, rerouting=False, reroute_patience=2, reroute_horizon=5, max_reroutes=16,
+                 profile_every=None, router="tree", demand=None, max_pending=100):
 
-        # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
-        dataDictionary = json.load(open("city_files/mapDictionary.json"))
+        # Load the map file. The map file is a text file where each character represents an agent.
+        # Parsed maps are cached, so models of the same map share them.
+        city_map = load_city_map(map_file)
+        # Arguments to create the same model again, e.g. to restore a checkpoint (see checkpoint).
+        self.settings = {"map_file": map_file, "spawn_interval": spawn_interval, "light_timings": light_timings,
+                         "seed": self._seed, "light_control": light_control, "rerouting": rerouting,
+                         "reroute_patience": reroute_patience, "reroute_horizon": reroute_horizon,
+                         "max_reroutes": max_reroutes, "router": router, "demand": demand, "max_pending": max_pending}
 
         self.trafficLights = []
         self.destinations = []
         self.cars_count = 0
         self.step_count = 0
+        # Cars that reached their destination.
         self.arrived_cars = 0
-        self.all_paths = {}
+        self.total_travel_time = 0
+        self.spawn_interval = spawn_interval
+        # Timings of the phases of the steps and counters of the cars, for the /metrics route.
+        self.metrics = StepMetrics(profile_every)
+        # checkpoint.EventLog the steps are written to, if any.
+        self.event_log = None
 
-        # Load the map file. The map file is a text file where each character represents an agent.
-        with open('city_files/2022_base.txt') as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0])-1
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height, torus = False) 
-            self.schedule = RandomActivation(self)
-
-            # Goes through each character in the map file and creates the corresponding agent.
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
-                    if col in ["v", "^", ">", "<"]:
-                        agent = Road(f"r_{r*self.width+c}", self, dataDictionary[col])
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col in ["R", "L", "U", "A", "r", "l", "u", "a"]:
-                        agent = None
-                        if col in ["R", "L", "U", "A"]:
-                            agent = TrafficLight(f"tl_{r*self.width+c}", self, False, 17, dataDictionary[col])
-                        elif col in ["r", "l", "u", "a"]:
-                            agent = TrafficLight(f"tl_{r*self.width+c}", self, True, 5, dataDictionary[col])
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-                        self.trafficLights.append(agent)
-
-                    elif col == "#":
-                        agent = Building(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col == "D":
-                        agent = Destination(f"d_{r*self.width+c}", self)
-                        self.destinations.append(agent)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-        self.corners = [(0, 0), (0, self.height-1), (self.width-1, 0), (self.width-1, self.height-1)]
-        self.generate_new_cars()
+        self.width = city_map.width
+        self.height = city_map.height
+
+        self.grid = CityGrid(self.width, self.height, torus = False)
+        self.schedule = RandomActivation(self)
+
+        # Only the cars are agents. Roads, buildings, destinations and lights stay in the arrays of the map,
+        # so the grid and the schedule grow with the cars and not with the size of the city.
+        # The controller groups the lights by intersection and sets all of them on every step.
+        self.light_timings = tuple(light_timings or city_map.light_timings)
+        self.traffic_control = TrafficController(city_map, light_control, self.light_timings)
+        self.occupancy = np.frombuffer(self.grid.cars, dtype=np.intc)
+        for (unique_id, pos, starts_green, _, direction), state in zip(city_map.traffic_lights, self.traffic_control.states.tolist()):
+            # Lights that start red (upper case in the map) use the first timing, the ones that start green the second.
+            timeToChange = self.light_timings[1] if starts_green else self.light_timings[0]
+            self.trafficLights.append(TrafficLight(unique_id, pos, state, timeToChange, direction))
+            self.grid.light_states[self.grid.cell_id(pos)] = state
+        self.light_by_cell = {self.grid.cell_id(light.pos): light for light in self.trafficLights}
+
+        self.destinations = [Destination(unique_id, pos) for unique_id, pos in city_map.destinations]
+
+        self.city_map = city_map
+        self.road_graph = city_map.road_graph
+        # Routes are cached as one shortest path tree per destination, so spawning a car is just a walk down its tree.
+        # The cache belongs to the map, so every model of the same map reuses the trees.
+        self.all_paths = city_map.routes
+        # What the new cars use to find their routes, the cached trees by default.
+        self.router = create_router(router, city_map)
+        # Blocked cars repair their routes with the traffic of this model, on top of the cached trees.
+        self.rerouter = CongestionRouter(self.road_graph, self.grid, self.all_paths, reroute_horizon) if rerouting else None
+        self.reroute_patience = reroute_patience
+        self.max_reroutes = max_reroutes
+        self.reroute_budget = max_reroutes
+        self.reroutes = 0
+
+        self.corners = city_map.corners
+        self.demand = None
+        self.spawn_queue = None
+        if demand is not None:
+            self.demand = DemandProfile(demand, self.road_graph, self.corners, len(self.destinations))
+            self.spawn_queue = SpawnQueue([self.grid.cell_id(origin) for origin in self.demand.origins], max_pending)
+        else:
+            self.generate_new_cars()
         self.running = True
 
+    def static_cell(self, pos):
+        """
+        Returns the Road, TrafficLight, Building or Destination in pos, or None.
+        """
+        city_map = self.city_map
+        cell = city_map.road_graph.cell_id(pos)
+        kind = city_map.kinds[cell]
+        # Same ids the agents had when they were created from the map file.
+        number = (self.height - pos[1] - 1) * self.width + pos[0]
+        if kind == ROAD:
+            return Road(f"r_{number}", pos, self.road_graph.direction_names[cell])
+        elif kind == TRAFFIC_LIGHT:
+            return self.light_by_cell[cell]
+        elif kind == BUILDING:
+            return Building(f"ob_{number}", pos)
+        elif kind == DESTINATION:
+            return Destination(f"d_{number}", pos)
+        return None
+
     def generate_new_cars(self):
         """
             Generates new cars in all the corners in the simulation.
@@ -80,20 +165,119 @@ class CityModel(Model):
             Returns:
                 None
         """
-        for corner in self.corners:
-            random_destination = self.random.choice(self.destinations)
-            # print("Destination: ", random_destination.pos)
-            car = Car(f"c_{self.cars_count}", self, corner, random_destination)
+        self.insert_cars([(corner, self.random.choice(self.destinations)) for corner in self.corners])
+
+    def spawn_demand(self):
+        """
+            Adds the cars that arrive in this step to the spawn queue and lets in the ones whose entry cell is free.
+        """
+        queue = self.spawn_queue
+        queue.add(self.demand.arrivals(self.step_count, self.random), self.step_count)
+        origins = self.demand.origins
+        self.insert_cars([(origins[origin], self.destinations[destination])
+                          for origin, destination in queue.release(self.grid.cars, self.step_count)])
+        self.metrics.pending_spawns = len(queue)
+        self.metrics.dropped_spawns = queue.dropped
+
+    def insert_cars(self, spawns):
+        """
+            Creates the cars of a step. They are routed together, the cars that go to the same destination
+            share one search (see router), and are added in the order of spawns.
+            Args:
+                spawns: List of (position, Destination) of the new cars
+        """
+        origins = {}
+        for pos, destination in spawns:
+            origins.setdefault(destination.pos, []).append(pos)
+        paths = {}
+        for goal, starts in origins.items():
+            start = time.perf_counter()
+            routes, expansions = self.router.route_batch(starts, goal)
+            self.metrics.add_routing(time.perf_counter() - start, expansions)
+            paths[goal] = iter(routes)
+        for pos, destination in spawns:
+            car = Car(f"c_{self.cars_count}", self, pos, destination, next(paths[destination.pos]))
             self.cars_count += 1
-            self.grid.place_agent(car, corner)
-            # print("Car: ", car.unique_id, " Place: ", corner, " Destination: ", random_destination.unique_id)
+            self.grid.place_agent(car, pos)
             self.schedule.add(car)
+            if self.event_log is not None:
+                self.event_log.spawn(car)
 
     def step(self):
         '''Advance the model by one step.'''
         self.step_count += 1
-        # print("*************** All paths ***************")
-        # print_dict(self.all_paths)
-        if self.step_count % 10 == 0:
+        self.reroute_budget = self.max_reroutes
+        metrics = self.metrics
+        metrics.begin(self.step_count)
+        if self.demand is not None:
+            self.spawn_demand()
+        elif self.step_count % self.spawn_interval == 0:
             self.generate_new_cars()
-        self.schedule.step()
\ No newline at end of file
+        metrics.lap("spawn")
+        self.step_traffic_lights()
+        metrics.lap("lights")
+        if self.rerouter is not None:
+            self.rerouter.refresh()
+        self.schedule.step()
+        metrics.lap("moves")
+        metrics.end(self.schedule.get_agent_count(), self.arrived_cars, self.cars_count, self.reroutes)
+        if self.event_log is not None:
+            self.event_log.end_step(self)
+
+    def step_traffic_lights(self):
+        """
+        Lets the controller advance the lights and copies the ones that changed to the grid.
+        """
+        states = self.traffic_control.states
+        changed = self.traffic_control.step(self.occupancy).tolist()
+        for index in changed:
+            light = self.trafficLights[index]
+            light.state = bool(states[index])
+            self.grid.light_states[self.grid.cell_id(light.pos)] = light.state
+        if self.event_log is not None and changed:
+            self.event_log.light_changes(changed, states[changed].tolist())
+
+    def get_cars(self):
+        """
+        Returns the cars as the list of dictionaries sent to the visualization.
+        """
+        return [{
+            "id": str(agent.unique_id),
+            "x": agent.pos[0],
+            "y": 0,
+            "dir": agent.direction,
+            "z": agent.pos[1]
+        } for agent in self.schedule.agents if isinstance(agent, Car)]
+
+    def get_traffic_lights(self):
+        """
+        Returns the traffic lights as the list of dictionaries sent to the visualization.
+        """
+        return [{
+            "id": str(agent.unique_id),
+            "x": agent.pos[0],
+            "y": 1,
+            "z": agent.pos[1],
+            "state": agent.state
+        } for agent in self.trafficLights]
+
+
+def create_model(engine="mesa", **kwargs):
+    """
+    Creates the simulation with the chosen engine.
+    Args:
+        engine: "mesa" for CityModel, "vectorized" for the numpy engine, "tiled" for the numpy engine split
+            into tiles moved by worker processes
+        kwargs: Arguments for the model
+    Returns:
+        The new model
+    """
+    if engine == "mesa":
+        return CityModel(**kwargs)
+    elif engine == "vectorized":
+        from vectorized import VectorizedCityModel
+        return VectorizedCityModel(**kwargs)
+    elif engine == "tiled":
+        from tiled import TiledCityModel
+        return TiledCityModel(**kwargs)
+    raise ValueError(f"Unknown engine: {engine}")
@@ -0,0 +1,156 @@
+import heapq
+import numpy as np
+
+
+class CongestionRouter:
+    """
+    Repairs the routes of blocked cars with the traffic they can see.
+    Entering a cell costs 1, plus car_penalty if there is a car in it and red_light_penalty if its light is red,
+    but only within horizon cells of the car: further away the traffic will have changed by the time it gets there.
+    The search is an A* that uses the distances of the cached shortest path tree of the destination as heuristic.
+    Outside the horizon every move costs 1, so those distances are exact there and the search stops as soon as
+    it leaves the horizon: the rest of the route is the cached one. Only the part of the path inside the jam
+    is searched again.
+    In a jam detours only fill the gaps the traffic needs to move, so cars in cells where the traffic is saturated
+    don't look for one (see refresh), and a detour is never more than max_detour cells longer than the route.
+    Attributes:
+        graph: The RoadGraph of the model
+        grid: The CityGrid of the model, with the cars and the lights of every cell
+        routes: RouteCache with the shortest path trees of the destinations
+        saturation: Fraction of the road cells within the horizon with cars above which the traffic is saturated
+        max_detour: How many more cells than its route a new path can have
+        saturated: Whether the traffic around every cell was saturated at the start of the step, by cell id
+        expansions: Number of cells expanded by all the searches
+    """
+    def __init__(self, graph, grid, routes, horizon=5, car_penalty=4, red_light_penalty=2, saturation=0.25, max_detour=2):
+        self.graph = graph
+        self.grid = grid
+        self.routes = routes
+        self.horizon = horizon
+        self.car_penalty = car_penalty
+        self.red_light_penalty = red_light_penalty
+        self.saturation = saturation
+        self.max_detour = max_detour
+        self.expansions = 0
+        self.occupancy = np.frombuffer(grid.cars, dtype=np.intc).reshape(graph.width, graph.height)
+        # Corners of the square of the horizon around every cell, clipped to the map, to count with prefix sums.
+        xs, ys = np.arange(graph.width), np.arange(graph.height)
+        self._lefts, self._rights = np.maximum(xs - horizon, 0), np.minimum(xs + horizon + 1, graph.width)
+        self._bottoms, self._tops = np.maximum(ys - horizon, 0), np.minimum(ys + horizon + 1, graph.height)
+        self._road_counts = self._window_sums((np.diff(graph.indptr) > 0).reshape(graph.width, graph.height))
+        self.saturated = np.zeros(graph.width * graph.height, dtype=bool)
+
+    def _window_sums(self, values):
+        """
+        Returns the sum of values over the square of the horizon around every cell, as a flat array by cell id.
+        """
+        sums = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.int64)
+        sums[1:, 1:] = values.cumsum(0).cumsum(1)
+        lefts, rights = self._lefts[:, None], self._rights[:, None]
+        bottoms, tops = self._bottoms[None, :], self._tops[None, :]
+        return (sums[rights, tops] - sums[lefts, tops] - sums[rights, bottoms] + sums[lefts, bottoms]).ravel()
+
+    def refresh(self):
+        """
+        Marks the cells where the cars fill more than saturation of the road cells within the horizon,
+        with the cars at the start of the step.
+        """
+        np.greater(self._window_sums(self.occupancy), self.saturation * self._road_counts, out=self.saturated)
+
+    def cost(self, cell):
+        """
+        Returns the cost of entering a cell inside the horizon.
+        """
+        cost = 1
+        if self.grid.cars[cell]:
+            cost += self.car_penalty
+        if self.grid.light_states[cell] == False:
+            cost += self.red_light_penalty
+        return cost
+
+    def is_free(self, cell):
+        """
+        Returns whether a car could enter a cell now: it is empty and its light, if it has one, isn't red.
+        """
+        return not self.grid.cars[cell] and self.grid.light_states[cell] != False
+
+    def has_way_out(self, origin, blocked, destination):
+        """
+        Returns whether a car in origin can enter a free cell other than blocked that still leads to destination.
+        When there is none, the traffic around the car is saturated and a search can't find a better path.
+        """
+        graph = self.graph
+        distance = self.routes.tree(destination).distance
+        goal = graph.cell_id(destination)
+        blocked = graph.cell_id(blocked)
+        destination_cells = graph.destination_cells
+        for next in graph.adjacency[graph.cell_id(origin)]:
+            if next == blocked or distance[next] == -1 or (next in destination_cells and next != goal):
+                continue
+            if self.is_free(next):
+                return True
+        return False
+
+    def route(self, origin, destination):
+        """
+        Returns the positions of the cheapest path from origin to destination with the traffic around origin.
+        Args:
+            origin: Start position
+            destination: Position of the destination
+        Returns:
+            A new list of positions without the origin, empty if the destination can't be reached
+        """
+        graph = self.graph
+        positions = graph.positions
+        adjacency = graph.adjacency
+        destination_cells = graph.destination_cells
+        tree = self.routes.tree(destination)
+        distance = tree.distance
+        next_hop = tree.next_hop
+        goal = tree.goal
+        start = graph.cell_id(origin)
+        if distance[start] == -1:
+            return []
+        origin_x, origin_y = origin
+        horizon = self.horizon
+
+        def inside(cell):
+            x, y = positions[cell]
+            return abs(x - origin_x) <= horizon and abs(y - origin_y) <= horizon
+
+        # Ties go to the cell that is further along, so the search dives towards the goal.
+        frontier = [(int(distance[start]), 0, start)]
+        cost_so_far = {start: 0}
+        came_from = {start: None}
+        while frontier:
+            priority, _, current = heapq.heappop(frontier)
+            cost = cost_so_far[current]
+            if priority > cost + distance[current]:
+                # Outdated entry, the cell was reached again with a lower cost.
+                continue
+            self.expansions += 1
+            if current == goal or not inside(current):
+                # The cached route is only the cheapest one if it doesn't go back into the horizon.
+                # It is walked one cell at a time, so a route that does is dropped at its first cell inside.
+                cell = current
+                while cell != goal:
+                    cell = int(next_hop[cell])
+                    if inside(cell):
+                        break
+                else:
+                    rest = tree.cells(current)
+                    path = []
+                    while current != start:
+                        path.append(current)
+                        current = came_from[current]
+                    path.reverse()
+                    return [positions[cell] for cell in path + rest]
+            for next in adjacency[current]:
+                if next in destination_cells and next != goal or distance[next] == -1:
+                    continue
+                new_cost = cost + (self.cost(next) if inside(next) else 1)
+                if next not in cost_so_far or new_cost < cost_so_far[next]:
+                    cost_so_far[next] = new_cost
+                    came_from[next] = current
+                    heapq.heappush(frontier, (new_cost + int(distance[next]), -new_cost, next))
+        return []
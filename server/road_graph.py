@@ -0,0 +1,160 @@
+from functools import cached_property
+import numpy as np
+
+# Direction codes used by the compiled graph. Index 0 means "no direction"
+# (buildings, destinations and empty cells).
+DIRECTIONS = (None, "Up", "Down", "Left", "Right")
+NONE, UP, DOWN, LEFT, RIGHT = range(len(DIRECTIONS))
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTIONS) if name}
+
+
+def is_transitable(current_direction, dx, dy, direction):
+    """
+    Checks if a car on a road cell can move to a neighbouring road cell.
+    These are the same Up/Down/Left/Right rules the cars used to evaluate on every A* expansion.
+    Works on single direction codes and on numpy arrays of them.
+    Args:
+        current_direction: Direction code of the current cell
+        dx, dy: Offset from the current cell to the neighbouring cell
+        direction: Direction code of the neighbouring cell
+    Returns:
+        True (or a boolean array) where the move follows the road direction rules
+    """
+    left = (direction == LEFT) & (dx <= 0)
+    right = (direction == RIGHT) & (dx >= 0)
+    up = (direction == UP) & (dy >= 0)
+    down = (direction == DOWN) & (dy <= 0)
+    return (((current_direction == UP) & (dy >= 0) & (left | right | up)) |
+            ((current_direction == DOWN) & (dy < 0) & (left | right | down)) |
+            ((current_direction == RIGHT) & (dx >= 0) & (up | down | right)) |
+            ((current_direction == LEFT) & (dx < 0) & (up | down | left)))
+
+
+def compile_edges(width, height, directions, is_destination):
+    """
+    Builds the CSR arrays of the road graph.
+    Args:
+        width, height: Size of the map
+        directions: Direction code of every cell
+        is_destination: Whether every cell is a destination
+    Returns:
+        indptr, indices
+    """
+    size = width * height
+    x, y = np.divmod(np.arange(size), height)
+    # Neighbours are visited in the same order as MultiGrid.get_neighborhood (x major, then y),
+    # so searches over the graph expand cells exactly like the old grid scans did.
+    offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+    valid = np.zeros((size, len(offsets)), dtype=bool)
+    for column, (dx, dy) in enumerate(offsets):
+        inside = (x + dx >= 0) & (x + dx < width) & (y + dy >= 0) & (y + dy < height)
+        neighbors = np.where(inside, np.arange(size) + dx * height + dy, 0)
+        valid[:, column] = inside & (directions != NONE) & (
+            is_destination[neighbors] | is_transitable(directions, dx, dy, directions[neighbors]))
+
+    sources, columns = np.nonzero(valid)
+    deltas = np.array([dx * height + dy for dx, dy in offsets])
+    indices = (sources + deltas[columns]).astype(np.int32)
+    indptr = np.zeros(size + 1, dtype=np.int32)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    return indptr, indices
+
+
+def reverse_edges(indptr, indices):
+    """
+    Builds the CSR arrays of the reversed graph, used to grow shortest path trees backwards from a destination.
+    Returns:
+        reverse_indptr, reverse_indices
+    """
+    size = len(indptr) - 1
+    sources = np.repeat(np.arange(size, dtype=np.int32), np.diff(indptr))
+    order = np.argsort(indices, kind="stable")
+    reverse_indptr = np.zeros(size + 1, dtype=np.int32)
+    np.cumsum(np.bincount(indices, minlength=size), out=reverse_indptr[1:])
+    return reverse_indptr, sources[order]
+
+
+class RoadGraph:
+    """
+    Immutable directed graph of the transitable cells of a city map, stored in CSR form.
+    Cells are identified by x * height + y, so sorting cell ids sorts positions the same way tuples do.
+    The tuples used by the pure python search loops are only built the first time they are needed.
+    Attributes:
+        width, height: Size of the map
+        directions: Direction code of every cell (uint8)
+        direction_names: Direction name of every cell, None if it isn't a road or a traffic light
+        is_destination: Whether every cell is a destination (bool)
+        destination_cells: Set with the cell ids of the destinations
+        indptr, indices: CSR arrays, the successors of cell i are indices[indptr[i]:indptr[i+1]]
+        positions: (x, y) tuple of every cell id
+        adjacency: Tuple with the successors of every cell
+        reverse_indptr, reverse_indices: CSR arrays of the reversed graph (predecessors)
+        predecessors: Tuple with the predecessors of every cell
+    """
+    def __init__(self, width, height, directions, is_destination, edges=None):
+        """
+        Compiles the graph.
+        Args:
+            width, height: Size of the map
+            directions: Direction code of every cell
+            is_destination: Whether every cell is a destination
+            edges: Already compiled (indptr, indices, reverse_indptr, reverse_indices), e.g. from a compiled map
+        """
+        self.width = width
+        self.height = height
+        self.directions = np.asarray(directions, dtype=np.uint8)
+        self.is_destination = np.asarray(is_destination, dtype=bool)
+        self.destination_cells = frozenset(np.flatnonzero(self.is_destination).tolist())
+
+        if edges is None:
+            indptr, indices = compile_edges(width, height, self.directions, self.is_destination)
+            edges = (indptr, indices) + reverse_edges(indptr, indices)
+        self.indptr, self.indices, self.reverse_indptr, self.reverse_indices = edges
+
+        for array in (self.directions, self.is_destination, self.indptr, self.indices, self.reverse_indptr, self.reverse_indices):
+            if array.flags.writeable:
+                array.setflags(write=False)
+
+    @cached_property
+    def direction_names(self):
+        return tuple(DIRECTIONS[code] for code in self.directions.tolist())
+
+    @cached_property
+    def positions(self):
+        return tuple((x, y) for x in range(self.width) for y in range(self.height))
+
+    @cached_property
+    def adjacency(self):
+        return self._tuples(self.indptr, self.indices)
+
+    @cached_property
+    def predecessors(self):
+        return self._tuples(self.reverse_indptr, self.reverse_indices)
+
+    @staticmethod
+    def _tuples(indptr, indices):
+        indptr = indptr.tolist()
+        indices = indices.tolist()
+        return tuple(tuple(indices[indptr[cell]:indptr[cell + 1]]) for cell in range(len(indptr) - 1))
+
+    def cell_id(self, pos):
+        """
+        Returns the id of the cell in pos.
+        """
+        return pos[0] * self.height + pos[1]
+
+    def direction(self, pos):
+        """
+        Returns the direction name of the road or traffic light in pos, or None.
+        """
+        return DIRECTIONS[self.directions[self.cell_id(pos)]]
+
+    def neighbors(self, cell, goal):
+        """
+        Returns the successors of a cell. Destinations are only transitable if they are the goal.
+        Args:
+            cell: Cell id
+            goal: Cell id of the destination of the search
+        """
+        destination_cells = self.destination_cells
+        return [neighbor for neighbor in self.adjacency[cell] if neighbor == goal or neighbor not in destination_cells]
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import threading
+from router import bfs_tree
+
+
+class RouteTree:
+    """
+    Shortest path tree towards one destination, grown backwards over the road graph.
+    Attributes:
+        goal: Cell id of the destination
+        next_hop: Next cell on the way to the goal for every cell, -1 if the goal can't be reached
+        distance: Number of moves to the goal for every cell, -1 if the goal can't be reached
+    """
+    def __init__(self, graph, goal):
+        """
+        Runs a breadth first search from the goal following the edges backwards (see router.bfs_tree).
+        Every move costs the same, so this gives the shortest path from every cell.
+        Args:
+            graph: The RoadGraph of the model
+            goal: Cell id of the destination
+        """
+        self.goal = goal
+        self.distance, self.next_hop = bfs_tree(graph.reverse_indptr, graph.reverse_indices, goal)
+        self.next_hop.setflags(write=False)
+        self.distance.setflags(write=False)
+
+    def cells(self, origin):
+        """
+        Returns the cell ids from origin (excluded) to the goal, or an empty list if there is no path.
+        """
+        next_hop = self.next_hop
+        path = []
+        current = origin
+        if next_hop[current] == -1:
+            return path
+        while current != self.goal:
+            current = int(next_hop[current])
+            path.append(current)
+        return path
+
+    @property
+    def nbytes(self):
+        return self.next_hop.nbytes + self.distance.nbytes
+
+
+class RouteCache(OrderedDict):
+    """
+    Routes of the cars, stored as one shortest path tree per destination position.
+    The least recently used trees are dropped once there are more than maxsize of them.
+    The cache can be shared by models stepped on different threads.
+    Attributes:
+        graph: The RoadGraph the routes are computed on
+        maxsize: Maximum number of trees kept in memory, None for no limit
+        hits, misses: Number of lookups that found / had to build their tree
+        evictions: Number of trees dropped because of the size limit
+    """
+    def __init__(self, graph, maxsize=128):
+        super().__init__()
+        self.graph = graph
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def tree(self, destination):
+        """
+        Returns the tree that leads to a destination position, building it if needed.
+        """
+        with self._lock:
+            tree = self.get(destination)
+            if tree is not None:
+                self.hits += 1
+                self.move_to_end(destination)
+                return tree
+
+            self.misses += 1
+            tree = RouteTree(self.graph, self.graph.cell_id(destination))
+            self[destination] = tree
+            if self.maxsize is not None:
+                while len(self) > self.maxsize:
+                    self.popitem(last=False)
+                    self.evictions += 1
+            return tree
+
+    def warm(self, destinations):
+        """
+        Builds the trees of several destinations ahead of time, e.g. at startup.
+        """
+        with self._lock:
+            for destination in destinations:
+                if destination not in self:
+                    self.tree(destination)
+
+    def route(self, origin, destination):
+        """
+        Returns the positions a car has to visit to go from origin to destination.
+        Args:
+            origin: Start position
+            destination: Position of the destination
+        Returns:
+            A new list of positions without the origin, empty if the destination can't be reached
+        """
+        positions = self.graph.positions
+        return [positions[cell] for cell in self.tree(destination).cells(self.graph.cell_id(origin))]
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        with self._lock:
+            return {
+                "size": len(self),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": sum(tree.nbytes for tree in self.values())
+            }
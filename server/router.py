@@ -0,0 +1,375 @@
+"""
+Route searches of the cars, all on the compiled road graph and all returning shortest paths (every move costs 1).
+
+    tree: Looks the route up in the shortest path tree of the destination (see route_cache). A tree costs a search
+          of the whole map the first time a destination is used, and nothing afterwards
+    astar: A* with the Chebyshev distance, the exact cost of a path on an empty grid where cars can move diagonally
+    bidirectional: Breadth first searches from both ends that stop when they meet
+    alt: A* with landmarks: the distances to and from a few cells are computed once per map, and the triangle
+         inequality turns them into a much tighter lower bound than the Chebyshev distance
+
+Every router returns the number of cells it expanded, so the strategies can be compared (see benchmark.py).
+Ties are always broken the same way, so a search gives the same path every time.
+
+The cars that appear in the same step are routed together with route_batch: all the cars going to one destination
+share a single search tree, grown backwards from the destination until it reaches all of them.
+"""
+import heapq
+import numpy as np
+
+ROUTERS = ("tree", "astar", "bidirectional", "alt")
+# Distance of the cells a BFS can't reach, high enough to never be a useful bound and low enough to not overflow.
+UNREACHABLE = 2 ** 29
+
+
+def bfs_distances(indptr, indices, source):
+    """
+    Returns the number of moves from a cell to every cell of a graph, -1 where it can't be reached.
+    Args:
+        indptr, indices: CSR arrays of the graph, or of the reversed graph for the distances to the cell
+        source: Cell id where the search starts
+    """
+    return bfs_tree(indptr, indices, source)[0]
+
+
+def bfs_tree(indptr, indices, source):
+    """
+    Breadth first search over the CSR arrays of a graph, one whole level at a time so it runs in numpy even on
+    big maps. Each level keeps the order of a queue: cells are reached in the order of the frontier, and the
+    successors of a cell in the order of indices. So the parents are the ones a search with a deque would give.
+    Args:
+        indptr, indices: CSR arrays of the graph, or of the reversed graph to search towards the cell
+        source: Cell id where the search starts
+    Returns:
+        (distances, parents): moves from source and the cell each one was reached from, -1 where it can't be reached
+    """
+    distances = np.full(len(indptr) - 1, -1, dtype=np.int32)
+    parents = np.full(len(indptr) - 1, -1, dtype=np.int32)
+    distances[source] = 0
+    frontier = np.array([source], dtype=np.int64)
+    level = 0
+    while len(frontier):
+        level += 1
+        begins = indptr[frontier].astype(np.int64)
+        counts = indptr[frontier + 1] - begins
+        # Positions in indices of the successors of every cell of the frontier.
+        positions = np.repeat(begins - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        successors = indices[positions]
+        new = distances[successors] == -1
+        successors = successors[new]
+        sources = np.repeat(frontier, counts)[new]
+        # The first time each cell appears is the one a queue would have taken.
+        _, first = np.unique(successors, return_index=True)
+        first.sort()
+        frontier = successors[first].astype(np.int64)
+        distances[frontier] = level
+        parents[frontier] = sources[first]
+    return distances, parents
+
+
+def chebyshev(positions, cell, goal):
+    """
+    Returns the Chebyshev distance between two cells: no path between them can be shorter.
+    """
+    x1, y1 = positions[cell]
+    x2, y2 = positions[goal]
+    return max(abs(x1 - x2), abs(y1 - y2))
+
+
+class TreeRouter:
+    """
+    Router that walks the cached shortest path trees of the destinations.
+    Attributes:
+        routes: RouteCache of the map
+    """
+    def __init__(self, routes):
+        self.routes = routes
+
+    def route(self, origin, destination):
+        """
+        Returns the positions from origin to destination.
+        Returns:
+            (positions, expansions): positions without the origin (empty if the destination can't be reached),
+            expansions is None if the tree was cached, otherwise the cells reached while building it
+        """
+        cached = destination in self.routes
+        path = self.routes.route(origin, destination)
+        if cached:
+            return path, None
+        return path, int(np.count_nonzero(self.routes.tree(destination).distance >= 0))
+
+    def route_batch(self, origins, destination):
+        """
+        Returns the positions from several origins to one destination, all walked down the same tree.
+        Returns:
+            (paths, expansions): one list of positions per origin, expansions as in route
+        """
+        cached = destination in self.routes
+        graph = self.routes.graph
+        tree = self.routes.tree(destination)
+        positions = graph.positions
+        paths = [[positions[cell] for cell in tree.cells(graph.cell_id(origin))] for origin in origins]
+        if cached:
+            return paths, None
+        return paths, int(np.count_nonzero(tree.distance >= 0))
+
+
+class AStarRouter:
+    """
+    A* over the road graph with the Chebyshev distance as heuristic.
+    Ties go first to the cell that is further from the start, then to the lowest cell id.
+    Attributes:
+        graph: The RoadGraph of the map
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def heuristic(self, start, goal):
+        """
+        Returns the function that gives the lower bound of the distance from a cell to the goal,
+        for a search that begins at start.
+        """
+        positions = self.graph.positions
+        goal_x, goal_y = positions[goal]
+
+        def distance(cell):
+            x, y = positions[cell]
+            return max(abs(x - goal_x), abs(y - goal_y))
+        return distance
+
+    def search(self, start, goal):
+        """
+        Finds a shortest path between two cells.
+        Returns:
+            (cells, expansions): cell ids from start (excluded) to goal, empty if there is no path
+        """
+        graph = self.graph
+        adjacency = graph.adjacency
+        destination_cells = graph.destination_cells
+        heuristic = self.heuristic(start, goal)
+        frontier = [(heuristic(start), 0, start)]
+        cost_so_far = {start: 0}
+        came_from = {start: None}
+        expansions = 0
+        while frontier:
+            _, cost, current = heapq.heappop(frontier)
+            cost = -cost
+            if cost > cost_so_far[current]:
+                # Outdated entry, the cell was reached again with a lower cost.
+                continue
+            expansions += 1
+            if current == goal:
+                path = []
+                while current != start:
+                    path.append(current)
+                    current = came_from[current]
+                path.reverse()
+                return path, expansions
+            new_cost = cost + 1
+            for next in adjacency[current]:
+                if next in destination_cells and next != goal:
+                    continue
+                if new_cost < cost_so_far.get(next, UNREACHABLE):
+                    cost_so_far[next] = new_cost
+                    came_from[next] = current
+                    heapq.heappush(frontier, (new_cost + heuristic(next), -new_cost, next))
+        return [], expansions
+
+    def route(self, origin, destination):
+        """
+        Returns the positions from origin to destination, see TreeRouter.route.
+        """
+        graph = self.graph
+        cells, expansions = self.search(graph.cell_id(origin), graph.cell_id(destination))
+        positions = graph.positions
+        return [positions[cell] for cell in cells], expansions
+
+    def route_batch(self, origins, destination):
+        """
+        Returns the positions from several origins to one destination, see TreeRouter.route_batch.
+        A single origin is a normal search. With more, a breadth first search from the destination over the
+        reversed edges runs until it has reached every origin, and each path is read from that partial tree.
+        """
+        if len(origins) == 1:
+            path, expansions = self.route(origins[0], destination)
+            return [path], expansions
+        graph = self.graph
+        predecessors = graph.predecessors
+        destination_cells = graph.destination_cells
+        goal = graph.cell_id(destination)
+        starts = [graph.cell_id(origin) for origin in origins]
+        missing = set(starts)
+        missing.discard(goal)
+        next_hop = {goal: None}
+        frontier = [goal]
+        expansions = 0
+        while frontier and missing:
+            next_frontier = []
+            for current in frontier:
+                expansions += 1
+                for previous in predecessors[current]:
+                    if previous in next_hop or previous in destination_cells:
+                        continue
+                    next_hop[previous] = current
+                    next_frontier.append(previous)
+                    missing.discard(previous)
+            frontier = next_frontier
+        positions = graph.positions
+        paths = []
+        for start in starts:
+            path = []
+            if start in next_hop:
+                current = next_hop[start]
+                while current is not None:
+                    path.append(positions[current])
+                    current = next_hop[current]
+            paths.append(path)
+        return paths, expansions
+
+
+class BidirectionalRouter(AStarRouter):
+    """
+    Breadth first searches from the start and, over the reversed edges, from the goal. The smaller side
+    expands one whole level at a time, and the search stops at the level where the two sides meet.
+    """
+    def search(self, start, goal):
+        """
+        Finds a shortest path between two cells, see AStarRouter.search.
+        """
+        if start == goal:
+            return [], 0
+        graph = self.graph
+        destination_cells = graph.destination_cells
+        # Distance and previous cell of the cells reached from the start, distance and next cell from the goal.
+        forward = {start: (0, None)}
+        backward = {goal: (0, None)}
+        forward_frontier = [start]
+        backward_frontier = [goal]
+        expansions = 0
+        while forward_frontier and backward_frontier:
+            if len(forward_frontier) <= len(backward_frontier):
+                reached, other, edges = forward, backward, graph.adjacency
+                frontier = forward_frontier
+            else:
+                reached, other, edges = backward, forward, graph.predecessors
+                frontier = backward_frontier
+            level = reached[frontier[0]][0] + 1
+            next_frontier = []
+            meeting = None
+            for current in frontier:
+                expansions += 1
+                for next in edges[current]:
+                    if next in reached or (next in destination_cells and next != goal):
+                        continue
+                    reached[next] = (level, current)
+                    next_frontier.append(next)
+                    # The shortest path goes through the meeting cell closest to the other end.
+                    if next in other and (meeting is None or other[next][0] < other[meeting][0]):
+                        meeting = next
+            if meeting is not None:
+                path = []
+                current = meeting
+                while current != start:
+                    path.append(current)
+                    current = forward[current][1]
+                path.reverse()
+                current = backward[meeting][1]
+                while current is not None:
+                    path.append(current)
+                    current = backward[current][1]
+                return path, expansions
+            if reached is forward:
+                forward_frontier = next_frontier
+            else:
+                backward_frontier = next_frontier
+        return [], expansions
+
+
+class Landmarks:
+    """
+    Distances from a few cells of a map to every cell and from every cell to them, for the ALT heuristic.
+    The landmarks are picked far from each other: each one is the road cell furthest from the ones before.
+    Attributes:
+        cells: Cell ids of the landmarks
+        table: Array with one row per cell: the distances to every landmark, then the distances from every
+            landmark with their sign changed. UNREACHABLE where there is no path
+    """
+    def __init__(self, graph, count=8):
+        size = graph.width * graph.height
+        # Cars appear in the corners, so the first landmark is one of them.
+        candidates = graph.directions != 0
+        cell = 0
+        nearest = np.full(size, UNREACHABLE, dtype=np.int64)
+        cells, to_landmarks, from_landmarks = [], [], []
+        for _ in range(count):
+            to_landmark = bfs_distances(graph.reverse_indptr, graph.reverse_indices, cell)
+            from_landmark = bfs_distances(graph.indptr, graph.indices, cell)
+            cells.append(cell)
+            to_landmarks.append(np.where(to_landmark >= 0, to_landmark, UNREACHABLE))
+            from_landmarks.append(np.where(from_landmark >= 0, from_landmark, UNREACHABLE))
+            reached = (from_landmark >= 0) & (to_landmark >= 0)
+            nearest = np.where(reached, np.minimum(nearest, from_landmark + to_landmark), nearest)
+            spread = np.where(candidates & (nearest < UNREACHABLE), nearest, -1)
+            spread[cells] = -1
+            if spread.max() <= 0:
+                break
+            cell = int(spread.argmax())
+        self.cells = cells
+        self.table = np.ascontiguousarray(np.stack(to_landmarks + [-distances for distances in from_landmarks], axis=1), dtype=np.int32)
+
+    def bounds(self, start, goal, active=4):
+        """
+        Returns the landmark bounds of the distance to goal that are the highest at start.
+        Returns:
+            List of (column, offset): for a cell, table[cell, column] + offset is a lower bound of its distance to goal.
+            The columns are d(cell, L) - d(goal, L) and d(L, goal) - d(L, cell), only for the landmarks with a path to
+            or from the goal
+        """
+        row = self.table[goal].astype(np.int64)
+        count = len(self.cells)
+        offsets = np.concatenate([-row[:count], -row[count:]])
+        useful = np.flatnonzero(np.concatenate([row[:count] < UNREACHABLE, -row[count:] < UNREACHABLE]))
+        at_start = self.table[start, useful] + offsets[useful]
+        columns = useful[np.argsort(-at_start, kind="stable")[:active]]
+        return [(int(column), int(offsets[column])) for column in columns]
+
+
+class LandmarkRouter(AStarRouter):
+    """
+    A* with the ALT heuristic: the highest of the Chebyshev distance and the landmark bounds.
+    Attributes:
+        landmarks: Landmarks of the map
+    """
+    def __init__(self, graph, landmarks):
+        super().__init__(graph)
+        self.landmarks = landmarks
+
+    def heuristic(self, start, goal):
+        landmarks = self.landmarks
+        size = self.graph.width * self.graph.height
+        goal_x, goal_y = divmod(goal, self.graph.height)
+        x, y = np.divmod(np.arange(size), self.graph.height)
+        lower_bounds = np.maximum(np.abs(x - goal_x), np.abs(y - goal_y))
+        # The bounds of every cell are computed once per search, with only the landmarks that give the best
+        # bounds at start: it is the same bound for a fraction of the work.
+        for column, offset in landmarks.bounds(start, goal):
+            np.maximum(lower_bounds, landmarks.table[:, column] + offset, out=lower_bounds)
+        return lower_bounds.tolist().__getitem__
+
+
+def create_router(name, city_map):
+    """
+    Creates one of the ROUTERS for a map.
+    Args:
+        name: "tree", "astar", "bidirectional" or "alt"
+        city_map: CityMap of the model. The trees and the landmarks are kept in it and shared by its models
+    """
+    if name == "tree":
+        return TreeRouter(city_map.routes)
+    elif name == "astar":
+        return AStarRouter(city_map.road_graph)
+    elif name == "bidirectional":
+        return BidirectionalRouter(city_map.road_graph)
+    elif name == "alt":
+        return LandmarkRouter(city_map.road_graph, city_map.landmarks)
+    raise ValueError(f"Unknown router: {name}")
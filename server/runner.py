@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import namedtuple
+
+# Read only view of the simulation after a step. Snapshots are never modified once published,
+# so the server can read them from any thread without locking the model.
+# total is the number of cars that reached their destination, metrics a copy of the StepMetrics of the model.
+Snapshot = namedtuple("Snapshot", ["step", "total", "cars", "traffic_lights", "metrics"])
+
+
+def take_snapshot(model):
+    """
+    Copies the state of the model the visualization needs.
+    """
+    return Snapshot(model.step_count, model.arrived_cars, tuple(model.get_cars()), tuple(model.get_traffic_lights()),
+                    model.metrics.copy())
+
+
+class SimulationRunner:
+    """
+    Advances a model on its own thread at a fixed rate and publishes a snapshot after every step.
+    With a tick rate of 0 there is no thread and the model only advances when step() is called.
+    Attributes:
+        model: The simulation
+        tick_rate: Steps per second
+        snapshot: Latest published Snapshot
+        on_step: Called with the model and its new snapshot after every step, on the thread that steps it, or None
+    """
+    def __init__(self, model, tick_rate=2.0, on_step=None):
+        self.model = model
+        self.tick_rate = tick_rate
+        self.on_step = on_step
+        self.snapshot = take_snapshot(model)
+        self._lock = threading.Lock()
+        self._published = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the stepping thread, if the runner has a tick rate.
+        """
+        if self.tick_rate and not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="simulation-runner", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the stepping thread and waits for the current step to finish.
+        """
+        self._stop.set()
+        with self._published:
+            self._published.notify_all()
+        for listener in tuple(self._listeners):
+            listener(self.snapshot)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def step(self):
+        """
+        Advances the model one step and publishes the new snapshot.
+        Returns:
+            The new snapshot
+        """
+        with self._lock:
+            self.model.step()
+            snapshot = take_snapshot(self.model)
+            if self.on_step is not None:
+                self.on_step(self.model, snapshot)
+            with self._published:
+                self.snapshot = snapshot
+                self._published.notify_all()
+            for listener in tuple(self._listeners):
+                listener(snapshot)
+        return snapshot
+
+    def subscribe(self, listener):
+        """
+        Calls listener with every new snapshot and when the runner stops, on the thread that steps or stops it.
+        Listeners must be quick, e.g. wake up an event loop that waits for the step and can't block on wait_for_step.
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    def wait_for_step(self, step, timeout=None):
+        """
+        Waits until a snapshot newer than step is published, the runner stops or the timeout expires.
+        Returns:
+            The latest snapshot
+        """
+        with self._published:
+            self._published.wait_for(lambda: self.snapshot.step > step or self._stop.is_set(), timeout)
+            return self.snapshot
+
+    def _run(self):
+        interval = 1.0 / self.tick_rate
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            self.step()
+            next_tick += interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # Running behind, don't try to catch up with a burst of steps.
+                next_tick = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
@@ -1,37 +1,105 @@
-from flask import Flask, request, jsonify
+import os
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS, cross_origin
 from model import CityModel, Building, Road, Destination, TrafficLight, Car
+from sessions import SessionRegistry, SessionLimitError, recording_folder
+from stream import DeltaEncoder
+from metrics import PrometheusText, add_step_metrics
+from trajectory import TrajectoryReader, frame_snapshot
 
 
 app = Flask("")
 cors = CORS(app, origins=['http://localhost'])
 
-cityModel = None
+# Simulation engine: "mesa" (one agent object per car), "vectorized" (numpy arrays) or "tiled" (numpy arrays
+# split into tiles, each moved by its own process).
+engine = os.environ.get("CITY_ENGINE", "mesa")
+# Steps per second of the simulation thread. With 0 the model only advances on each /update request.
+tickRate = float(os.environ.get("CITY_TICK_RATE", "2"))
+# Every how many steps a step of each session is run under cProfile, see /profile. 0 never profiles.
+profileEvery = int(os.environ.get("CITY_PROFILE_EVERY", "0")) or None
+
+# Every simulation lives in a session. Clients that don't send a session id all share the default one.
+DEFAULT_SESSION = "default"
+sessions = SessionRegistry(
+    max_sessions=int(os.environ.get("CITY_MAX_SESSIONS", "256")),
+    max_cars=int(os.environ.get("CITY_MAX_CARS", "20000")),
+    idle_timeout=float(os.environ.get("CITY_IDLE_TIMEOUT", "600")),
+    # With a checkpoint folder the sessions are saved every CITY_CHECKPOINT_EVERY steps and continue after a restart.
+    checkpoint_dir=os.environ.get("CITY_CHECKPOINT_DIR") or None,
+    checkpoint_every=int(os.environ.get("CITY_CHECKPOINT_EVERY", "200")),
+    # With a recording folder every step of the sessions is recorded, see /replay.
+    recording_dir=os.environ.get("CITY_RECORDING_DIR") or None
+)
+
+def sessionId():
+    """
+    Returns the session id of the request: the session query parameter, the X-Session-Id header or the session field of the body.
+    """
+    parameters = request.get_json(silent=True) or {}
+    return request.args.get("session") or request.headers.get("X-Session-Id") or parameters.get("session") or DEFAULT_SESSION
+
+def queryInt(name, default=None, minimum=None):
+    """
+    Returns an integer query parameter of the request, default if it wasn't sent.
+    Raises:
+        ValueError: If the parameter isn't an integer or is smaller than minimum
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    value = int(value)
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return value
+
+def sessionNotFound():
+    return jsonify({"message":"Session not found, initialize the model first."}), 404
 
 # This route will be used to send the parameters of the simulation to the server.
 # The servers expects a POST request with the parameters in a.json.
+# With "newSession": true a new session is created and its id is returned in "sessionId".
+# With "rerouting": true the blocked cars look for a way around the traffic.
+# "lightControl" chooses how the traffic lights are coordinated: "fixed" (the default), "green_wave" or "adaptive".
+# "seed" makes the run repeatable, the seed of the run is returned in "seed" either way.
+# "demand" sets the arrival rates and the origin-destination matrix of the cars (see demand.py, mesa engine only).
 @app.route('/init', methods=['POST'])
 @cross_origin()
 def initModel():
-    global cityModel
     if request.method == 'POST':
         try:
-            # Create the model using the parameters sent by the application
-            if cityModel is None:
-                cityModel = CityModel()
+            parameters = request.get_json(silent=True) or {}
+            session_id = None if parameters.get("newSession") else sessionId()
+            session = sessions.get(session_id) if session_id else None
+            if session is None:
+                # Create the model using the parameters sent by the application
+                session = sessions.create(session_id,
+                                          engine=parameters.get("engine", engine),
+                                          tick_rate=float(parameters.get("tickRate", tickRate)),
+                                          rerouting=bool(parameters.get("rerouting", False)),
+                                          light_control=parameters.get("lightControl", "fixed"),
+                                          profile_every=profileEvery,
+                                          demand=parameters.get("demand"),
+                                          seed=int(parameters["seed"]) if parameters.get("seed") is not None else None)
                 # Return a message to saying that the model was created successfully
                 return jsonify({
                     "message":"Parameters recieved, model initiated.",
-                    "width": cityModel.width,
-                    "height": cityModel.height
+                    "sessionId": session.session_id,
+                    "seed": session.run_seed,
+                    "width": session.model.width,
+                    "height": session.model.height
                 })
             else:
                 return jsonify({
                     "message":"Model already initiated",
-                    "width": cityModel.width,
-                    "height": cityModel.height
+                    "sessionId": session.session_id,
+                    "seed": session.run_seed,
+                    "width": session.model.width,
+                    "height": session.model.height
                 })
 
+        except SessionLimitError as e:
+            return jsonify({"message":str(e)}), 503
         except Exception as e:
             print(e)
             return jsonify({"message":"Erorr initializing the model"}), 500
@@ -39,15 +107,19 @@ def initModel():
 @app.route('/reset', methods=['POST'])
 @cross_origin()
 def resetModel():
-    global cityModel
     if request.method == 'POST':
         try:
+            session = sessions.get(sessionId())
+            if session is None:
+                return sessionNotFound()
             # Create the model using the parameters sent by the application
-            cityModel = CityModel()
+            session.start()
             return jsonify({
                 "message":"Parameters recieved, model initiated.",
-                "width": cityModel.width,
-                "height": cityModel.height
+                "sessionId": session.session_id,
+                "seed": session.run_seed,
+                "width": session.model.width,
+                "height": session.model.height
             })
         except Exception as e:
             print(e)
@@ -58,15 +130,19 @@ def resetModel():
 @app.route('/update', methods=['GET'])
 @cross_origin()
 def updateModel():
-    global cityModel
     if request.method == 'GET':
         try:
-            # Update the model and return a message to WebGL saying that the model was updated successfully
-            cityModel.step()
+            session = sessions.get(sessionId())
+            if session is None:
+                return sessionNotFound()
+            # The runner steps the model on its own thread, this just reports the latest step.
+            # Without a tick rate the model is updated here, like before.
+            runner = session.runner
+            snapshot = runner.snapshot if runner.running else runner.step()
             return jsonify({
-                'message': f'Model updated to step <replace to step>',
-                'step': cityModel.step_count,
-                'total': cityModel.arrived_cars
+                'message': f'Model updated to step {snapshot.step}',
+                'step': snapshot.step,
+                'total': snapshot.total
             })
         except Exception as e:
             print(e)
@@ -76,98 +152,184 @@ def updateModel():
 @app.route('/get-cars', methods=['GET'])
 @cross_origin()
 def getCars():
-    global cityModel
     if request.method == 'GET':
         try:
+            session = sessions.get(sessionId())
+            if session is None:
+                return sessionNotFound()
             # Get the positions of the cars and return them to WebGL in JSON.json.
             # The positions are sent as a list of dictionaries, where each dictionary has the id and position of a car.
-            carPositions = []
-            for agent in cityModel.schedule.agents:
-                if isinstance(agent, Car):
-                    carPositions.append({
-                        "id": str(agent.unique_id), 
-                        "x": agent.pos[0],
-                        "y": 0,
-                        "dir": agent.direction,
-                        "z": agent.pos[1]
-                    })
-
-            trafficLights = []
-            for agent in cityModel.schedule.agents:
-                if isinstance(agent, TrafficLight):
-                    trafficLights.append({
-                        "id": str(agent.unique_id),
-                        "x": agent.pos[0],
-                        "y": 1,
-                        "z": agent.pos[1],
-                        "state": agent.state
-                    })
-                    
+            # They come from the latest snapshot, so a step can't change them halfway through.
+            snapshot = session.runner.snapshot
 
             return jsonify({
-                "cars": carPositions,
-                "trafficLights": trafficLights
+                "cars": snapshot.cars,
+                "trafficLights": snapshot.traffic_lights
             })
 
         except Exception as e:
             print(e)
             return jsonify({"message":"Error with car positions"}), 500
 
+# This route streams the cars and traffic lights: a keyframe first and then only what changed on each step.
+# JSON frames are sent as server-sent events, binary frames (?format=binary) as a stream of length-prefixed packets.
+@app.route('/stream-cars', methods=['GET'])
+@cross_origin()
+def streamCars():
+    session = sessions.get(sessionId())
+    if session is None:
+        return sessionNotFound()
+    binary = request.args.get("format") == "binary"
+    try:
+        keyframe = queryInt("keyframe", 50, minimum=1)
+    except ValueError:
+        return jsonify({"message":"keyframe must be a number of frames, at least 1."}), 400
+    encoder = DeltaEncoder(keyframe, binary)
+
+    def frames():
+        current = None
+        snapshot = None
+        # The stream ends when the session is closed.
+        while sessions.get(session.session_id) is session:
+            # A reset replaces the runner, so the client needs a new keyframe.
+            if current is not session.runner:
+                current = session.runner
+                encoder.reset()
+                snapshot = current.snapshot
+            else:
+                latest = current.wait_for_step(snapshot.step, timeout=15)
+                if latest.step == snapshot.step:
+                    # Nothing new, keep the connection alive (an empty packet in binary streams).
+                    yield bytes(4) if binary else ": keep-alive\n\n"
+                    continue
+                snapshot = latest
+            frame = encoder.encode(snapshot)
+            if binary:
+                yield len(frame).to_bytes(4, "little") + frame
+            else:
+                yield f"data: {frame}\n\n"
+
+    if binary:
+        return Response(stream_with_context(frames()), mimetype="application/octet-stream")
+    return Response(stream_with_context(frames()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Streams a range of recorded steps (?start=&stop=, both included) in the same frames as /stream-cars, without running the model.
+# Works for the sessions that are running and for the recordings of the sessions that were closed.
+@app.route('/replay', methods=['GET'])
+@cross_origin()
+def replaySteps():
+    session_id = sessionId()
+    session = sessions.get(session_id)
+    folder = None
+    if sessions.recording_dir is not None:
+        try:
+            folder = recording_folder(sessions.recording_dir, session_id)
+        except ValueError:
+            return jsonify({"message":"Invalid session id."}), 400
+    if session is not None and session.recorder is not None:
+        lights = session.recorder.meta["lights"]
+        recorded = session.recorder.frames
+    elif folder is not None and os.path.exists(os.path.join(folder, "meta.json")):
+        reader = TrajectoryReader(folder)
+        lights = reader.lights
+        recorded = reader.frames
+    else:
+        return jsonify({"message":"The session has no recording, set CITY_RECORDING_DIR to record the sessions."}), 404
+    try:
+        start = queryInt("start")
+        stop = queryInt("stop")
+    except ValueError:
+        return jsonify({"message":"start and stop must be step numbers."}), 400
+    binary = request.args.get("format") == "binary"
+    try:
+        keyframe = queryInt("keyframe", 50, minimum=1)
+    except ValueError:
+        return jsonify({"message":"keyframe must be a number of frames, at least 1."}), 400
+    encoder = DeltaEncoder(keyframe, binary)
+
+    def frames():
+        for frame in recorded(start, stop):
+            encoded = encoder.encode(frame_snapshot(lights, frame))
+            if binary:
+                yield len(encoded).to_bytes(4, "little") + encoded
+            else:
+                yield f"data: {encoded}\n\n"
+
+    if binary:
+        return Response(stream_with_context(frames()), mimetype="application/octet-stream")
+    return Response(stream_with_context(frames()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 # This route will be used to get the positions of all the city objects
 @app.route('/get-city', methods=['GET'])
 @cross_origin()
 def getCity():
-    global cityModel
     if request.method == 'GET':
         try:
+            session = sessions.get(sessionId())
+            if session is None:
+                return sessionNotFound()
             # Get the positions of the objects and return them to WebGL in JSON.json.t.
             # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an object.
-            buildingPositions = []
-            roadsPositions = []
-            destinationsPositions = []
-            trafficLightPositions = []
-            for agents, (x, z) in cityModel.grid.coord_iter():
-                for agent in agents:
-                    if isinstance(agent, Building):
-                        buildingPositions.append({
-                            "id": str(agent.unique_id),
-                            "x": x,
-                            "y":1,
-                            "z":z
-                        })
-                    elif isinstance(agent, Road):
-                        roadsPositions.append({
-                            "id": str(agent.unique_id), 
-                            "x": x, 
-                            "y":1, 
-                            "z":z
-                        })
-                    elif isinstance(agent, Destination):
-                        destinationsPositions.append({
-                            "id": str(agent.unique_id), 
-                            "x": x, 
-                            "y":1, 
-                            "z":z
-                        })
-                    elif isinstance(agent, TrafficLight):
-                        trafficLightPositions.append({
-                            "id": str(agent.unique_id), 
-                            "x": x, 
-                            "y":1, 
-                            "z":z
-                        })
-
-            return jsonify({
-                "buildings": buildingPositions,
-                "roads": roadsPositions,
-                "destinations": destinationsPositions,
-                "trafficLights": trafficLightPositions
-            })
+            # The city doesn't change, so the JSON is built and compressed once per map and clients that have it get a 304.
+            payload = session.model.city_map.city_payload
+            if request.if_none_match.contains(payload.etag):
+                response = Response(status=304)
+            else:
+                encodings = request.accept_encodings
+                if payload.br is not None and encodings["br"]:
+                    response = Response(payload.br, mimetype="application/json", headers={"Content-Encoding": "br"})
+                elif encodings["gzip"]:
+                    response = Response(payload.gzip, mimetype="application/json", headers={"Content-Encoding": "gzip"})
+                else:
+                    response = Response(payload.json, mimetype="application/json")
+            response.set_etag(payload.etag)
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Accept-Encoding")
+            return response
 
         except Exception as e:
             print(e)
             return jsonify({"message":"Error with city objects positions"}), 500
 
+# Metrics of every session in the Prometheus text format: step latency and the time of each phase of the steps,
+# cells expanded by the route searches and counts of active, blocked and arrived cars.
+# They come from the snapshots, so scraping never waits for a step.
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    page = PrometheusText()
+    page.sample("city_sessions", "gauge", "Open sessions.", len(sessions))
+    page.sample("city_sessions_evicted_total", "counter", "Sessions closed for being idle or too big.", sessions.evicted)
+    for session_id, session in sessions.items():
+        add_step_metrics(page, session.runner.snapshot.metrics, {"session": session_id, "engine": session.engine})
+    return Response(page.render(), mimetype="text/plain; version=0.0.4")
+
+# Report of the last step profiled with cProfile (the server needs CITY_PROFILE_EVERY).
+@app.route('/profile', methods=['GET'])
+@cross_origin()
+def getProfile():
+    session = sessions.get(sessionId())
+    if session is None:
+        return sessionNotFound()
+    try:
+        report = session.runner.snapshot.metrics.profile_report(request.args.get("sort", "cumulative"))
+    except KeyError:
+        return jsonify({"message":"Unknown sort key."}), 400
+    if report is None:
+        return jsonify({"message":"No step has been profiled, set CITY_PROFILE_EVERY to profile the steps."}), 404
+    return Response(report, mimetype="text/plain")
+
+# Closes a session and frees its model.
+@app.route('/close', methods=['POST'])
+@cross_origin()
+def closeSession():
+    session_id = sessionId()
+    if session_id not in sessions:
+        return sessionNotFound()
+    sessions.remove(session_id)
+    return jsonify({"message":"Session closed.", "sessionId": session_id})
+
 if __name__=='__main__':
-    # Run the flask server in port 8585
-    app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
+    sessions.start_reaper()
+    # Run the flask server in port 8585. It is meant for development: asgi.py serves the same routes in production.
+    # CITY_DEBUG=1 turns on the reloader and the debugger.
+    app.run(host="localhost", port=8585, debug=os.environ.get("CITY_DEBUG") == "1")
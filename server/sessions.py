@@ -0,0 +1,308 @@
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from model import create_model
+from runner import SimulationRunner
+from checkpoint import EventLog, read_checkpoint, write_checkpoint
+from trajectory import TrajectoryRecorder, is_inside
+
+
+class SessionLimitError(Exception):
+    """
+    Raised when the registry can't hold another session.
+    """
+
+
+# Ids that are used as they are in the file names: no separators and no leading dot, so never "." or "..".
+SAFE_NAME = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}")
+
+
+def file_name(session_id):
+    """
+    Returns the name of the files of a session. Safe ids are kept, any other id is named after its sha256
+    with a "~" in front, which no safe id has, so two sessions never share their files.
+    """
+    if SAFE_NAME.fullmatch(session_id):
+        return session_id
+    return "~" + hashlib.sha256(session_id.encode()).hexdigest()
+
+
+def recording_folder(recording_dir, session_id):
+    """
+    Returns the folder of the recording of a session.
+    Raises:
+        ValueError: If the folder isn't inside recording_dir
+    """
+    folder = os.path.join(recording_dir, file_name(session_id))
+    if not is_inside(folder, recording_dir):
+        raise ValueError(f"The recording of the session {session_id} isn't inside {recording_dir}")
+    return folder
+
+
+class Session:
+    """
+    One simulation served to one or more viewers.
+    Attributes:
+        session_id: Id sent by the clients
+        engine, tick_rate, map_file, rerouting, light_control, profile_every: Settings used to (re)create the model
+        demand: Demand profile of the model (see demand), None for the cars of every spawn_interval steps
+        seed: Seed of every model of the session, a new random one on each start if None
+        run_seed: Seed of the current model, to run it again
+        checkpoint_dir: Folder of the checkpoints and event logs, None to not save the session.
+            Only the mesa engine can be saved
+        checkpoint_every: Every how many steps a checkpoint is written
+        recording_dir: Folder where the steps of the session are recorded (see trajectory), None to not record them
+        recorder: TrajectoryRecorder of the current model, None if the session isn't recorded
+        runner: SimulationRunner that steps the model of the session
+        last_seen: time.monotonic() of the last request to the session
+    """
+    def __init__(self, session_id, engine="mesa", tick_rate=2.0, map_file="city_files/2022_base.txt", rerouting=False,
+                 light_control="fixed", profile_every=None, seed=None, checkpoint_dir=None, checkpoint_every=200,
+                 recording_dir=None, demand=None):
+        self.session_id = session_id
+        self.engine = engine
+        self.tick_rate = tick_rate
+        self.map_file = map_file
+        self.rerouting = rerouting
+        self.light_control = light_control
+        self.profile_every = profile_every
+        self.demand = demand
+        self.seed = seed
+        self.run_seed = seed
+        self.checkpoint_dir = checkpoint_dir if engine == "mesa" else None
+        self.checkpoint_every = checkpoint_every
+        self.recording_dir = recording_dir
+        self.event_log = None
+        self.recorder = None
+        self.runner = None
+        self.touch()
+        # A session that was saved before the server restarted continues where it was.
+        self.start(resume=True)
+
+    @property
+    def model(self):
+        return self.runner.model
+
+    def _path(self, extension):
+        return os.path.join(self.checkpoint_dir, f"{file_name(self.session_id)}.{extension}")
+
+    def start(self, resume=False):
+        """
+        Creates a new model for the session, stopping the previous one.
+        Args:
+            resume: Restore the last checkpoint of the session instead, if it has one
+        """
+        self.stop()
+        model = None
+        if self.checkpoint_dir is not None:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            if resume and os.path.exists(self._path("checkpoint")):
+                try:
+                    model = read_checkpoint(self._path("checkpoint"), profile_every=self.profile_every)
+                    self.run_seed = model.settings["seed"]
+                except (ValueError, OSError) as e:
+                    print(f"Session {self.session_id}: {e}")
+            if model is None and os.path.exists(self._path("events")):
+                os.remove(self._path("events"))
+        if model is None:
+            self.run_seed = self.seed if self.seed is not None else random.randrange(2 ** 32)
+            options = {"rerouting": True} if self.rerouting else {}
+            if self.demand is not None:
+                options["demand"] = self.demand
+            model = create_model(self.engine, map_file=self.map_file, light_control=self.light_control,
+                                 profile_every=self.profile_every, seed=self.run_seed, **options)
+        if self.checkpoint_dir is not None:
+            self.event_log = EventLog(self._path("events"), model)
+        self.runner = SimulationRunner(model, self.tick_rate, self._after_step)
+        if self.recording_dir is not None:
+            # A restored model continues its recording, a new one replaces it.
+            resumed = model.step_count > 0
+            self.recorder = TrajectoryRecorder(recording_folder(self.recording_dir, self.session_id),
+                                               self.runner.snapshot.traffic_lights,
+                                               resume_step=model.step_count if resumed else None,
+                                               root=self.recording_dir)
+            if not resumed:
+                self.recorder.record(self.runner.snapshot)
+        self.runner.start()
+
+    def _after_step(self, model, snapshot):
+        # A checkpoint every checkpoint_every steps, and the step in the recording.
+        if self.checkpoint_dir is not None and model.step_count % self.checkpoint_every == 0:
+            write_checkpoint(model, self._path("checkpoint"))
+        if self.recorder is not None:
+            self.recorder.record(snapshot)
+
+    def stop(self):
+        if self.runner is not None:
+            self.runner.stop()
+            if hasattr(self.model, "close"):
+                # The tiled engine has worker processes.
+                self.model.close()
+        if self.event_log is not None:
+            self.event_log.close()
+            self.event_log = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def close(self):
+        """
+        Stops the session for good: its checkpoint is deleted, so it isn't resumed. The event log and the recording are kept.
+        """
+        self.stop()
+        if self.checkpoint_dir is not None and os.path.exists(self._path("checkpoint")):
+            os.remove(self._path("checkpoint"))
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+
+class SessionRegistry:
+    """
+    Sessions of the server, by id. The parsed maps are cached by CityMap, so all the sessions of a map share them.
+    Attributes:
+        max_sessions: Maximum number of sessions at the same time
+        max_cars: Maximum number of cars in a session. Cars are the only thing that grows during a
+            simulation, so this is what bounds the memory of each session
+        idle_timeout: Seconds without requests after which a session is closed. Its checkpoint is kept,
+            so it continues if the client comes back
+        checkpoint_dir, checkpoint_every: Where and how often the sessions are saved, see Session
+        recording_dir: Folder of the recordings of the sessions, see Session
+    """
+    def __init__(self, max_sessions=256, max_cars=20000, idle_timeout=600, checkpoint_dir=None, checkpoint_every=200,
+                 recording_dir=None):
+        self.max_sessions = max_sessions
+        self.max_cars = max_cars
+        self.idle_timeout = idle_timeout
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.recording_dir = recording_dir
+        self.evicted = 0
+        self._sessions = {}
+        # Sessions that have a slot but are still being built, see create.
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def create(self, session_id=None, **settings):
+        """
+        Creates a session, replacing the one with the same id if there was one.
+        Args:
+            session_id: Id of the session, a random one if None
+            settings: engine, tick_rate, map_file, rerouting, light_control, profile_every, seed and demand of the session
+        Returns:
+            The new Session
+        """
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+        with self._lock:
+            # Sessions being created count too, so concurrent requests can't go over max_sessions.
+            used = len(self._sessions) + self._pending
+            idle = []
+            if session_id not in self._sessions and used >= self.max_sessions:
+                idle = self._evict_idle(self.idle_timeout / 2)
+                used = len(self._sessions) + self._pending
+            full = session_id not in self._sessions and used >= self.max_sessions
+            if not full:
+                # The slot is reserved until the session is built.
+                self._pending += 1
+                previous = self._sessions.pop(session_id, None)
+        # Stopping waits for the step the sessions are running, so it happens outside the lock.
+        for _, session in idle:
+            session.stop()
+        if full:
+            raise SessionLimitError(f"The server already has {used} sessions")
+        try:
+            if previous is not None:
+                # Stopped first, so it doesn't write to the files of the session any more.
+                previous.stop()
+            session = Session(session_id, checkpoint_dir=self.checkpoint_dir, checkpoint_every=self.checkpoint_every,
+                              recording_dir=self.recording_dir, **settings)
+        except BaseException:
+            # The slot is given back if the session couldn't be built.
+            with self._lock:
+                self._pending -= 1
+            raise
+        with self._lock:
+            self._pending -= 1
+            # Another request may have created the same session in the meantime, the last one wins.
+            replaced = self._sessions.get(session_id)
+            self._sessions[session_id] = session
+        if replaced is not None:
+            replaced.stop()
+        return session
+
+    def get(self, session_id):
+        """
+        Returns the session with the id, or None if there isn't one.
+        """
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    def items(self):
+        """
+        Returns the (session_id, session) pairs of the registry, without touching the sessions.
+        """
+        with self._lock:
+            return list(self._sessions.items())
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+
+    def _evict_idle(self, timeout):
+        """
+        Takes the sessions idle for more than timeout out of the registry, the caller stops them.
+        Returns:
+            List of (session_id, session)
+        """
+        now = time.monotonic()
+        idle = [session_id for session_id, session in self._sessions.items() if now - session.last_seen > timeout]
+        self.evicted += len(idle)
+        return [(session_id, self._sessions.pop(session_id)) for session_id in idle]
+
+    def evict(self):
+        """
+        Closes the sessions that have been idle too long or that have more cars than max_cars.
+        Returns:
+            The ids of the closed sessions
+        """
+        with self._lock:
+            idle = self._evict_idle(self.idle_timeout)
+            over_limit = [(session_id, self._sessions.pop(session_id)) for session_id, session in list(self._sessions.items())
+                          if len(session.runner.snapshot.cars) > self.max_cars]
+            self.evicted += len(over_limit)
+        for _, session in idle:
+            session.stop()
+        for _, session in over_limit:
+            session.close()
+        return [session_id for session_id, _ in idle + over_limit]
+
+    def start_reaper(self, interval=5.0):
+        """
+        Starts a thread that calls evict() every interval seconds.
+        """
+        if self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict()
+
+        self._reaper = threading.Thread(target=reap, name="session-reaper", daemon=True)
+        self._reaper.start()
@@ -0,0 +1,118 @@
+import json
+import struct
+import numpy as np
+from road_graph import DIRECTION_CODES
+
+KEYFRAME = 0
+DELTA = 1
+
+# Binary records. Car ids are the number after "c_", lights are referenced by their index in the keyframe.
+CAR_RECORD = np.dtype([("id", "<u4"), ("x", "<i2"), ("z", "<i2"), ("dir", "u1")])
+LIGHT_RECORD = np.dtype([("x", "<i2"), ("z", "<i2"), ("state", "u1")])
+LIGHT_CHANGE_RECORD = np.dtype([("index", "<u2"), ("state", "u1")])
+# type, step, total, then the number of records of each section of the frame.
+KEYFRAME_HEADER = struct.Struct("<BIIII")
+DELTA_HEADER = struct.Struct("<BIIIIII")
+
+
+def car_records(cars):
+    records = np.zeros(len(cars), dtype=CAR_RECORD)
+    if cars:
+        records["id"] = [int(car["id"].split("_")[-1]) for car in cars]
+        records["x"] = [car["x"] for car in cars]
+        records["z"] = [car["z"] for car in cars]
+        records["dir"] = [DIRECTION_CODES.get(car["dir"], 0) for car in cars]
+    return records
+
+
+class DeltaEncoder:
+    """
+    Turns the snapshots of a runner into a stream of frames: a keyframe with the whole state first,
+    and then only what changed since the previous frame. A new keyframe is sent every keyframe_interval
+    frames so clients can resync.
+    Frames are JSON strings, or bytes with packed little endian records if binary is True.
+    Raises:
+        ValueError: If keyframe_interval is smaller than 1
+    """
+    def __init__(self, keyframe_interval=50, binary=False):
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1")
+        self.keyframe_interval = keyframe_interval
+        self.binary = binary
+        self.frames = 0
+        self.cars = None
+        self.lights = None
+
+    def reset(self):
+        """
+        Makes the next frame a keyframe, e.g. after the model was replaced.
+        """
+        self.cars = None
+
+    def encode(self, snapshot):
+        """
+        Encodes the frame for a snapshot.
+        Args:
+            snapshot: Snapshot published by the runner
+        Returns:
+            The frame, as str or bytes
+        """
+        cars = {car["id"]: car for car in snapshot.cars}
+        lights = [light["state"] for light in snapshot.traffic_lights]
+        keyframe = (self.cars is None or self.frames % self.keyframe_interval == 0 or
+                    len(lights) != len(self.lights))
+
+        if keyframe:
+            frame = self._keyframe(snapshot)
+        else:
+            moved = []
+            spawned = []
+            for car_id, car in cars.items():
+                previous = self.cars.get(car_id)
+                if previous is None:
+                    spawned.append(car)
+                elif previous["x"] != car["x"] or previous["z"] != car["z"] or previous["dir"] != car["dir"]:
+                    moved.append(car)
+            removed = [car_id for car_id in self.cars if car_id not in cars]
+            toggled = [(index, state) for index, (state, previous) in enumerate(zip(lights, self.lights)) if state != previous]
+            frame = self._delta(snapshot, moved, spawned, removed, toggled)
+
+        self.frames += 1
+        self.cars = cars
+        self.lights = lights
+        return frame
+
+    def _keyframe(self, snapshot):
+        if not self.binary:
+            return json.dumps({
+                "type": "keyframe",
+                "step": snapshot.step,
+                "total": snapshot.total,
+                "cars": snapshot.cars,
+                "trafficLights": snapshot.traffic_lights
+            }, separators=(",", ":"))
+
+        lights = np.zeros(len(snapshot.traffic_lights), dtype=LIGHT_RECORD)
+        if snapshot.traffic_lights:
+            lights["x"] = [light["x"] for light in snapshot.traffic_lights]
+            lights["z"] = [light["z"] for light in snapshot.traffic_lights]
+            lights["state"] = [light["state"] for light in snapshot.traffic_lights]
+        header = KEYFRAME_HEADER.pack(KEYFRAME, snapshot.step, snapshot.total, len(snapshot.cars), len(lights))
+        return header + car_records(snapshot.cars).tobytes() + lights.tobytes()
+
+    def _delta(self, snapshot, moved, spawned, removed, toggled):
+        if not self.binary:
+            return json.dumps({
+                "type": "delta",
+                "step": snapshot.step,
+                "total": snapshot.total,
+                "moved": [{"id": car["id"], "x": car["x"], "z": car["z"], "dir": car["dir"]} for car in moved],
+                "spawned": spawned,
+                "removed": removed,
+                "trafficLights": [{"index": index, "state": state} for index, state in toggled]
+            }, separators=(",", ":"))
+
+        removed_ids = np.array([int(car_id.split("_")[-1]) for car_id in removed], dtype="<u4")
+        changes = np.array(toggled, dtype=LIGHT_CHANGE_RECORD) if toggled else np.zeros(0, dtype=LIGHT_CHANGE_RECORD)
+        header = DELTA_HEADER.pack(DELTA, snapshot.step, snapshot.total, len(moved), len(spawned), len(removed_ids), len(changes))
+        return header + car_records(moved).tobytes() + car_records(spawned).tobytes() + removed_ids.tobytes() + changes.tobytes()
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+# The modules of the server import each other by name and open the maps with paths relative to the server folder.
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER)
+
+
+@pytest.fixture(autouse=True)
+def server_folder(monkeypatch):
+    monkeypatch.chdir(SERVER)
@@ -0,0 +1,74 @@
+import pytest
+from model import CityModel
+from checkpoint import EventLog, load_checkpoint, replay, save_checkpoint
+from demand import rush_hour_rates
+
+MAP = "city_files/2022_base.txt"
+DEMAND = {"rates": rush_hour_rates(0.2, 1.5, [60], 40)}
+
+
+def state(model):
+    """
+    Everything a step depends on, to compare two models.
+    """
+    return {
+        "cars": model.get_cars(),
+        "paths": [car.path for car in model.schedule.agents],
+        "lights": model.traffic_control.states.tolist(),
+        "phases": model.traffic_control.phase.tolist(),
+        "elapsed": model.traffic_control.elapsed.tolist(),
+        "counters": (model.step_count, model.cars_count, model.arrived_cars, model.total_travel_time, model.reroutes),
+        "random": model.random.getstate(),
+        "spawn_queue": None if model.spawn_queue is None else model.spawn_queue.state()
+    }
+
+
+@pytest.mark.parametrize("settings", [
+    {"light_control": "fixed"},
+    {"light_control": "adaptive", "rerouting": True},
+    {"light_control": "green_wave", "demand": DEMAND},
+])
+def test_restored_checkpoint_runs_the_same_steps(settings):
+    model = CityModel(MAP, spawn_interval=2, seed=11, **settings)
+    for _ in range(80):
+        model.step()
+    restored = load_checkpoint(save_checkpoint(model))
+    assert state(restored) == state(model)
+    for _ in range(120):
+        model.step()
+        restored.step()
+        assert state(restored) == state(model)
+
+
+def test_checkpoint_of_a_restored_model_is_the_same():
+    model = CityModel(MAP, spawn_interval=2, seed=3, rerouting=True)
+    for _ in range(100):
+        model.step()
+    data = save_checkpoint(model)
+    assert save_checkpoint(load_checkpoint(data)) == data
+
+
+def test_same_seed_gives_the_same_run():
+    first, second = (CityModel(MAP, spawn_interval=2, seed=7, rerouting=True) for _ in range(2))
+    for _ in range(150):
+        first.step()
+        second.step()
+    assert state(first) == state(second)
+
+
+def test_replay_rebuilds_every_step(tmp_path):
+    path = str(tmp_path / "run.events")
+    model = CityModel(MAP, spawn_interval=2, seed=5, rerouting=True)
+    log = EventLog(path, model, keyframe_every=50)
+    expected = {}
+    for _ in range(160):
+        model.step()
+        expected[model.step_count] = (sorted(model.get_cars(), key=lambda car: car["id"]),
+                                      [light["state"] for light in model.get_traffic_lights()], model.arrived_cars)
+    log.close()
+    for step in (1, 49, 50, 51, 99, 100, 123, 160):
+        replayed = replay(path, step)
+        assert replayed.step == step
+        assert (sorted(replayed.get_cars(), key=lambda car: car["id"]),
+                [light["state"] for light in replayed.get_traffic_lights()], replayed.arrived_cars) == expected[step]
+    assert replay(path).step == 160
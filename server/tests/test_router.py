@@ -0,0 +1,92 @@
+from collections import deque
+import random
+import pytest
+from city_map import load_city_map
+from route_cache import RouteCache
+from router import ROUTERS, TreeRouter, create_router
+
+MAPS = ["city_files/2021_base.txt", "city_files/2022_base.txt", "city_files/2023_base.txt"]
+
+
+def distances_to(graph, goal):
+    """
+    Moves from every cell to goal without going through another destination, by a plain BFS.
+    """
+    distances = {goal: 0}
+    frontier = deque([goal])
+    while frontier:
+        cell = frontier.popleft()
+        for previous in graph.predecessors[cell]:
+            if previous not in distances and previous not in graph.destination_cells:
+                distances[previous] = distances[cell] + 1
+                frontier.append(previous)
+    return distances
+
+
+def pairs(city_map, count=40):
+    """
+    Origins and destinations to route: from the corners, from the destinations and from random road cells.
+    """
+    graph = city_map.road_graph
+    destinations = [pos for _, pos in city_map.destinations]
+    roads = [graph.positions[cell] for cell in range(graph.width * graph.height) if graph.adjacency[cell]]
+    rng = random.Random(0)
+    starts = list(city_map.corners) + destinations[:4] + rng.sample(roads, count)
+    return [(start, goal) for start in starts for goal in rng.sample(destinations, min(4, len(destinations)))]
+
+
+def check_path(graph, origin, goal, path, distances):
+    cell = graph.cell_id(origin)
+    if cell not in distances:
+        assert path == []
+        return
+    assert len(path) == distances[cell]
+    for position in path:
+        next_cell = graph.cell_id(position)
+        assert next_cell in graph.adjacency[cell]
+        assert next_cell == graph.cell_id(goal) or next_cell not in graph.destination_cells
+        cell = next_cell
+    assert cell == graph.cell_id(goal)
+
+
+def make_router(name, city_map):
+    # A new cache, so the trees are built by the test and not taken from another model of the map.
+    return TreeRouter(RouteCache(city_map.road_graph)) if name == "tree" else create_router(name, city_map)
+
+
+@pytest.mark.parametrize("name", ROUTERS)
+@pytest.mark.parametrize("map_file", MAPS)
+def test_routers_return_shortest_paths(name, map_file):
+    city_map = load_city_map(map_file)
+    graph = city_map.road_graph
+    router = make_router(name, city_map)
+    distances = {}
+    for origin, goal in pairs(city_map):
+        if goal not in distances:
+            distances[goal] = distances_to(graph, graph.cell_id(goal))
+        path, _ = router.route(origin, goal)
+        check_path(graph, origin, goal, path, distances[goal])
+
+
+@pytest.mark.parametrize("name", ROUTERS)
+def test_batches_are_shortest_paths(name):
+    city_map = load_city_map(MAPS[1])
+    graph = city_map.road_graph
+    router = make_router(name, city_map)
+    by_goal = {}
+    for origin, goal in pairs(city_map):
+        by_goal.setdefault(goal, []).append(origin)
+    for goal, origins in by_goal.items():
+        distances = distances_to(graph, graph.cell_id(goal))
+        paths, _ = router.route_batch(origins, goal)
+        assert len(paths) == len(origins)
+        for origin, path in zip(origins, paths):
+            check_path(graph, origin, goal, path, distances)
+
+
+@pytest.mark.parametrize("name", ["astar", "bidirectional", "alt"])
+def test_searches_are_repeatable(name):
+    city_map = load_city_map(MAPS[2])
+    router = make_router(name, city_map)
+    for origin, goal in pairs(city_map, count=10):
+        assert router.route(origin, goal) == router.route(origin, goal)
@@ -0,0 +1,114 @@
+import json
+import numpy as np
+import pytest
+from model import CityModel
+from road_graph import DIRECTIONS
+from runner import take_snapshot
+from stream import (CAR_RECORD, DELTA_HEADER, KEYFRAME, KEYFRAME_HEADER, LIGHT_CHANGE_RECORD, LIGHT_RECORD,
+                    DeltaEncoder)
+
+MAP = "city_files/2022_base.txt"
+
+
+def run_snapshots(steps):
+    model = CityModel(MAP, spawn_interval=2, seed=9, rerouting=True)
+    snapshots = [take_snapshot(model)]
+    for _ in range(steps):
+        model.step()
+        snapshots.append(take_snapshot(model))
+    return snapshots
+
+
+def expected(snapshot):
+    return (snapshot.step, snapshot.total, {car["id"]: (car["x"], car["z"], car["dir"]) for car in snapshot.cars},
+            [light["state"] for light in snapshot.traffic_lights])
+
+
+def apply_json(state, encoded):
+    """
+    Applies a JSON frame to the state a client has, the way the viewer does. Returns the new state and the frame type.
+    """
+    frame = json.loads(encoded)
+    if frame["type"] == "keyframe":
+        cars = {car["id"]: (car["x"], car["z"], car["dir"]) for car in frame["cars"]}
+        lights = [light["state"] for light in frame["trafficLights"]]
+    else:
+        cars = dict(state[2])
+        lights = list(state[3])
+        for car in frame["moved"] + frame["spawned"]:
+            cars[car["id"]] = (car["x"], car["z"], car["dir"])
+        for car_id in frame["removed"]:
+            del cars[car_id]
+        for change in frame["trafficLights"]:
+            lights[change["index"]] = change["state"]
+    return (frame["step"], frame["total"], cars, lights), frame["type"]
+
+
+def frame_type(encoded):
+    if isinstance(encoded, bytes):
+        return "keyframe" if encoded[0] == KEYFRAME else "delta"
+    return json.loads(encoded)["type"]
+
+
+def binary_cars(data, offset, count):
+    records = np.frombuffer(data, dtype=CAR_RECORD, count=count, offset=offset)
+    cars = {f"c_{record['id']}": (int(record["x"]), int(record["z"]), DIRECTIONS[record["dir"]]) for record in records}
+    return cars, offset + records.nbytes
+
+
+def apply_binary(state, encoded):
+    """
+    Same as apply_json for a binary frame.
+    """
+    if encoded[0] == KEYFRAME:
+        _, step, total, car_count, light_count = KEYFRAME_HEADER.unpack_from(encoded)
+        cars, offset = binary_cars(encoded, KEYFRAME_HEADER.size, car_count)
+        lights = np.frombuffer(encoded, dtype=LIGHT_RECORD, count=light_count, offset=offset)
+        return (step, total, cars, [bool(light["state"]) for light in lights]), "keyframe"
+
+    _, step, total, moved, spawned, removed, toggled = DELTA_HEADER.unpack_from(encoded)
+    cars = dict(state[2])
+    lights = list(state[3])
+    changed, offset = binary_cars(encoded, DELTA_HEADER.size, moved + spawned)
+    cars.update(changed)
+    removed_ids = np.frombuffer(encoded, dtype="<u4", count=removed, offset=offset)
+    for car_id in removed_ids:
+        del cars[f"c_{car_id}"]
+    changes = np.frombuffer(encoded, dtype=LIGHT_CHANGE_RECORD, count=toggled, offset=offset + removed_ids.nbytes)
+    for change in changes:
+        lights[change["index"]] = bool(change["state"])
+    return (step, total, cars, lights), "delta"
+
+
+@pytest.mark.parametrize("binary, apply", [(False, apply_json), (True, apply_binary)])
+def test_deltas_rebuild_every_snapshot(binary, apply):
+    encoder = DeltaEncoder(keyframe_interval=7, binary=binary)
+    state = None
+    types = []
+    for snapshot in run_snapshots(60):
+        state, type_ = apply(state, encoder.encode(snapshot))
+        types.append(type_)
+        assert state == expected(snapshot)
+    assert types.count("delta") > types.count("keyframe")
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_keyframe_every_interval(binary):
+    encoder = DeltaEncoder(keyframe_interval=5, binary=binary)
+    types = [frame_type(encoder.encode(snapshot)) for snapshot in run_snapshots(12)]
+    assert [index for index, type_ in enumerate(types) if type_ == "keyframe"] == [0, 5, 10]
+
+
+def test_reset_sends_a_keyframe():
+    snapshots = run_snapshots(4)
+    encoder = DeltaEncoder(keyframe_interval=50)
+    frames = [frame_type(encoder.encode(snapshot)) for snapshot in snapshots[:3]]
+    encoder.reset()
+    frames.append(frame_type(encoder.encode(snapshots[3])))
+    assert frames == ["keyframe", "delta", "delta", "keyframe"]
+
+
+@pytest.mark.parametrize("interval", [0, -1])
+def test_keyframe_interval_below_one_is_rejected(interval):
+    with pytest.raises(ValueError):
+        DeltaEncoder(keyframe_interval=interval)
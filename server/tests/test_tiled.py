@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from tiled import TiledCityModel, car_bids
+
+
+def run(tiles, processes=False, map_file="city_files/2021_base.txt", spawn_interval=1, steps=150):
+    model = TiledCityModel(map_file, spawn_interval=spawn_interval, seed=9, tiles=tiles, processes=processes)
+    try:
+        for _ in range(steps):
+            model.step()
+        return model.arrived_cars, model.total_travel_time, model.get_cars(), model.light_states.tolist()
+    finally:
+        model.close()
+
+
+@pytest.mark.parametrize("map_file", ["city_files/2021_base.txt", "city_files/2022_base.txt", "city_files/2023_base.txt"])
+def test_tile_layouts_give_the_same_run(map_file):
+    expected = run((1, 1), map_file=map_file)
+    assert expected[0] > 0
+    for tiles in [(2, 1), (2, 2), (3, 2), (4, 4)]:
+        assert run(tiles, map_file=map_file) == expected, tiles
+
+
+@pytest.mark.parametrize("spawn_interval", [1, 4])
+def test_every_car_belongs_to_one_tile(spawn_interval):
+    model = TiledCityModel("city_files/2023_base.txt", spawn_interval=spawn_interval, seed=2, tiles=(3, 3), processes=False)
+    try:
+        for _ in range(100):
+            model.step()
+            # The cars that crossed into another tile wait in the handoffs until the next step.
+            handoffs = model.shared.arrays["handoffs"]
+            owned = np.concatenate([worker.own for worker in model.workers] + [handoffs[handoffs >= 0], model.spawned[model.spawned >= 0]])
+            assert sorted(owned.tolist()) == np.flatnonzero(model.alive).tolist()
+            for worker in model.workers:
+                assert (worker.tiles[model.cells[worker.own]] == worker.index).all()
+    finally:
+        model.close()
+
+
+def test_processes_give_the_same_run():
+    assert run((2, 2), processes=True, spawn_interval=3, steps=80) == run((1, 1), spawn_interval=3, steps=80)
+
+
+def test_bids_never_tie():
+    serials = np.arange(10000, dtype=np.int64)
+    bids = car_bids(9, 3, serials)
+    assert len(np.unique(bids)) == len(serials)
+    assert (car_bids(9, 3, serials) == bids).all()
+    assert (car_bids(9, 4, serials) != bids).any()
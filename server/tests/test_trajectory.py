@@ -0,0 +1,105 @@
+import os
+import pytest
+from model import CityModel
+from runner import take_snapshot
+from sessions import file_name, recording_folder
+from trajectory import TrajectoryReader, TrajectoryRecorder, frame_snapshot, is_inside
+
+MAP = "city_files/2022_base.txt"
+
+
+def run_snapshots(steps, seed=5):
+    """
+    Snapshots of the first steps of a model, the initial state included.
+    """
+    model = CityModel(MAP, spawn_interval=2, seed=seed)
+    snapshots = [take_snapshot(model)]
+    for _ in range(steps):
+        model.step()
+        snapshots.append(take_snapshot(model))
+    return snapshots
+
+
+def record(folder, snapshots, **options):
+    recorder = TrajectoryRecorder(folder, snapshots[0].traffic_lights, chunk_steps=10, **options)
+    for snapshot in snapshots:
+        recorder.record(snapshot)
+    recorder.close()
+    return recorder
+
+
+def read(folder):
+    reader = TrajectoryReader(folder)
+    return [frame_snapshot(reader.lights, frame) for frame in reader.frames()]
+
+
+def same_steps(frames, snapshots):
+    return [(frame.step, frame.total, frame.cars, frame.traffic_lights) for frame in frames] == \
+           [(snapshot.step, snapshot.total, snapshot.cars, snapshot.traffic_lights) for snapshot in snapshots]
+
+
+def test_recording_reads_back_every_step(tmp_path):
+    snapshots = run_snapshots(25)
+    folder = str(tmp_path / "run")
+    record(folder, snapshots)
+    assert [chunk[1:] for chunk in TrajectoryReader(folder).chunks] == [(0, 9), (10, 19), (20, 25)]
+    assert same_steps(read(folder), snapshots)
+    assert same_steps([frame_snapshot(TrajectoryReader(folder).lights, frame)
+                       for frame in TrajectoryReader(folder).frames(12, 21)], snapshots[12:22])
+
+
+def test_resume_keeps_the_earlier_chunks_and_truncates_the_rest(tmp_path):
+    snapshots = run_snapshots(25)
+    folder = str(tmp_path / "run")
+    record(folder, snapshots)
+    first_chunk = os.path.join(folder, "chunk_000000", "steps.npy")
+    written = os.stat(first_chunk).st_mtime_ns
+
+    # The model restarts from step 14, so steps 15 to 25 are recorded again by a different run.
+    rerun = run_snapshots(30, seed=6)
+    recorder = TrajectoryRecorder(folder, snapshots[0].traffic_lights, chunk_steps=10, resume_step=14)
+    assert [chunk[1:] for chunk in recorder.meta["chunks"]] == [(0, 9), (10, 14)]
+    assert not os.path.exists(os.path.join(folder, "chunk_000002"))
+    assert os.stat(first_chunk).st_mtime_ns == written
+    for snapshot in rerun[15:]:
+        recorder.record(snapshot)
+    recorder.close()
+
+    assert same_steps(read(folder), snapshots[:15] + rerun[15:])
+
+
+def test_new_recording_replaces_the_folder(tmp_path):
+    folder = str(tmp_path / "run")
+    record(folder, run_snapshots(25))
+    snapshots = run_snapshots(4, seed=6)
+    record(folder, snapshots)
+    assert sorted(os.listdir(folder)) == ["chunk_000000", "meta.json"]
+    assert same_steps(read(folder), snapshots)
+
+
+def test_unsafe_session_ids_get_their_own_folder_inside_the_recordings(tmp_path):
+    root = str(tmp_path / "recordings")
+    ids = [".", "..", "../other", "/etc", "a/b", "a_b", "a\\b", ".hidden", "x" * 100, "default"]
+    folders = [recording_folder(root, session_id) for session_id in ids]
+    assert all(is_inside(folder, root) for folder in folders)
+    assert all(os.path.dirname(folder) == root for folder in folders)
+    assert len(set(folders)) == len(ids)
+    assert file_name("default") == "default"
+    assert file_name("a_b") == "a_b"
+
+
+def test_session_recording_never_deletes_outside_the_recordings(tmp_path):
+    root = tmp_path / "recordings"
+    root.mkdir()
+    (tmp_path / "keep.txt").write_text("kept")
+    snapshots = run_snapshots(2)
+    for session_id in (".", ".."):
+        record(recording_folder(str(root), session_id), snapshots, root=str(root))
+    assert (tmp_path / "keep.txt").read_text() == "kept"
+    assert len(os.listdir(root)) == 2
+
+    with pytest.raises(ValueError):
+        TrajectoryRecorder(str(tmp_path), snapshots[0].traffic_lights, root=str(root))
+    with pytest.raises(ValueError):
+        TrajectoryRecorder(str(root), snapshots[0].traffic_lights, root=str(root))
+    assert (tmp_path / "keep.txt").read_text() == "kept"
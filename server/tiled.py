@@ -0,0 +1,432 @@
+"""
+Engine that splits the city into tiles and moves the cars of every tile in its own worker process.
+
+It follows the rules of VectorizedCityModel, with the state the workers need in shared memory:
+    occupancy, red: State of every cell
+    car table: One slot per car (serial, cell, destination, direction, spawn step), reused when the car leaves
+    border cells: The cells a car of another tile can move into, numbered from 0 to the number of border cells
+    bids: One row per worker, the bids of its cars for the border cells
+    handoffs: Slot of the car that moved into every border cell from another tile, -1 if none did
+    spawned: Slots of the cars the main process added since the workers last took them, -1 for the unused entries
+
+The main process spawns the cars and advances the lights, then the workers move the cars:
+    1. Every worker keeps the slots of the cars on its tile, so it never looks at the cars of the others.
+       It adds the cars spawned on its tile and the ones handed to it: a car that crosses into another
+       tile is left in the handoff of the border cell it moved into, and taken by that tile on the next step.
+    2. The cars move in rounds. In each round every car that can move bids for its next cell and the highest
+       bid gets it. A bid is a hash of the seed, the step and the car, so the cars that move are the same
+       whatever the number of tiles. Only the cells on a border can get bids from the cars of other tiles,
+       and only for those the workers read the bids of the others.
+Barriers keep the workers in the same phase, so a worker never reads what another one is writing.
+"""
+import multiprocessing
+import threading
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+from city_map import load_city_map
+from road_graph import DIRECTIONS
+from traffic_control import FIXED
+from vectorized import VectorizedCityModel
+
+# Columns of the stats row of every worker, written on each step.
+ARRIVED, TRAVEL_TIME, MOVED, BLOCKED = range(4)
+# Fields of the control array.
+STEP, STOP, SEED, USED = range(4)
+NO_BID = -1
+
+
+def car_bids(seed, step, serials):
+    """
+    Returns the bids of some cars on a step: a 31 bit hash (splitmix64) of the seed, the step and the car
+    in the high bits and the serial of the car in the low bits, so two cars never bid the same.
+    """
+    with np.errstate(over="ignore"):
+        z = serials.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64((seed * 0x632BE59BD9B4E019 + step) % 2 ** 64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return ((z >> np.uint64(33)).astype(np.int64) << 32) | (serials & 0xFFFFFFFF)
+
+
+class SharedArrays:
+    """
+    Numpy arrays in shared memory. The model creates them and the workers attach to them by name.
+    Attributes:
+        specs: Dictionary of array name to (shared memory name, shape, dtype), all a worker needs to attach
+        arrays: Dictionary of array name to array
+    """
+    def __init__(self, specs=None):
+        self.specs = dict(specs or {})
+        self.arrays = {}
+        self._memory = []
+        for name, (memory_name, shape, dtype) in self.specs.items():
+            memory = shared_memory.SharedMemory(name=memory_name)
+            self._memory.append(memory)
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+    def create(self, name, shape, dtype, fill=0):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        self._memory.append(memory)
+        array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        array.fill(fill)
+        self.specs[name] = (memory.name, shape, np.dtype(dtype).str)
+        self.arrays[name] = array
+        return array
+
+    def close(self, unlink=False):
+        """
+        Detaches from the shared memory, and frees it if unlink.
+        """
+        self.arrays = {}
+        for memory in self._memory:
+            try:
+                memory.close()
+            except BufferError:
+                # An array still uses it, it is detached when the process ends.
+                pass
+            if unlink:
+                memory.unlink()
+        self._memory = []
+
+
+class TileWorker:
+    """
+    Moves the cars of one tile. Its phases are called in order, with barriers between them, by a worker
+    process, or one tile after the other by the model when it runs without processes.
+    """
+    def __init__(self, index, arrays):
+        self.index = index
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.bid_cells = np.zeros(0, dtype=np.int64)
+        self.own = np.zeros(0, dtype=np.int64)
+        # Border cells of the tile, where the cars of the other tiles are handed to it.
+        border_cells = np.flatnonzero(self.border_index >= 0)
+        self.incoming = self.border_index[border_cells[self.tiles[border_cells] == index]]
+
+    def begin_step(self):
+        """
+        Takes the cars handed to the tile, removes the ones that arrived and finds the next cell of the others.
+        """
+        step = int(self.control[STEP])
+        handed = self.handoffs[self.incoming]
+        self.handoffs[self.incoming] = -1
+        spawned = self.spawned[self.spawned >= 0]
+        spawned = spawned[self.tiles[self.cells[spawned]] == self.index]
+        slots = np.concatenate([self.own, handed[handed >= 0], spawned])
+        targets = self.next_hop[self.destinations[slots], self.cells[slots]]
+
+        # Cars without a next cell are at their destination (or can't reach it) and leave the grid.
+        arrived = targets < 0
+        leaving = slots[arrived]
+        np.subtract.at(self.occupancy, self.cells[leaving], 1)
+        finished = leaving[self.cells[leaving] == self.destination_cells[self.destinations[leaving]]]
+        self.stats[self.index, ARRIVED] = len(finished)
+        self.stats[self.index, TRAVEL_TIME] = int((step - self.spawn_steps[finished]).sum())
+        self.alive[leaving] = False
+        self.slots = slots[~arrived]
+        self.targets = targets[~arrived]
+
+        # Cars look at the next cell even if they can't move into it.
+        target_directions = self.directions[self.targets]
+        self.car_directions[self.slots] = np.where(target_directions != 0, target_directions, self.car_directions[self.slots])
+
+        self.car_bids = car_bids(int(self.control[SEED]), step, self.serials[self.slots])
+        self.waiting = ~self.red[self.targets]
+        self.left = np.zeros(len(self.slots), dtype=bool)
+        self.moved = 0
+
+    def bid(self):
+        """
+        Picks the highest bid of the tile for every free cell and publishes the ones for border cells.
+        """
+        self.bids[self.index, self.bid_cells] = NO_BID
+        candidates = np.flatnonzero(self.waiting & (self.occupancy[self.targets] == 0))
+        targets = self.targets[candidates]
+        order = np.lexsort((-self.car_bids[candidates], targets))
+        _, first = np.unique(targets[order], return_index=True)
+        self.winners = candidates[order[first]]
+        border_index = self.border_index[self.targets[self.winners]]
+        border = border_index >= 0
+        self.bid_cells = border_index[border]
+        self.bids[self.index, self.bid_cells] = self.car_bids[self.winners[border]]
+
+    def resolve(self):
+        """
+        Moves the cars that won their cell, also against the bids of the other tiles.
+        """
+        winners = self.winners
+        targets = self.targets[winners]
+        lost = np.zeros(len(winners), dtype=bool)
+        border_index = self.border_index[targets]
+        border = np.flatnonzero(border_index >= 0)
+        if len(border):
+            lost[border] = self.bids[:, border_index[border]].max(axis=0) != self.car_bids[winners[border]]
+        winners = winners[~lost]
+        targets = targets[~lost]
+        border_index = border_index[~lost]
+
+        slots = self.slots[winners]
+        np.subtract.at(self.occupancy, self.cells[slots], 1)
+        self.occupancy[targets] += 1
+        self.cells[slots] = targets
+        self.waiting[winners] = False
+        # The cars that moved into another tile are handed to it.
+        crossed = self.tiles[targets] != self.index
+        self.handoffs[border_index[crossed]] = slots[crossed]
+        self.left[winners[crossed]] = True
+        self.moved += len(winners)
+        self.stats[self.index, MOVED] = len(winners)
+
+    def end_step(self):
+        self.own = self.slots[~self.left]
+        self.stats[self.index, BLOCKED] = len(self.slots) - self.moved
+
+
+def run_worker(index, specs, max_rounds, start, phase, done):
+    """
+    Loop of a worker process: waits for the model to start a step, moves the cars of its tile and waits for the others.
+    """
+    shared = SharedArrays(specs)
+    worker = TileWorker(index, shared.arrays)
+    control = shared.arrays["control"]
+    stats = shared.arrays["stats"]
+    while True:
+        start.wait()
+        if control[STOP]:
+            break
+        worker.begin_step()
+        phase.wait()
+        for _ in range(max_rounds):
+            worker.bid()
+            phase.wait()
+            worker.resolve()
+            phase.wait()
+            if not stats[:, MOVED].any():
+                break
+        worker.end_step()
+        done.wait()
+    del worker, control, stats
+    shared.close()
+
+
+def _shut_down(shared, processes, start, *barriers):
+    # Stops the workers and frees the shared memory. It doesn't use the model, so it can run once the model is collected.
+    if processes:
+        shared.arrays["control"][STOP] = 1
+        try:
+            start.wait(5)
+        except threading.BrokenBarrierError:
+            pass
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+    shared.close(unlink=True)
+
+
+class TiledCityModel(VectorizedCityModel):
+    """
+    VectorizedCityModel with the cars moved by one worker per tile, see the module docstring. The only
+    difference in the rules is which car gets a cell several cars want: the highest bid instead of a random
+    one, so a seed gives the same simulation with any number of tiles, with or without processes.
+    Attributes:
+        tiles: Columns and rows of tiles
+        capacity: Maximum number of cars at the same time
+        workers: TileWorker of every tile when they run in this process, None when they run in processes
+    """
+    def __init__(self, map_file="city_files/2022_base.txt", spawn_interval=10, light_timings=None, seed=None, city_map=None,
+                 light_control=FIXED, profile_every=None, tiles=(2, 2), processes=True, max_rounds=8, capacity=None,
+                 timeout=60):
+        """
+        Creates the engine and starts its workers, close() stops them.
+        Args:
+            map_file, spawn_interval, light_timings, seed, city_map, light_control, profile_every: See VectorizedCityModel
+            tiles: Columns and rows of tiles the map is split into
+            processes: Whether each tile runs in its own process. Without processes the tiles run one after the
+                other in this process, with the same results
+            max_rounds: How many times cells freed during the step are offered again to the cars behind them
+            capacity: Maximum number of cars at the same time, twice the number of cells if None
+            timeout: Seconds to wait for the workers on each step before giving up
+        """
+        if city_map is None:
+            city_map = load_city_map(map_file)
+        if seed is None:
+            seed = int(np.random.default_rng().integers(2 ** 31))
+        self.seed = seed
+        self.tiles = tuple(tiles)
+        self.max_rounds = max_rounds
+        self.timeout = timeout
+        self.capacity = capacity or 2 * city_map.width * city_map.height
+        self._use_processes = processes
+        self.shared = None
+        super().__init__(map_file, spawn_interval, light_timings, seed, city_map, light_control, profile_every)
+
+    def _share(self):
+        """
+        Moves the state of the engine to shared memory and starts the workers.
+        """
+        graph = self.graph
+        size = self.width * self.height
+        columns, rows = self.tiles
+        count = columns * rows
+        x, y = self._coordinates(np.arange(size))
+        tile_of_cell = (x * columns // self.width) * rows + y * rows // self.height
+        # A cell is on a border if a car of another tile can move into it.
+        sources = np.repeat(np.arange(size), np.diff(graph.indptr))
+        border = np.zeros(size, dtype=bool)
+        border[graph.indices[tile_of_cell[sources] != tile_of_cell[graph.indices]]] = True
+        border_count = int(border.sum())
+
+        shared = self.shared = SharedArrays()
+        arrays = {
+            "control": shared.create("control", (4,), np.int64),
+            "stats": shared.create("stats", (count, 4), np.int64),
+            "tiles": shared.create("tiles", (size,), np.int32),
+            "border_index": shared.create("border_index", (size,), np.int32, -1),
+            "occupancy": shared.create("occupancy", (size,), np.int32),
+            "red": shared.create("red", (size,), bool),
+            "directions": shared.create("directions", (size,), np.uint8),
+            "next_hop": shared.create("next_hop", self.next_hop.shape, self.next_hop.dtype),
+            "destination_cells": shared.create("destination_cells", self.destination_cells.shape, np.int32),
+            "bids": shared.create("bids", (count, border_count), np.int64, NO_BID),
+            "handoffs": shared.create("handoffs", (border_count,), np.int64, -1),
+            # The cars spawned with the model wait there with the ones of the first step.
+            "spawned": shared.create("spawned", (2 * len(self.corners),), np.int64, -1),
+            "alive": shared.create("alive", (self.capacity,), bool),
+            "serials": shared.create("serials", (self.capacity,), np.int64),
+            "cells": shared.create("cells", (self.capacity,), np.int32),
+            "destinations": shared.create("destinations", (self.capacity,), np.int32),
+            "car_directions": shared.create("car_directions", (self.capacity,), np.uint8),
+            "spawn_steps": shared.create("spawn_steps", (self.capacity,), np.int32)
+        }
+        arrays["control"][SEED] = self.seed
+        arrays["tiles"][:] = tile_of_cell
+        arrays["border_index"][border] = np.arange(border_count)
+        arrays["occupancy"][:] = self.occupancy
+        arrays["red"][:] = self.red
+        arrays["directions"][:] = graph.directions
+        arrays["next_hop"][:] = self.next_hop
+        arrays["destination_cells"][:] = self.destination_cells
+        for name in ("control", "stats", "spawned") + self._car_state:
+            setattr(self, name, arrays[name])
+
+        self.processes = []
+        self._start = self._phase = self._done = None
+        if self._use_processes:
+            self.workers = None
+            # The barriers are kept here until the workers stop, the semaphores go away with the last reference.
+            context = multiprocessing.get_context("spawn")
+            self._start = context.Barrier(count + 1)
+            self._phase = context.Barrier(count)
+            self._done = context.Barrier(count + 1)
+            for index in range(count):
+                process = context.Process(target=run_worker, name=f"city-tile-{index}", daemon=True,
+                                          args=(index, shared.specs, self.max_rounds, self._start, self._phase, self._done))
+                process.start()
+                self.processes.append(process)
+        else:
+            self.workers = [TileWorker(index, arrays) for index in range(count)]
+        self._finalizer = weakref.finalize(self, _shut_down, shared, self.processes, self._start, self._phase, self._done)
+
+    # Arrays the model keeps after close().
+    _car_state = ("occupancy", "red", "alive", "serials", "cells", "destinations", "car_directions", "spawn_steps")
+
+    def close(self):
+        """
+        Stops the workers and frees the shared memory. The cars and lights can still be read afterwards.
+        """
+        if self.shared is None or not self._finalizer.alive:
+            return
+        for name in self._car_state:
+            setattr(self, name, np.array(getattr(self, name)))
+        self.control = self.stats = self.spawned = self.workers = None
+        self._finalizer()
+        self.running = False
+
+    def generate_new_cars(self):
+        """
+            Generates new cars in all the corners in the simulation.
+        """
+        if self.shared is None:
+            # First call, from VectorizedCityModel.__init__ once the lights are set.
+            self._share()
+        count = len(self.corners)
+        used = int(self.control[USED])
+        # Slots of the cars that left are reused first.
+        slots = np.flatnonzero(~self.alive[:used])[:count]
+        if len(slots) < count:
+            added = count - len(slots)
+            if used + added > self.capacity:
+                raise RuntimeError(f"The simulation can't have more than {self.capacity} cars")
+            slots = np.concatenate([slots, np.arange(used, used + added)])
+            self.control[USED] = used + added
+        self.serials[slots] = np.arange(self.cars_count, self.cars_count + count)
+        self.cells[slots] = self.corners
+        self.destinations[slots] = self.random.integers(0, len(self.destination_ids), count)
+        self.car_directions[slots] = self.graph.directions[self.corners]
+        self.spawn_steps[slots] = self.step_count
+        self.alive[slots] = True
+        self.spawned[np.flatnonzero(self.spawned < 0)[:count]] = slots
+        np.add.at(self.occupancy, self.corners, 1)
+        self.cars_count += count
+
+    def step_cars(self):
+        """
+        Lets the workers move the cars of their tiles.
+        """
+        self.control[STEP] = self.step_count
+        if self.workers is None:
+            try:
+                self._start.wait(self.timeout)
+                self._done.wait(self.timeout)
+            except threading.BrokenBarrierError:
+                raise RuntimeError("The workers of the tiles stopped responding")
+        else:
+            for worker in self.workers:
+                worker.begin_step()
+            for _ in range(self.max_rounds):
+                for worker in self.workers:
+                    worker.bid()
+                for worker in self.workers:
+                    worker.resolve()
+                if not self.stats[:, MOVED].any():
+                    break
+            for worker in self.workers:
+                worker.end_step()
+        # The workers took the new cars.
+        self.spawned[:] = -1
+        self.arrived_cars += int(self.stats[:, ARRIVED].sum())
+        self.total_travel_time += int(self.stats[:, TRAVEL_TIME].sum())
+        self.metrics.blocked_cars = int(self.stats[:, BLOCKED].sum())
+
+    def step(self):
+        '''Advance the model by one step.'''
+        self.step_count += 1
+        metrics = self.metrics
+        metrics.begin(self.step_count)
+        if self.step_count % self.spawn_interval == 0:
+            self.generate_new_cars()
+        metrics.lap("spawn")
+        self.step_traffic_lights()
+        metrics.lap("lights")
+        self.step_cars()
+        metrics.lap("moves")
+        metrics.end(int(self.alive.sum()), self.arrived_cars, self.cars_count)
+
+    def get_cars(self):
+        """
+        Returns the cars as the list of dictionaries sent to the visualization, in the order they were created.
+        """
+        slots = np.flatnonzero(self.alive)
+        slots = slots[np.argsort(self.serials[slots])]
+        x, z = self._coordinates(self.cells[slots])
+        return [{
+            "id": f"c_{serial}",
+            "x": car_x,
+            "y": 0,
+            "dir": DIRECTIONS[direction],
+            "z": car_z
+        } for serial, car_x, car_z, direction in zip(self.serials[slots].tolist(), x.tolist(), z.tolist(), self.car_directions[slots].tolist())]
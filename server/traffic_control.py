@@ -0,0 +1,286 @@
+from collections import deque
+import numpy as np
+from map_compiler import ROAD, TRAFFIC_LIGHT
+from road_graph import UP, DOWN, LEFT, RIGHT
+
+# How the controller picks the green phase of each intersection.
+# fixed: every intersection runs the same cycle at the same time.
+# green_wave: the same cycle, shifted so a group of cars that gets a green keeps finding greens along its road.
+# adaptive: the phases still alternate, but the green goes to the other phase as soon as nobody is waiting
+# for the current one (or its exits are full), and stays while nobody is waiting for the other one.
+# It can lock up dense traffic that the fixed cycle keeps moving, so fixed is the default and adaptive is opt-in.
+FIXED, GREEN_WAVE, ADAPTIVE = "fixed", "green_wave", "adaptive"
+MODES = (FIXED, GREEN_WAVE, ADAPTIVE)
+
+# Offset of the next cell in each direction.
+STEPS = {UP: (0, 1), DOWN: (0, -1), LEFT: (-1, 0), RIGHT: (1, 0)}
+
+
+class Intersection:
+    """
+    Lights of one intersection, split in two phases that are never green at the same time.
+    Phase 0 has the lights that start green in the map (lower case), phase 1 the ones that start red.
+    Which phase is green is kept by the TrafficController, in one array for all the intersections.
+    Attributes:
+        phases: Indices of the lights of each phase
+        approaches: Cells where the cars of each phase wait for the green
+        exits: Cells right after the lights of each phase
+        offset: Steps the cycle of the intersection is shifted
+    """
+    def __init__(self, phases):
+        self.phases = phases
+        self.approaches = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+        self.exits = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+        self.offset = 0
+
+
+class Segments:
+    """
+    Cells of every intersection concatenated in one array, so a step reduces all of them with numpy at once.
+    Attributes:
+        cells: Cell ids of all the intersections, one after the other
+        starts: Index in cells of the first cell of every intersection
+        counts: Number of cells of every intersection
+    """
+    def __init__(self, cells_of_intersections):
+        self.counts = np.array([len(cells) for cells in cells_of_intersections], dtype=np.int64)
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.cells = np.concatenate([np.zeros(0, dtype=np.int64)] + list(cells_of_intersections))
+
+    def sums(self, values):
+        """
+        Returns the sum of values over the cells of every intersection.
+        """
+        # reduceat needs every start inside the array and gives the value at the start for the empty segments,
+        # so the array gets one more element and the empty segments are set to 0.
+        values = np.append(values[self.cells], 0)
+        return np.where(self.counts > 0, np.add.reduceat(values, self.starts), 0)
+
+    def all(self, values):
+        """
+        Returns whether values is true in all the cells of every intersection, False for the ones without cells.
+        """
+        values = np.append(values[self.cells] > 0, True)
+        return (self.counts > 0) & np.logical_and.reduceat(values, self.starts)
+
+
+def find_intersections(positions, groups, radius=2):
+    """
+    Groups the lights that are close to each other into intersections.
+    Args:
+        positions: (x, y) of every light
+        groups: Whether every light starts green
+        radius: Lights at this Chebyshev distance or less belong to the same intersection
+    Returns:
+        List of Intersection, ordered by their first light
+    """
+    parents = list(range(len(positions)))
+
+    def root(light):
+        while parents[light] != light:
+            parents[light] = parents[parents[light]]
+            light = parents[light]
+        return light
+
+    # Lights are put in square buckets of the size of the radius, so each one is only compared with the
+    # lights of its bucket and the ones around it.
+    buckets = {}
+    for light, (x, y) in enumerate(positions):
+        buckets.setdefault((x // (radius + 1), y // (radius + 1)), []).append(light)
+    for first, (x1, y1) in enumerate(positions):
+        column, row = x1 // (radius + 1), y1 // (radius + 1)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for second in buckets.get((column + dx, row + dy), ()):
+                    x2, y2 = positions[second]
+                    if second > first and max(abs(x1 - x2), abs(y1 - y2)) <= radius:
+                        parents[root(second)] = root(first)
+
+    members = {}
+    for light in range(len(positions)):
+        members.setdefault(root(light), []).append(light)
+    return [Intersection([np.array([light for light in lights if groups[light]], dtype=np.int64),
+                          np.array([light for light in lights if not groups[light]], dtype=np.int64)])
+            for lights in members.values()]
+
+
+class TrafficController:
+    """
+    Sets the state of all the traffic lights of a model. The lights of an intersection are grouped in two phases,
+    and the controller decides which phase is green on every step, so the lights are no longer scheduled one by one.
+    Attributes:
+        mode: FIXED, GREEN_WAVE or ADAPTIVE
+        cells: Cell id of every light, in the order of CityMap.traffic_lights
+        states: Whether every light is green
+        green_times: Green time of phase 0 and phase 1 in the fixed cycle
+        cycle: Length of the fixed cycle
+        intersections: List of Intersection
+        phase: Phase that is green at every intersection
+        elapsed: Steps since the phase of every intersection turned green
+        time: Number of steps of the controller
+    """
+    def __init__(self, city_map, mode=FIXED, light_timings=None, queue_depth=4, min_green=3):
+        """
+        Groups the lights of a map and sets their first state.
+        Args:
+            city_map: CityMap with the lights
+            mode: FIXED, GREEN_WAVE or ADAPTIVE
+            light_timings: Green time of the lights that start red and of the ones that start green,
+                the timings of the map if None
+            queue_depth: How many cells before a light count as its queue (adaptive)
+            min_green: Minimum steps a phase stays green (adaptive). The maximum, while the other phase
+                has cars waiting, is its green time in the fixed cycle
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown traffic light mode: {mode}")
+        lights = city_map.traffic_lights
+        graph = city_map.road_graph
+        red_timing, green_timing = light_timings or city_map.light_timings
+        self.mode = mode
+        self.cells = np.array([graph.cell_id(pos) for _, pos, _, _, _ in lights], dtype=np.int64)
+        self.states = np.array([state for _, _, state, _, _ in lights], dtype=bool)
+        self.green_times = (green_timing, red_timing)
+        self.cycle = green_timing + red_timing
+        self.min_green = min_green
+        self.intersections = find_intersections([pos for _, pos, _, _, _ in lights], self.states.tolist())
+        self.time = 0
+
+        # Intersection and phase of every light, so the states of all of them follow from the phases in one go.
+        self._light_intersection = np.zeros(len(lights), dtype=np.int64)
+        self._light_phase = np.zeros(len(lights), dtype=np.int8)
+        for index, intersection in enumerate(self.intersections):
+            for phase, phase_lights in enumerate(intersection.phases):
+                self._light_intersection[phase_lights] = index
+                self._light_phase[phase_lights] = phase
+        if mode == GREEN_WAVE:
+            self._green_wave_offsets(city_map)
+        elif mode == ADAPTIVE:
+            self._approaches(city_map, queue_depth)
+        self._offsets = np.array([intersection.offset for intersection in self.intersections], dtype=np.int64)
+        self.elapsed = np.zeros(len(self.intersections), dtype=np.int32)
+        self.phase = self._fixed_phase() if mode != ADAPTIVE else np.zeros(len(self.intersections), dtype=np.int8)
+        self.states[:] = self.phase[self._light_intersection] == self._light_phase
+
+    def _fixed_phase(self):
+        """
+        Returns the phase of every intersection in the fixed cycle at the current time.
+        """
+        positions = (self.time + self._offsets) % self.cycle
+        return (positions >= self.green_times[0]).astype(np.int8)
+
+    def _green_wave_offsets(self, city_map):
+        """
+        Follows the road from every light to the next intersection and shifts the cycle of that intersection
+        by the steps a car needs to get there, so the phase of the light it reaches turns green when it arrives.
+        Intersections are visited in order from the first one, and keep the first offset they get.
+        """
+        graph = city_map.road_graph
+        kinds = city_map.kinds
+        directions = city_map.directions
+        light_of_cell = {cell: light for light, cell in enumerate(self.cells.tolist())}
+        intersection_of_light = {}
+        phase_of_light = {}
+        for index, intersection in enumerate(self.intersections):
+            for phase, lights in enumerate(intersection.phases):
+                for light in lights.tolist():
+                    intersection_of_light[light] = index
+                    phase_of_light[light] = phase
+        phase_starts = (0, self.green_times[0])
+
+        links = [[] for _ in self.intersections]
+        for light, cell in enumerate(self.cells.tolist()):
+            direction = int(directions[cell])
+            if direction not in STEPS:
+                continue
+            dx, dy = STEPS[direction]
+            x, y = graph.positions[cell]
+            distance = 0
+            while True:
+                x, y = x + dx, y + dy
+                distance += 1
+                if not (0 <= x < graph.width and 0 <= y < graph.height):
+                    break
+                next_cell = graph.cell_id((x, y))
+                if kinds[next_cell] not in (ROAD, TRAFFIC_LIGHT) or directions[next_cell] != direction:
+                    break
+                reached = light_of_cell.get(next_cell)
+                if reached is not None and intersection_of_light[reached] != intersection_of_light[light]:
+                    links[intersection_of_light[light]].append((intersection_of_light[reached], phase_of_light[light],
+                                                                 phase_of_light[reached], distance))
+                    break
+
+        assigned = [False] * len(self.intersections)
+        for first in range(len(self.intersections)):
+            if assigned[first]:
+                continue
+            assigned[first] = True
+            frontier = deque([first])
+            while frontier:
+                current = frontier.popleft()
+                offset = self.intersections[current].offset
+                for reached, phase, reached_phase, distance in links[current]:
+                    if not assigned[reached]:
+                        assigned[reached] = True
+                        self.intersections[reached].offset = (phase_starts[reached_phase] - phase_starts[phase] + offset - distance) % self.cycle
+                        frontier.append(reached)
+
+    def _approaches(self, city_map, queue_depth):
+        """
+        Finds the cells up to queue_depth moves before the lights of every phase, and the cells right after them.
+        """
+        adjacency = city_map.road_graph.adjacency
+        predecessors = city_map.road_graph.predecessors
+        lights = set(self.cells.tolist())
+        for intersection in self.intersections:
+            for phase, phase_lights in enumerate(intersection.phases):
+                exits = {cell for light in self.cells[phase_lights].tolist() for cell in adjacency[light] if cell not in lights}
+                intersection.exits[phase] = np.array(sorted(exits), dtype=np.int64)
+                depth = {cell: 0 for cell in self.cells[phase_lights].tolist()}
+                frontier = deque(depth)
+                while frontier:
+                    current = frontier.popleft()
+                    if depth[current] == queue_depth:
+                        continue
+                    for previous in predecessors[current]:
+                        if previous not in depth and previous not in lights:
+                            depth[previous] = depth[current] + 1
+                            frontier.append(previous)
+                intersection.approaches[phase] = np.array([cell for cell, steps in depth.items() if steps > 0], dtype=np.int64)
+        self._phase_sizes = np.array([[len(lights) for lights in intersection.phases] for intersection in self.intersections],
+                                     dtype=np.int64).reshape(-1, 2)
+        self._approach_segments = [Segments([intersection.approaches[phase] for intersection in self.intersections]) for phase in (0, 1)]
+        self._exit_segments = [Segments([intersection.exits[phase] for intersection in self.intersections]) for phase in (0, 1)]
+
+    def step(self, occupancy=None):
+        """
+        Advances the lights one step.
+        Args:
+            occupancy: Number of cars in every cell, needed by the adaptive mode
+        Returns:
+            Indices of the lights that changed
+        """
+        previous = self.states.copy()
+        self.time += 1
+        self.elapsed += 1
+        if self.mode != ADAPTIVE:
+            phase = self._fixed_phase()
+            self.elapsed[phase != self.phase] = 0
+            self.phase = phase
+        else:
+            # The sums and the full exits of both phases of every intersection, then picked by the phase that is green.
+            current = self.phase.astype(np.int64)
+            other = 1 - current
+            rows = np.arange(len(self.intersections))
+            waiting = np.stack([segments.sums(occupancy) for segments in self._approach_segments], axis=1)
+            # A phase whose exits are all taken can't let anybody through, so it gives the green away and doesn't get it.
+            blocked = np.stack([segments.all(occupancy) for segments in self._exit_segments], axis=1)
+            green_times = np.array(self.green_times)[current]
+            # The green never lasts longer than in the fixed cycle while the other phase has cars waiting:
+            # longer greens for the longest queue let the roads fill up until the whole city locks.
+            switch = ((self.elapsed >= self.min_green) & (self._phase_sizes[rows, other] > 0)
+                      & (waiting[rows, other] > 0) & ~blocked[rows, other]
+                      & ((waiting[rows, current] == 0) | blocked[rows, current] | (self.elapsed >= green_times)))
+            self.phase[switch] = other[switch]
+            self.elapsed[switch] = 0
+        self.states[:] = self.phase[self._light_intersection] == self._light_phase
+        return np.flatnonzero(self.states != previous)
@@ -0,0 +1,261 @@
+"""
+Recording of the cars and lights of every step, in chunked columnar files that can be memory-mapped.
+
+A recording is a folder with a meta.json and one folder per chunk of steps. Each chunk has one .npy file per column:
+    steps, totals: Step number and arrived cars of every step in the chunk
+    offsets: Row of the first car of every step in the car columns, plus the number of rows at the end
+    id, x, z, dir: Car columns, one row per car per step, same types as stream.CAR_RECORD
+    lights: One row per step with the state of every light
+Reading a range of steps only maps the chunks it touches, so long runs never have to fit in memory.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+from road_graph import DIRECTIONS
+from runner import Snapshot
+from stream import CAR_RECORD, car_records
+
+CAR_COLUMNS = ("id", "x", "z", "dir")
+STEP_COLUMNS = ("steps", "totals", "offsets")
+
+
+def _chunk_name(index):
+    return f"chunk_{index:06d}"
+
+
+class TrajectoryReader:
+    """
+    Reads a recording.
+    Attributes:
+        folder: Folder of the recording
+        lights: List of (unique_id, x, z) of the lights, in the order of the light columns
+        chunks: List of (name, first step, last step) of the chunks
+    """
+    def __init__(self, folder, meta=None):
+        self.folder = folder
+        if meta is None:
+            with open(os.path.join(folder, "meta.json")) as metaFile:
+                meta = json.load(metaFile)
+        self.lights = [tuple(light) for light in meta["lights"]]
+        self.chunks = [tuple(chunk) for chunk in meta["chunks"]]
+
+    @property
+    def first_step(self):
+        return self.chunks[0][1] if self.chunks else None
+
+    @property
+    def last_step(self):
+        return self.chunks[-1][2] if self.chunks else None
+
+    def frames(self, start=None, stop=None):
+        """
+        Yields the recorded steps from start to stop (both included), in order.
+        Yields:
+            (step, total, cars, lights): cars is an array of stream.CAR_RECORD, lights the state of every light
+        """
+        for name, first, last in self.chunks:
+            if (stop is not None and first > stop) or (start is not None and last < start):
+                continue
+            yield from chunk_frames(load_chunk(self.folder, name), start, stop)
+
+
+def load_chunk(folder, name):
+    """
+    Memory-maps the columns of a chunk of a recording.
+    Returns:
+        Dictionary of column name to array
+    """
+    folder = os.path.join(folder, name)
+    return {column: np.load(os.path.join(folder, f"{column}.npy"), mmap_mode="r")
+            for column in STEP_COLUMNS + CAR_COLUMNS + ("lights",)}
+
+
+def chunk_frames(columns, start=None, stop=None):
+    """
+    Yields the steps of a chunk between start and stop, see TrajectoryReader.frames.
+    """
+    steps = columns["steps"]
+    begin = 0 if start is None else int(np.searchsorted(steps, start))
+    end = len(steps) if stop is None else int(np.searchsorted(steps, stop, side="right"))
+    offsets = columns["offsets"]
+    for index in range(begin, end):
+        rows = slice(int(offsets[index]), int(offsets[index + 1]))
+        cars = np.empty(rows.stop - rows.start, dtype=CAR_RECORD)
+        for column in CAR_COLUMNS:
+            cars[column] = columns[column][rows]
+        yield int(steps[index]), int(columns["totals"][index]), cars, np.asarray(columns["lights"][index], dtype=bool)
+
+
+def is_inside(path, root):
+    """
+    Returns whether path is strictly inside the folder root, once the links and the .. of both are resolved.
+    """
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return path != root and os.path.commonpath([path, root]) == root
+
+
+class TrajectoryRecorder:
+    """
+    Records the snapshots of a runner into a recording folder, chunk_steps steps per chunk.
+    The steps of the current chunk are kept in memory until the chunk is full or the recorder is closed.
+    Attributes:
+        folder: Folder of the recording
+        chunk_steps: Steps per chunk
+    """
+    def __init__(self, folder, traffic_lights, chunk_steps=1000, resume_step=None, root=None):
+        """
+        Opens a recording.
+        Args:
+            folder: Folder of the recording
+            traffic_lights: Traffic lights of the model, as returned by get_traffic_lights
+            chunk_steps: Steps per chunk
+            resume_step: Continue the recording in the folder, dropping the steps after resume_step.
+                If None, the folder is replaced by a new recording
+            root: Folder the recording has to be inside. Nothing is deleted outside of it
+        Raises:
+            ValueError: If the folder isn't inside root
+        """
+        if root is not None and not is_inside(folder, root):
+            raise ValueError(f"The recording {folder} isn't inside {root}")
+        self.folder = folder
+        self.chunk_steps = chunk_steps
+        self._lock = threading.Lock()
+        meta = None
+        if resume_step is not None and os.path.exists(os.path.join(folder, "meta.json")):
+            with open(os.path.join(folder, "meta.json")) as metaFile:
+                meta = json.load(metaFile)
+            chunks = []
+            for name, first, last in meta["chunks"]:
+                if first <= resume_step < last:
+                    # The chunk goes past the step, only its first steps are kept.
+                    chunks.append((name, first, self._truncate_chunk(name, resume_step)))
+                elif last <= resume_step:
+                    chunks.append((name, first, last))
+                else:
+                    shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+            meta["chunks"] = chunks
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+            meta = {"lights": [(light["id"], light["x"], light["z"]) for light in traffic_lights], "chunks": []}
+        self.meta = meta
+        self.next_chunk = max((int(name.split("_")[-1]) + 1 for name, _, _ in meta["chunks"]), default=0)
+        self._write_meta()
+        self._clear()
+
+    def _clear(self):
+        self.steps = []
+        self.totals = []
+        self.cars = []
+        self.lights = []
+
+    def _write_meta(self):
+        temporary = os.path.join(self.folder, "meta.json.tmp")
+        with open(temporary, "w") as metaFile:
+            json.dump(self.meta, metaFile)
+        os.replace(temporary, os.path.join(self.folder, "meta.json"))
+
+    def record(self, snapshot):
+        """
+        Adds the step of a snapshot, writing the chunk if it is full.
+        """
+        with self._lock:
+            self.steps.append(snapshot.step)
+            self.totals.append(snapshot.total)
+            self.cars.append(car_records(snapshot.cars))
+            self.lights.append([light["state"] for light in snapshot.traffic_lights])
+            if len(self.steps) >= self.chunk_steps:
+                self._flush()
+
+    def _flush(self):
+        if not self.steps:
+            return
+        cars = np.concatenate(self.cars)
+        columns = {
+            "steps": np.array(self.steps, dtype="<i4"),
+            "totals": np.array(self.totals, dtype="<i4"),
+            "offsets": np.concatenate([[0], np.cumsum([len(step_cars) for step_cars in self.cars])]).astype("<i8"),
+            "lights": np.array(self.lights, dtype="u1").reshape(len(self.steps), len(self.meta["lights"]))
+        }
+        for column in CAR_COLUMNS:
+            columns[column] = np.ascontiguousarray(cars[column])
+        name = _chunk_name(self.next_chunk)
+        self._write_chunk(name, columns)
+        self.meta["chunks"].append((name, self.steps[0], self.steps[-1]))
+        self.next_chunk += 1
+        self._write_meta()
+        self._clear()
+
+    def _write_chunk(self, name, columns):
+        # Written next to its final place and renamed, so readers never see half a chunk.
+        temporary = tempfile.mkdtemp(dir=self.folder)
+        for column, values in columns.items():
+            np.save(os.path.join(temporary, f"{column}.npy"), values)
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(temporary, path)
+
+    def _truncate_chunk(self, name, last_step):
+        """
+        Rewrites a chunk without the steps after last_step.
+        Returns:
+            The last step kept
+        """
+        columns = load_chunk(self.folder, name)
+        steps = int(np.searchsorted(columns["steps"], last_step, side="right"))
+        rows = int(columns["offsets"][steps])
+        kept = {column: np.array(columns[column][:steps]) for column in ("steps", "totals", "lights")}
+        kept["offsets"] = np.array(columns["offsets"][:steps + 1])
+        kept.update((column, np.array(columns[column][:rows])) for column in CAR_COLUMNS)
+        del columns
+        self._write_chunk(name, kept)
+        return int(kept["steps"][-1])
+
+    def flush(self):
+        """
+        Writes the steps in memory as a chunk, even if it isn't full.
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def frames(self, start=None, stop=None):
+        """
+        Yields the recorded steps from start to stop, including the ones still in memory. See TrajectoryReader.frames.
+        """
+        with self._lock:
+            reader = TrajectoryReader(self.folder, {"lights": self.meta["lights"], "chunks": list(self.meta["chunks"])})
+            pending = list(zip(self.steps, self.totals, self.cars, self.lights))
+        yield from reader.frames(start, stop)
+        for step, total, cars, lights in pending:
+            if (start is None or step >= start) and (stop is None or step <= stop):
+                yield step, total, cars, np.array(lights, dtype=bool)
+
+
+def frame_snapshot(lights, frame):
+    """
+    Turns a recorded step into a Snapshot, e.g. to send it with stream.DeltaEncoder.
+    Args:
+        lights: List of (unique_id, x, z) of the lights of the recording
+        frame: (step, total, cars, lights) as yielded by frames
+    """
+    step, total, cars, states = frame
+    return Snapshot(step, total, tuple({
+        "id": f"c_{car_id}",
+        "x": x,
+        "y": 0,
+        "dir": DIRECTIONS[direction],
+        "z": z
+    } for car_id, x, z, direction in cars.tolist()), tuple({
+        "id": unique_id,
+        "x": x,
+        "y": 1,
+        "z": z,
+        "state": state
+    } for (unique_id, x, z), state in zip(lights, states.tolist())), None)
@@ -0,0 +1,184 @@
+import numpy as np
+from city_map import load_city_map
+from road_graph import DIRECTIONS
+from traffic_control import TrafficController, FIXED
+from metrics import StepMetrics
+
+
+class VectorizedCityModel:
+    """
+    Alternative engine for the city simulation. Cars, traffic lights and occupancy are numpy
+    arrays and every step is resolved with batched operations instead of one agent call per car.
+    It follows the same rules as CityModel (spawns every 10 steps at the corners, lights set by a
+    TrafficController, cars that wait on red lights and occupied cells), but all
+    the cars move at the same time: a car can enter a cell left by another car in the same step,
+    and when several cars want the same cell a random one wins.
+    Attributes:
+        width, height: Size of the map
+        step_count: Number of steps of the simulation
+        cars_count: Number of cars created
+        arrived_cars: Number of cars that reached their destination
+        total_travel_time: Sum of the steps the arrived cars took to get to their destination
+        metrics: StepMetrics of the steps. Routes are rows of a table, so there is no routing phase
+    """
+    def __init__(self, map_file="city_files/2022_base.txt", spawn_interval=10, light_timings=None, seed=None, city_map=None,
+                 light_control=FIXED, profile_every=None):
+        """
+        Creates the engine.
+        Args:
+            map_file: Path of the map file to load
+            spawn_interval: Every how many steps new cars appear in the corners
+            light_timings: Green time of the lights that start red and of the lights that start green, the timings of the map if None
+            seed: Seed of the random number generator
+            city_map: Already parsed CityMap, map_file is ignored if given
+            light_control: How the lights are coordinated, "fixed", "green_wave" or "adaptive" (see traffic_control)
+            profile_every: Every how many steps a step is run under cProfile (see metrics), None to never profile
+        """
+        if city_map is None:
+            city_map = load_city_map(map_file)
+        self.city_map = city_map
+        self.random = np.random.default_rng(seed)
+        self.graph = city_map.road_graph
+        self.width = city_map.width
+        self.height = city_map.height
+        self.cars_count = 0
+        self.step_count = 0
+        self.arrived_cars = 0
+        self.total_travel_time = 0
+        self.metrics = StepMetrics(profile_every)
+        self.spawn_interval = spawn_interval
+        self.running = True
+
+        graph = self.graph
+        self.corners = np.array([graph.cell_id(pos) for pos in city_map.corners], dtype=np.int32)
+
+        # One row of next cells per destination. A car only needs its cell and its destination row.
+        self.destination_ids = [unique_id for unique_id, _ in city_map.destinations]
+        self.destination_cells = np.array([graph.cell_id(pos) for _, pos in city_map.destinations], dtype=np.int32)
+        self.next_hop = city_map.next_hops
+
+        self.light_ids = [unique_id for unique_id, _, _, _, _ in city_map.traffic_lights]
+        self.light_cells = np.array([graph.cell_id(pos) for _, pos, _, _, _ in city_map.traffic_lights], dtype=np.int32)
+        self.light_timings = tuple(light_timings or city_map.light_timings)
+        self.traffic_control = TrafficController(city_map, light_control, self.light_timings)
+        self.light_states = self.traffic_control.states
+        self.light_x, self.light_z = self._coordinates(self.light_cells)
+        self.red = np.zeros(self.width * self.height, dtype=bool)
+        self.red[self.light_cells] = ~self.light_states
+
+        # Cars, one entry per car in the simulation.
+        self.car_serials = np.zeros(0, dtype=np.int64)
+        self.car_cells = np.zeros(0, dtype=np.int32)
+        self.car_destinations = np.zeros(0, dtype=np.int32)
+        self.car_directions = np.zeros(0, dtype=np.uint8)
+        self.car_spawn_steps = np.zeros(0, dtype=np.int32)
+        self.occupancy = np.zeros(self.width * self.height, dtype=np.int32)
+
+        self.generate_new_cars()
+
+    def _coordinates(self, cells):
+        return cells // self.height, cells % self.height
+
+    def generate_new_cars(self):
+        """
+            Generates new cars in all the corners in the simulation.
+        """
+        count = len(self.corners)
+        self.car_serials = np.concatenate([self.car_serials, np.arange(self.cars_count, self.cars_count + count)])
+        self.car_cells = np.concatenate([self.car_cells, self.corners])
+        self.car_destinations = np.concatenate([self.car_destinations, self.random.integers(0, len(self.destination_ids), count).astype(np.int32)])
+        self.car_directions = np.concatenate([self.car_directions, self.graph.directions[self.corners]])
+        self.car_spawn_steps = np.concatenate([self.car_spawn_steps, np.full(count, self.step_count, dtype=np.int32)])
+        np.add.at(self.occupancy, self.corners, 1)
+        self.cars_count += count
+
+    def step_traffic_lights(self):
+        """
+        Lets the controller advance the lights.
+        """
+        changed = self.traffic_control.step(self.occupancy)
+        self.red[self.light_cells[changed]] = ~self.light_states[changed]
+
+    def step_cars(self, max_rounds=8):
+        """
+        Moves every car that can move one cell along its route.
+        Args:
+            max_rounds: How many times cells freed during the step are offered again to the cars behind them
+        """
+        targets = self.next_hop[self.car_destinations, self.car_cells]
+
+        # Cars without a next cell are at their destination (or can't reach it) and leave the grid.
+        arrived = targets < 0
+        if arrived.any():
+            np.subtract.at(self.occupancy, self.car_cells[arrived], 1)
+            finished = arrived & (self.car_cells == self.destination_cells[self.car_destinations])
+            self.arrived_cars += int(finished.sum())
+            self.total_travel_time += int((self.step_count - self.car_spawn_steps[finished]).sum())
+            keep = ~arrived
+            self.car_serials = self.car_serials[keep]
+            self.car_cells = self.car_cells[keep]
+            self.car_destinations = self.car_destinations[keep]
+            self.car_directions = self.car_directions[keep]
+            self.car_spawn_steps = self.car_spawn_steps[keep]
+            targets = targets[keep]
+
+        # Cars look at the next cell even if they can't move into it.
+        target_directions = self.graph.directions[targets]
+        self.car_directions = np.where(target_directions != 0, target_directions, self.car_directions)
+
+        waiting = ~self.red[targets]
+        moved = 0
+        for _ in range(max_rounds):
+            candidates = np.flatnonzero(waiting & (self.occupancy[targets] == 0))
+            if len(candidates) == 0:
+                break
+            # When several cars want the same cell, the first one in a random order gets it.
+            candidates = self.random.permutation(candidates)
+            _, first = np.unique(targets[candidates], return_index=True)
+            movers = candidates[first]
+
+            np.subtract.at(self.occupancy, self.car_cells[movers], 1)
+            self.occupancy[targets[movers]] += 1
+            self.car_cells[movers] = targets[movers]
+            waiting[movers] = False
+            moved += len(movers)
+        self.metrics.blocked_cars = len(targets) - moved
+
+    def step(self):
+        '''Advance the model by one step.'''
+        self.step_count += 1
+        metrics = self.metrics
+        metrics.begin(self.step_count)
+        if self.step_count % self.spawn_interval == 0:
+            self.generate_new_cars()
+        metrics.lap("spawn")
+        self.step_traffic_lights()
+        metrics.lap("lights")
+        self.step_cars()
+        metrics.lap("moves")
+        metrics.end(len(self.car_cells), self.arrived_cars, self.cars_count)
+
+    def get_cars(self):
+        """
+        Returns the cars as the list of dictionaries sent to the visualization.
+        """
+        x, z = self._coordinates(self.car_cells)
+        return [{
+            "id": f"c_{serial}",
+            "x": car_x,
+            "y": 0,
+            "dir": DIRECTIONS[direction],
+            "z": car_z
+        } for serial, car_x, car_z, direction in zip(self.car_serials.tolist(), x.tolist(), z.tolist(), self.car_directions.tolist())]
+
+    def get_traffic_lights(self):
+        """
+        Returns the traffic lights as the list of dictionaries sent to the visualization.
+        """
+        return [{
+            "id": unique_id,
+            "x": light_x,
+            "y": 1,
+            "z": light_z,
+            "state": state
+        } for unique_id, light_x, light_z, state in zip(self.light_ids, self.light_x.tolist(), self.light_z.tolist(), self.light_states.tolist())]